@@ -0,0 +1,190 @@
+"""Shared factory for convolution kernels.
+
+Kernels are built with vectorized numpy and memoized on the arguments that
+determine them (radius, pixel size and, for lat/lng rasters, latitude) so
+scripts that convolve many rasters or bands only build each kernel once.
+Returned arrays are read-only; copy them before modifying.
+"""
+import functools
+
+from osgeo import gdal
+from osgeo import osr
+import numpy
+import scipy.ndimage
+
+import pixel_area
+
+# degree lengths historically averaged to size WGS84 kernels
+_DEGREE_LEN_0 = 110574  # length at 0 degrees
+_DEGREE_LEN_60 = 111412  # length at 60 degrees
+
+
+def pixel_size_in_meters(pixel_size_degree, center_lat=None):
+    """Convert a square lat/lng pixel size to meters.
+
+    Args:
+        pixel_size_degree (float): side of the pixel in degrees.
+        center_lat (float): latitude the kernel will be used at. If None the
+            mean of the degree lengths at 0 and 60 degrees is used for both
+            axes.
+
+    Returns:
+        (x_meters, y_meters) tuple.
+
+    """
+    if center_lat is None:
+        degree_len = (_DEGREE_LEN_0 + _DEGREE_LEN_60) / 2.0
+        return (pixel_size_degree * degree_len,) * 2
+    lat_len, lng_len = pixel_area.length_of_degree(center_lat)
+    return (
+        float(pixel_size_degree * abs(lng_len)),
+        float(pixel_size_degree * lat_len))
+
+
+@functools.lru_cache(maxsize=64)
+def disk_coverage_kernel(radius, pixel_size, n_samples=200):
+    """Fraction of each pixel covered by a disk centered on the kernel.
+
+    Coverage is exact along y and midpoint sampled ``n_samples`` times
+    across each pixel in x, so it costs ``O(n_samples * width * height)``
+    rather than a supersampled distance transform.
+
+    Args:
+        radius (float): radius of the disk.
+        pixel_size (tuple): (x, y) size of a pixel in the same units as
+            ``radius``.
+        n_samples (int): samples per pixel along x.
+
+    Returns:
+        read-only float64 array of shape
+        ``(2*ceil(radius/y)+1, 2*ceil(radius/x)+1)`` with values in [0, 1].
+
+    """
+    x_size, y_size = pixel_size
+    x_radius = int(numpy.ceil(radius / x_size))
+    y_radius = int(numpy.ceil(radius / y_size))
+
+    # x sample positions within each kernel column
+    x_edge = (numpy.arange(-x_radius, x_radius+1) - 0.5) * x_size
+    x_sample = (
+        x_edge[:, None] + (numpy.arange(n_samples) + 0.5) *
+        x_size / n_samples)
+    half_chord = numpy.sqrt(numpy.maximum(radius**2 - x_sample**2, 0))
+
+    # overlap of each sampled chord with each kernel row
+    y_bottom = (numpy.arange(-y_radius, y_radius+1) - 0.5) * y_size
+    overlap = numpy.clip(
+        numpy.minimum(y_bottom[:, None, None] + y_size, half_chord) -
+        numpy.maximum(y_bottom[:, None, None], -half_chord), 0, None)
+    kernel_array = overlap.mean(axis=2) / y_size
+    kernel_array.setflags(write=False)
+    return kernel_array
+
+
+@functools.lru_cache(maxsize=64)
+def wgs84_disk_coverage_kernel(
+        radius_meters, pixel_size_degree, center_lat=None):
+    """Disk coverage kernel for a lat/lng raster, see
+    ``disk_coverage_kernel`` and ``pixel_size_in_meters``."""
+    return disk_coverage_kernel(
+        radius_meters, pixel_size_in_meters(pixel_size_degree, center_lat))
+
+
+def _kernel_distances(pixel_radius):
+    """Pixel distance from the center of a ``2*pixel_radius+1`` kernel."""
+    kernel_size = int(pixel_radius*2+1)
+    row_indices, col_indices = numpy.indices(
+        (kernel_size, kernel_size), dtype=numpy.float64) - pixel_radius
+    return numpy.hypot(row_indices, col_indices)
+
+
+@functools.lru_cache(maxsize=64)
+def hat_kernel(pixel_radius):
+    """1 within ``pixel_radius`` of the center and 0 outside.
+
+    Args:
+        pixel_radius (int): radius of the kernel in pixels.
+
+    Returns:
+        read-only float64 ``2*pixel_radius+1`` square array.
+
+    """
+    kernel_array = (
+        _kernel_distances(pixel_radius) <= pixel_radius).astype(
+            numpy.float64)
+    kernel_array.setflags(write=False)
+    return kernel_array
+
+
+@functools.lru_cache(maxsize=64)
+def linear_decay_kernel(pixel_radius):
+    """Linear decay from 1 at the center to 0 at ``pixel_radius``.
+
+    Args:
+        pixel_radius (int): radius of the kernel in pixels.
+
+    Returns:
+        read-only float64 ``2*pixel_radius+1`` square array.
+
+    """
+    kernel_array = numpy.clip(
+        (pixel_radius - _kernel_distances(pixel_radius)) / pixel_radius,
+        0, None)
+    kernel_array.setflags(write=False)
+    return kernel_array
+
+
+@functools.lru_cache(maxsize=None)
+def gaussian_kernel_1d(n):
+    """Build the 1D factor of an ``n`` x ``n`` gaussian kernel.
+
+    The 2D kernel is ``numpy.outer(kernel_1d, kernel_1d)``, this is exactly
+    a gaussian filtered delta of width ``n`` and sigma ``n/3``.
+
+    Args:
+        n (int): width of the kernel in pixels.
+
+    Returns:
+        read-only 1D float64 array of length ``n`` that sums to 1.
+
+    """
+    base = numpy.zeros(n)
+    base[n//2] = 1
+    kernel_1d = scipy.ndimage.gaussian_filter1d(base, n/3)
+    kernel_1d /= kernel_1d.sum()
+    kernel_1d.setflags(write=False)
+    return kernel_1d
+
+
+def write_kernel_raster(kernel_array, kernel_filepath, nodata):
+    """Write a kernel array to a GeoTIFF for ``convolve_2d``.
+
+    Args:
+        kernel_array (numpy.ndarray): 2D kernel.
+        kernel_filepath (str): path to target raster, overwritten if it
+            exists.
+        nodata (float): nodata value to set on the kernel band.
+
+    Returns:
+        None
+
+    """
+    driver = gdal.GetDriverByName('GTiff')
+    kernel_raster = driver.Create(
+        kernel_filepath.encode('utf-8'), kernel_array.shape[1],
+        kernel_array.shape[0], 1, gdal.GDT_Float32, options=[
+            'BIGTIFF=IF_SAFER', 'TILED=YES', 'BLOCKXSIZE=256',
+            'BLOCKYSIZE=256'])
+
+    # Make some kind of geotransform, it doesn't matter what but
+    # will make GIS libraries behave better if it's all defined
+    kernel_raster.SetGeoTransform([-180, 1, 0, 90, 0, -1])
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    kernel_raster.SetProjection(srs.ExportToWkt())
+    kernel_band = kernel_raster.GetRasterBand(1)
+    kernel_band.SetNoDataValue(nodata)
+    kernel_band.WriteArray(kernel_array)
+    kernel_band.FlushCache()
+    kernel_band = None
+    kernel_raster = None
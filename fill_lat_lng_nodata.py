@@ -2,161 +2,345 @@
 Fill lat/lng raster nodata
 """
 import argparse
+import concurrent.futures
 import glob
 import logging
 import multiprocessing
 import os
-import shutil
 import warnings
 import threading
 import time
 warnings.filterwarnings('error')
 
 from osgeo import gdal
-import ecoshard
 import pygeoprocessing
 import numpy
 import scipy.ndimage
-import taskgraph
+import scipy.signal
+
+import convolution_kernels
+import tiled_convolution
 
 gdal.SetCacheMax(2**26)
 
 N_CPUS = multiprocessing.cpu_count()
 
+# tiles are at least this wide and at least twice the kernel width
+_MIN_TILE_SIZE = 512
+# kernels wider than this are convolved with FFTs
+_FFT_KERNEL_SIZE = 64
+# rough peak bytes per padded tile pixel held while filling a tile
+_TILE_BYTES_PER_PIXEL = 64
+
 logging.basicConfig(
     level=logging.DEBUG,
     format=(
         '%(asctime)s (%(relativeCreated)d) %(processName)s %(levelname)s '
         '%(name)s [%(funcName)s:%(lineno)d] %(message)s'))
 LOGGER = logging.getLogger(__name__)
-logging.getLogger('taskgraph').setLevel(logging.DEBUG)
 logging.getLogger('pygeoprocessing').setLevel(logging.DEBUG)
 
 
+def _kernel_width(raster_info, convolve_radius):
+    """Width in pixels of the fill kernel for ``convolve_radius``."""
+    # this ensures a minimum of 3 pixels in case the pixel size is too
+    # chunky
+    return max(3, int(convolve_radius / raster_info['pixel_size'][0]))
+
+
+def estimate_fill_memory(raster_info, convolve_radius, n_threads):
+    """Estimate the peak bytes ``fill_by_convolution`` holds in memory.
+
+    Args:
+        raster_info (dict): ``pygeoprocessing.get_raster_info`` of the base.
+        convolve_radius (float): fill radius in projected units of base.
+        n_threads (int): number of tile threads the fill will use.
+
+    Returns:
+        estimated bytes.
+
+    """
+    n = _kernel_width(raster_info, convolve_radius)
+    padded_width = max(_MIN_TILE_SIZE, 2*n) + n - 1
+    # 2*n_threads tiles can be in flight
+    return 2 * n_threads * padded_width**2 * _TILE_BYTES_PER_PIXEL
+
+
+def _correlate_padded(padded_array, kernel_1d):
+    """Correlate a padded 2D array with ``outer(kernel_1d, kernel_1d)``.
+
+    Args:
+        padded_array (numpy.ndarray): 2D array padded by ``n//2`` before and
+            ``n-1-n//2`` after on both axes where ``n`` is
+            ``len(kernel_1d)``.
+        kernel_1d (numpy.ndarray): separable kernel factor.
+
+    Returns:
+        correlation the shape of ``padded_array`` without its padding.
+
+    """
+    n = len(kernel_1d)
+    if n > _FFT_KERNEL_SIZE:
+        # flip the kernel so convolution computes correlation
+        result = scipy.signal.fftconvolve(
+            padded_array, kernel_1d[::-1, None], mode='valid', axes=0)
+        return scipy.signal.fftconvolve(
+            result, kernel_1d[None, ::-1], mode='valid', axes=1)
+    result = scipy.ndimage.correlate1d(
+        padded_array, kernel_1d, axis=0, mode='constant')
+    result = scipy.ndimage.correlate1d(
+        result, kernel_1d, axis=1, mode='constant')
+    before = n//2
+    after = n-1-before
+    return result[before:result.shape[0]-after, before:result.shape[1]-after]
+
+
+def _box_any_padded(padded_mask, n):
+    """Test for any True in each ``n`` x ``n`` window of a padded mask.
+
+    Args:
+        padded_mask (numpy.ndarray): 2D boolean array padded as in
+            ``_correlate_padded``.
+        n (int): window width.
+
+    Returns:
+        boolean array the shape of ``padded_mask`` without its padding.
+
+    """
+    count = padded_mask.astype(numpy.int32)
+    for axis in (0, 1):
+        cumulative = numpy.cumsum(count, axis=axis)
+        cumulative = numpy.concatenate(
+            [numpy.zeros_like(cumulative.take([0], axis=axis)), cumulative],
+            axis=axis)
+        size = cumulative.shape[axis]
+        count = (
+            cumulative.take(numpy.arange(n, size), axis=axis) -
+            cumulative.take(numpy.arange(0, size-n), axis=axis))
+    return count > 0
+
+
+def _fill_tile(base_raster_path, nodata, kernel_1d, tile_offset):
+    """Fill the nodata holes in one tile of the base raster.
+
+    Args:
+        base_raster_path (str): path to base raster.
+        nodata (float): nodata value of the base raster, may be None.
+        kernel_1d (numpy.ndarray): separable gaussian kernel factor.
+        tile_offset (dict): tile window with 'xoff', 'yoff', 'win_xsize' and
+            'win_ysize'.
+
+    Returns:
+        filled tile array.
+
+    """
+    n = len(kernel_1d)
+    before = n//2
+    after = n-1-before
+    raster = gdal.OpenEx(base_raster_path, gdal.OF_RASTER)
+    band = raster.GetRasterBand(1)
+
+    # read the tile plus its halo, anything off the raster stays invalid
+    x_min = max(0, tile_offset['xoff']-before)
+    y_min = max(0, tile_offset['yoff']-before)
+    x_max = min(
+        raster.RasterXSize,
+        tile_offset['xoff']+tile_offset['win_xsize']+after)
+    y_max = min(
+        raster.RasterYSize,
+        tile_offset['yoff']+tile_offset['win_ysize']+after)
+    halo_array = band.ReadAsArray(
+        xoff=x_min, yoff=y_min, win_xsize=x_max-x_min,
+        win_ysize=y_max-y_min)
+    band = None
+    raster = None
+
+    padded_shape = (
+        tile_offset['win_ysize']+n-1, tile_offset['win_xsize']+n-1)
+    padded_slice = (
+        slice(y_min-(tile_offset['yoff']-before),
+              y_max-(tile_offset['yoff']-before)),
+        slice(x_min-(tile_offset['xoff']-before),
+              x_max-(tile_offset['xoff']-before)))
+    padded_valid = numpy.zeros(padded_shape, dtype=bool)
+    padded_valid[padded_slice] = _mask_valid_op(halo_array, nodata)
+    padded_base = numpy.zeros(padded_shape)
+    padded_base[padded_slice] = numpy.where(
+        padded_valid[padded_slice], halo_array, 0)
+
+    tile_slice = (
+        slice(before, before+tile_offset['win_ysize']),
+        slice(before, before+tile_offset['win_xsize']))
+    result = halo_array[
+        tile_offset['yoff']-y_min:
+        tile_offset['yoff']-y_min+tile_offset['win_ysize'],
+        tile_offset['xoff']-x_min:
+        tile_offset['xoff']-x_min+tile_offset['win_xsize']].copy()
+    hole_mask = ~padded_valid[tile_slice]
+    if nodata is not None:
+        # sanitize non-finite values to nodata
+        result[hole_mask] = nodata
+
+    # only holes with a valid pixel under the kernel footprint get filled
+    fill_mask = hole_mask & _box_any_padded(padded_valid, n)
+    if not fill_mask.any():
+        return result
+    numerator = _correlate_padded(padded_base, kernel_1d)
+    denominator = _correlate_padded(
+        padded_valid.astype(numpy.float64), kernel_1d)
+    result[fill_mask] = numerator[fill_mask] / denominator[fill_mask]
+    return result
+
+
 def fill_by_convolution(
-        base_raster_path, convolve_radius, target_filled_raster_path):
+        base_raster_path, convolve_radius, target_filled_raster_path,
+        n_threads=None):
     """Clip and fill.
 
-    Clip the base raster data to the bounding box then fill any noodata
-    holes with a weighted distance convolution.
+    Fill any nodata or non-finite holes in the base raster with a gaussian
+    weighted average of the valid pixels within ``convolve_radius``. The
+    raster is processed in halo padded tiles in a thread pool, only the
+    target raster is written. A first pass indexes which tiles have holes,
+    tiles without holes are copied straight through and only tiles with
+    holes within reach of valid pixels are convolved.
 
     Args:
         base_raster_path (str): path to base raster
         convolve_radius (float): maximum convolution distance kernel in
             projected units of base.
         target_filled_raster_path (str): raster created by convolution fill,
-            if holes are too far from valid pixels resulting fill will be
-            nonsensical, perhaps NaN.
+            holes with no valid pixels within the kernel are left as nodata.
+        n_threads (int): number of tiles to process at once, defaults to
+            the number of CPUs.
 
     Return:
         None
     """
     try:
         LOGGER.info(f'filling {base_raster_path}')
-        # create working directory in the same directory as the target with
-        # the same name as the target file so it can't be duplicated
-        # easier to spot for debugging too
-        working_dir = os.path.join(
-            os.path.dirname(target_filled_raster_path),
-            os.path.basename(os.path.splitext(target_filled_raster_path)[0]))
-        try:
-            os.makedirs(working_dir)
-        except OSError:
-            pass
-
-        basename = os.path.basename(target_filled_raster_path)
         base_raster_info = pygeoprocessing.get_raster_info(base_raster_path)
-
-        # this ensures a minimum of 3 pixels in case the pixel size is too
-        # chunky
-        n = max(3, int(convolve_radius / base_raster_info['pixel_size'][0]))
-        base = numpy.zeros((n, n))
-        base[n//2, n//2] = 1
-        kernel_array = scipy.ndimage.filters.gaussian_filter(base, n/3)
-        kernel_raster_path = os.path.join(working_dir, f'kernel_{basename}')
-        geotransform = base_raster_info['geotransform']
-        pygeoprocessing.numpy_array_to_raster(
-            kernel_array, None, base_raster_info['pixel_size'],
-            (geotransform[0], geotransform[3]),
-            base_raster_info['projection_wkt'], kernel_raster_path)
-
-        # scrub input raster
-        sanitized_base_raster_path = os.path.join(
-            working_dir, f'sanitized_{basename}')
-        sanitize_raster(base_raster_path, sanitized_base_raster_path)
-
-        # mask valid
-        valid_raster_path = os.path.join(
-            working_dir, f'sanitized_{basename}')
-        pygeoprocessing.raster_calculator(
-            [(base_raster_path, 1), (base_raster_info['nodata'][0], 'raw')],
-            _mask_valid_op, valid_raster_path, gdal.GDT_Byte, None)
-        mask_kernel_raster_path = os.path.join(
-            working_dir, f'mask_kernel_{basename}')
-        geotransform = base_raster_info['geotransform']
-        mask_kernel_array = numpy.copy(kernel_array)
-        mask_kernel_array[:] = 1
-        pygeoprocessing.numpy_array_to_raster(
-            mask_kernel_array, None, base_raster_info['pixel_size'],
-            (geotransform[0], geotransform[3]),
-            base_raster_info['projection_wkt'], mask_kernel_raster_path)
-        coverage_raster_path = os.path.join(
-            working_dir, f'coverage_{basename}')
-        pygeoprocessing.convolve_2d(
-            (valid_raster_path, 1), (mask_kernel_raster_path, 1),
-            coverage_raster_path,
-            mask_nodata=False,
-            target_nodata=-1,
-            target_datatype=gdal.GDT_Byte,
-            working_dir=working_dir)
-
-        # this raster will be filled with the entire convolution
-        backfill_raster_path = os.path.join(
-            working_dir, f'backfill_{basename}')
         base_nodata = base_raster_info['nodata'][0]
-        if base_nodata is None:
-            target_datatype = gdal.GDT_Float64
-        else:
-            target_datatype = base_raster_info['datatype']
-        LOGGER.info(
-            f'create backfill from {sanitized_base_raster_path} to '
-            f'{backfill_raster_path}')
-        pygeoprocessing.convolve_2d(
-            (sanitized_base_raster_path, 1), (kernel_raster_path, 1),
-            backfill_raster_path, ignore_nodata_and_edges=True,
-            mask_nodata=False, normalize_kernel=True,
-            target_nodata=base_nodata,
-            target_datatype=target_datatype,
-            working_dir=working_dir)
-
-        LOGGER.info(
-            f'fill nodata of {base_raster_path} to {backfill_raster_path}')
-        pygeoprocessing.raster_calculator(
-            [(base_raster_path, 1),
-             (backfill_raster_path, 1), (coverage_raster_path, 1),
-             (base_nodata, 'raw')], _fill_nodata_op,
-            target_filled_raster_path,
-            base_raster_info['datatype'], base_nodata)
-        shutil.rmtree(working_dir)
+
+        n = _kernel_width(base_raster_info, convolve_radius)
+        kernel_1d = convolution_kernels.gaussian_kernel_1d(n)
+
+        pygeoprocessing.new_raster_from_base(
+            base_raster_path, target_filled_raster_path,
+            base_raster_info['datatype'], [base_nodata])
+
+        if n_threads is None:
+            n_threads = N_CPUS
+        tile_size = max(_MIN_TILE_SIZE, 2*n)
+        n_cols, n_rows = base_raster_info['raster_size']
+        tile_offset_list = [
+            {'xoff': xoff, 'yoff': yoff,
+             'win_xsize': min(tile_size, n_cols-xoff),
+             'win_ysize': min(tile_size, n_rows-yoff)}
+            for yoff in range(0, n_rows, tile_size)
+            for xoff in range(0, n_cols, tile_size)]
+
+        target_raster = gdal.OpenEx(
+            target_filled_raster_path, gdal.OF_RASTER | gdal.OF_UPDATE)
+        target_band = target_raster.GetRasterBand(1)
+        # bound the tiles in flight so finished tiles don't pile up in memory
+        max_pending = 2*n_threads
+        n_tile_rows = (n_rows+tile_size-1) // tile_size
+        n_tile_cols = (n_cols+tile_size-1) // tile_size
+        has_hole = numpy.zeros((n_tile_rows, n_tile_cols), dtype=bool)
+        has_valid = numpy.zeros((n_tile_rows, n_tile_cols), dtype=bool)
+        with concurrent.futures.ThreadPoolExecutor(n_threads) as executor:
+            # index pass: copy tiles without holes straight through and
+            # note which tiles have holes or valid pixels
+            for tile_offset, (tile_has_hole, tile_has_valid, tile_array) in (
+                    tiled_convolution.iter_tile_results(
+                        executor, _index_tile,
+                        (base_raster_path, base_nodata), tile_offset_list,
+                        max_pending)):
+                tile_index = (
+                    tile_offset['yoff']//tile_size,
+                    tile_offset['xoff']//tile_size)
+                has_hole[tile_index] = tile_has_hole
+                has_valid[tile_index] = tile_has_valid
+                if not tile_has_hole:
+                    _write_tile(target_band, tile_offset, tile_array)
+
+            # the halo is at most half a tile so only holes in tiles next to
+            # a tile with valid pixels can be filled
+            fill_tile_mask = has_hole & scipy.ndimage.maximum_filter(
+                has_valid, size=3, mode='constant')
+            LOGGER.info(
+                f'{numpy.count_nonzero(fill_tile_mask)} of '
+                f'{len(tile_offset_list)} tiles have fillable holes in '
+                f'{base_raster_path}')
+            fill_offset_list = []
+            unfillable_offset_list = []
+            for tile_offset in tile_offset_list:
+                tile_index = (
+                    tile_offset['yoff']//tile_size,
+                    tile_offset['xoff']//tile_size)
+                if fill_tile_mask[tile_index]:
+                    fill_offset_list.append(tile_offset)
+                elif has_hole[tile_index]:
+                    unfillable_offset_list.append(tile_offset)
+
+            for tile_offset, tile_array in (
+                    tiled_convolution.iter_tile_results(
+                        executor, _fill_tile,
+                        (base_raster_path, base_nodata, kernel_1d),
+                        fill_offset_list, max_pending)):
+                _write_tile(target_band, tile_offset, tile_array)
+
+            # unfillable tiles have no valid pixels, so they are all nodata
+            # or, without a nodata value, copied as they are
+            if base_nodata is not None:
+                for tile_offset in unfillable_offset_list:
+                    _write_tile(target_band, tile_offset, numpy.full(
+                        (tile_offset['win_ysize'], tile_offset['win_xsize']),
+                        base_nodata, dtype=base_raster_info['numpy_type']))
+            else:
+                for tile_offset, (_, _, tile_array) in (
+                        tiled_convolution.iter_tile_results(
+                            executor, _index_tile,
+                            (base_raster_path, base_nodata),
+                            unfillable_offset_list, max_pending)):
+                    _write_tile(target_band, tile_offset, tile_array)
+        target_band = None
+        target_raster = None
     except Exception:
         LOGGER.exception(
             f'error on fill by convolution {target_filled_raster_path}')
         raise
 
 
-def _fill_nodata_op(base, fill, valid, nodata):
-    result = numpy.copy(base)
-    valid_mask = valid > 0
-    if nodata is not None:
-        valid_mask &= numpy.isclose(base, nodata)
-    result[valid_mask] = fill[valid_mask]
-    return result
+def _index_tile(base_raster_path, nodata, tile_offset):
+    """Read a tile and test it for holes and valid pixels.
 
+    Args:
+        base_raster_path (str): path to base raster.
+        nodata (float): nodata value of the base raster, may be None.
+        tile_offset (dict): tile window with 'xoff', 'yoff', 'win_xsize' and
+            'win_ysize'.
+
+    Returns:
+        (has_hole, has_valid, tile_array) tuple, ``tile_array`` has its
+        non-finite values set to nodata if ``nodata`` is not None.
+
+    """
+    raster = gdal.OpenEx(base_raster_path, gdal.OF_RASTER)
+    tile_array = raster.GetRasterBand(1).ReadAsArray(**tile_offset)
+    raster = None
+    valid_mask = _mask_valid_op(tile_array, nodata)
+    has_valid = bool(valid_mask.any())
+    has_hole = not valid_mask.all()
+    if has_hole and nodata is not None:
+        tile_array[~valid_mask] = nodata
+    return has_hole, has_valid, tile_array
 
-def _non_finite_to_fill_op(base_array, fill):
-    result = numpy.copy(base_array)
-    result[~numpy.isfinite(base_array)] = fill
-    return result
+
+def _write_tile(target_band, tile_offset, tile_array):
+    """Write ``tile_array`` to ``target_band`` at ``tile_offset``."""
+    target_band.WriteArray(
+        tile_array, xoff=tile_offset['xoff'], yoff=tile_offset['yoff'])
 
 
 def _mask_valid_op(base_array, nodata):
@@ -164,32 +348,82 @@ def _mask_valid_op(base_array, nodata):
     if nodata is not None:
         valid_mask = ~numpy.isclose(base_array, nodata)
     else:
-        valid_mask = numpy.ones(base_array.shape, dtype=numpy.bool)
+        valid_mask = numpy.ones(base_array.shape, dtype=bool)
     valid_mask &= numpy.isfinite(base_array)
     return valid_mask
 
 
-def sanitize_raster(base_raster_path, target_raster_path):
-    """Scrub base raster of any non-finite values to nodata.
-
-    If noodata is None then scrub to 0.
+def fill_rasters(
+        raster_path_list, convolve_radius, output_dir, filled_raster_prefix,
+        memory_budget, n_workers):
+    """Fill many rasters concurrently under a memory budget.
 
     Args:
-        base_raster_path (str): path to base raster
-        target_raster_path (str): path to target raster
+        raster_path_list (list): paths to rasters to fill.
+        convolve_radius (float): fill radius in projected units of the
+            rasters.
+        output_dir (str): directory to write filled rasters to.
+        filled_raster_prefix (str): prefix for filled raster basenames.
+        memory_budget (int): approximate bytes the concurrent fills may hold,
+            a fill that alone exceeds the budget runs by itself.
+        n_workers (int): maximum number of rasters to fill at once, the CPUs
+            are split evenly between them for tile threads.
+
+    Returns:
+        dict mapping raster path to fill time in seconds.
 
-    Return:
-        None.
     """
-    raster_info = pygeoprocessing.get_raster_info(
-        base_raster_path)
-    fill_value = raster_info['nodata'][0]
-    if fill_value is None:
-        fill_value = 0
-    pygeoprocessing.raster_calculator(
-        [(base_raster_path, 1), (fill_value, 'raw')], _non_finite_to_fill_op,
-        target_raster_path, raster_info['datatype'],
-        raster_info['nodata'][0])
+    os.makedirs(output_dir, exist_ok=True)
+    job_list = []
+    target_path_set = set()
+    n_workers = max(1, min(n_workers, len(raster_path_list)))
+    n_threads = max(1, N_CPUS // n_workers)
+    for raster_path in raster_path_list:
+        pre, post = os.path.splitext(os.path.basename(raster_path))
+        target_fill_path = os.path.join(
+            output_dir, f'{filled_raster_prefix}{pre}{convolve_radius}{post}')
+        if target_fill_path in target_path_set:
+            raise ValueError(
+                f'{raster_path} would overwrite another fill at '
+                f'{target_fill_path}')
+        target_path_set.add(target_fill_path)
+        job_memory = min(memory_budget, estimate_fill_memory(
+            pygeoprocessing.get_raster_info(raster_path), convolve_radius,
+            n_threads))
+        job_list.append((raster_path, target_fill_path, job_memory))
+
+    budget_condition = threading.Condition()
+    available_memory = [memory_budget]
+    fill_time_map = {}
+
+    def _fill_job(raster_path, target_fill_path, job_memory):
+        with budget_condition:
+            budget_condition.wait_for(
+                lambda: available_memory[0] >= job_memory)
+            available_memory[0] -= job_memory
+        try:
+            start_time = time.time()
+            fill_by_convolution(
+                raster_path, convolve_radius, target_fill_path,
+                n_threads=n_threads)
+            fill_time_map[raster_path] = time.time() - start_time
+            LOGGER.info(
+                f'filled {raster_path} to {target_fill_path} in '
+                f'{fill_time_map[raster_path]:.2f}s')
+        finally:
+            with budget_condition:
+                available_memory[0] += job_memory
+                budget_condition.notify_all()
+
+    with concurrent.futures.ThreadPoolExecutor(n_workers) as executor:
+        future_list = [
+            executor.submit(_fill_job, *job) for job in job_list]
+        for future in future_list:
+            future.result()
+
+    for raster_path in raster_path_list:
+        LOGGER.info(f'{fill_time_map[raster_path]:8.2f}s {raster_path}')
+    return fill_time_map
 
 
 if __name__ == '__main__':
@@ -210,13 +444,20 @@ if __name__ == '__main__':
         '--filled_raster_prefix', default='filled_', help=(
             'Prefix to put on filled raster from their original path, '
             'default is `filled_`.'))
+    parser.add_argument(
+        '--n_workers', type=int, default=N_CPUS, help=(
+            'Maximum number of rasters to fill at once, default is the '
+            'number of CPUs.'))
+    parser.add_argument(
+        '--memory_budget_gb', type=float, default=4.0, help=(
+            'Approximate memory the concurrent fills may use in GB, '
+            'default is 4.'))
 
     args = parser.parse_args()
-    for raster_pattern in args.raster_pattern:
-        for raster_path in glob.glob(raster_pattern):
-            pre, post = os.path.splitext(os.path.basename(raster_path))
-            target_fill_path = os.path.join(
-                args.output_dir,
-                f'{args.filled_raster_prefix}'
-                f'{pre}{args.radius}{post}')
-            fill_by_convolution(raster_path, args.radius, target_fill_path)
+    raster_path_list = [
+        raster_path for raster_pattern in args.raster_pattern
+        for raster_path in glob.glob(raster_pattern)]
+    fill_rasters(
+        raster_path_list, args.radius, args.output_dir,
+        args.filled_raster_prefix, int(args.memory_budget_gb * 2**30),
+        args.n_workers)
@@ -1,9 +1,9 @@
 """Demo of how to use pandas to multiply one table by another."""
 import os
+import tempfile
 
 from osgeo import gdal
-from osgeo import ogr
-from osgeo import osr
+import numpy
 import pandas
 
 # Justin said this was his reference
@@ -14,67 +14,162 @@ inv_gt = gdal.InvGeoTransform(esa_lulc_geotransform)
 base_table_path = '1_test_data.csv'
 lasso_table_path = 'lasso_interacted_not_forest_gs1to100_params.csv'
 
-print('reading')
-base_table_df = pandas.read_csv(base_table_path)
-lasso_df = pandas.read_csv(lasso_table_path)
-
-target_df = pandas.DataFrame()
-
-gpkg_driver = ogr.GetDriverByName('GPKG')
-base_id = os.path.basename(os.path.splitext(base_table_path)[0])
-vector = gpkg_driver.CreateDataSource(f'{base_id}.gpkg')
-wgs84_srs = osr.SpatialReference()
-wgs84_srs.ImportFromEPSG(4326)
-layer = vector.CreateLayer(base_id, wgs84_srs, geom_type=ogr.wkbPoint)
-layer_def = layer.GetLayerDefn()
-
-header_pos = {}
-print('start lasso')
-for row_index, row in lasso_df.iterrows():
-    header = row[0]
-    header_pos[header] = row_index
-
-    field = ogr.FieldDefn(header, ogr.OFTReal)
-    layer.CreateField(field)
-
-    lasso_val = row[1]
-    if header in base_table_df:
-        # modify that column
-        target_df[header] = base_table_df[header]*lasso_val
-    if '*' in header:
-        # add a new column
-        col_a, col_b = header.split('*')
-        target_df[header] = (
-            base_table_df[col_a] * base_table_df[col_b] * row[1])
-
-# Add a "predicted" column
-predicted_col = []
-for _, row in target_df.iterrows():
-    predicted_col.append(sum(row[:]))
-
-target_df['predicted'] = predicted_col
-field = ogr.FieldDefn('predicted', ogr.OFTReal)
-layer.CreateField(field)
-header_pos['predicted'] = len(header_pos)
-
-layer.StartTransaction()
-print('generate point cloud')
-for row_index, row in base_table_df.iterrows():
-    positional_index = row['positional_index']
-    pos_x = positional_index % esa_n_cols
-    pos_y = positional_index // esa_n_cols
-    lng, lat = gdal.ApplyGeoTransform(esa_lulc_geotransform, pos_x, pos_y)
-    point_geom = ogr.Geometry(ogr.wkbPoint)
-    point_geom.AddPoint(lng, lat)
-
-    point_feature = ogr.Feature(layer_def)
-    point_feature.SetGeometry(point_geom)
-
-    for header, header_col in header_pos.items():
-        point_feature.SetField(
-            header, target_df.iloc[row_index, header_col])
-    layer.CreateFeature(point_feature)
-layer.CommitTransaction()
-
-print('writing')
-target_df.to_csv('result.csv', index=False)
+# lasso term of the y intercept, compared case insensitively
+INTERCEPT_TERM = 'intercept'
+# features written per vector transaction
+_TRANSACTION_SIZE = 2**16
+# coordinate columns of the scratch CSV ``write_point_vector`` converts
+_LNG_COLUMN = 'point_lng'
+_LAT_COLUMN = 'point_lat'
+
+
+def build_term_matrix(base_table_df, lasso_df):
+    """Evaluate each lasso term over every row of the base table.
+
+    A term is a column of the base table or a ``*`` separated product of
+    columns. The intercept row is skipped.
+
+    Args:
+        base_table_df (pandas.DataFrame): table of sample values.
+        lasso_df (pandas.DataFrame): lasso table of term name and
+            coefficient rows.
+
+    Returns:
+        (header_list, term_matrix, coefficient_array) where ``term_matrix``
+        is an (n_rows, n_terms) float64 array of the unweighted terms in
+        ``header_list`` order.
+
+    Raises:
+        ValueError if any term other than the intercept uses a column that
+        is not in the base table.
+
+    """
+    header_list = []
+    term_column_list = []
+    coefficient_list = []
+    unmatched_term_list = []
+    for header, coefficient in zip(lasso_df.iloc[:, 0], lasso_df.iloc[:, 1]):
+        if str(header).lower() == INTERCEPT_TERM:
+            continue
+        column_list = header.split('*')
+        if any(col not in base_table_df for col in column_list):
+            unmatched_term_list.append(header)
+            continue
+        header_list.append(header)
+        term_column_list.append(numpy.prod([
+            base_table_df[col].to_numpy(dtype=numpy.float64)
+            for col in column_list], axis=0))
+        coefficient_list.append(coefficient)
+    if unmatched_term_list:
+        raise ValueError(
+            'the base table has no columns for the lasso terms: '
+            f'{", ".join(map(str, unmatched_term_list))}')
+    if not header_list:
+        raise ValueError('the lasso table has no terms besides the intercept')
+    return (
+        header_list, numpy.column_stack(term_column_list),
+        numpy.array(coefficient_list, dtype=numpy.float64))
+
+
+def positional_index_to_lng_lat(positional_index, geotransform, n_cols):
+    """Convert flat pixel indexes to the lng/lat of their upper left corner.
+
+    Args:
+        positional_index (numpy.ndarray): ``row*n_cols+col`` pixel indexes.
+        geotransform (tuple): GDAL geotransform of the indexed raster.
+        n_cols (int): number of columns of the indexed raster.
+
+    Returns:
+        (lng_array, lat_array) tuple.
+
+    """
+    pos_y, pos_x = numpy.divmod(positional_index, n_cols)
+    lng_array = geotransform[0] + pos_x*geotransform[1] + pos_y*geotransform[2]
+    lat_array = geotransform[3] + pos_x*geotransform[4] + pos_y*geotransform[5]
+    return lng_array, lat_array
+
+
+def write_point_vector(
+        target_vector_path, layer_name, lng_array, lat_array, header_list,
+        value_matrix):
+    """Write a WGS84 point GeoPackage with one real field per column.
+
+    The coordinates and values are dumped to a scratch CSV in one
+    vectorized call and converted by ``gdal.VectorTranslate``, so no
+    feature is built in Python. Features are committed in transactions of
+    ``_TRANSACTION_SIZE``.
+
+    Args:
+        target_vector_path (str): path to the target GeoPackage.
+        layer_name (str): name of the point layer.
+        lng_array, lat_array (numpy.ndarray): point coordinates.
+        header_list (list): field names, one per column of
+            ``value_matrix``.
+        value_matrix (numpy.ndarray): (n_points, n_fields) field values.
+
+    Returns:
+        None
+
+    """
+    csv_file, csv_path = tempfile.mkstemp(
+        suffix='.csv', dir=os.path.dirname(os.path.abspath(
+            target_vector_path)))
+    os.close(csv_file)
+    csvt_path = f'{os.path.splitext(csv_path)[0]}.csvt'
+    try:
+        point_df = pandas.DataFrame(value_matrix, columns=header_list)
+        point_df.insert(0, _LAT_COLUMN, lat_array)
+        point_df.insert(0, _LNG_COLUMN, lng_array)
+        point_df.to_csv(csv_path, index=False)
+        # the .csvt sidecar makes the CSV driver read every column as real
+        with open(csvt_path, 'w') as csvt_file:
+            csvt_file.write(','.join(['Real'] * point_df.shape[1]))
+
+        csv_vector = gdal.OpenEx(
+            csv_path, gdal.OF_VECTOR, open_options=[
+                f'X_POSSIBLE_NAMES={_LNG_COLUMN}',
+                f'Y_POSSIBLE_NAMES={_LAT_COLUMN}',
+                'KEEP_GEOM_COLUMNS=NO'])
+        if os.path.exists(target_vector_path):
+            os.remove(target_vector_path)
+        translate_options = gdal.VectorTranslateOptions(
+            options=[
+                '-a_srs', 'EPSG:4326', '-nlt', 'POINT',
+                '-gt', str(_TRANSACTION_SIZE)],
+            format='GPKG', layerName=layer_name)
+        gdal.VectorTranslate(
+            target_vector_path, csv_vector, options=translate_options)
+        csv_vector = None
+    finally:
+        for path in [csv_path, csvt_path]:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+if __name__ == '__main__':
+    print('reading')
+    base_table_df = pandas.read_csv(base_table_path)
+    lasso_df = pandas.read_csv(lasso_table_path)
+
+    print('start lasso')
+    header_list, term_matrix, coefficient_array = build_term_matrix(
+        base_table_df, lasso_df)
+    predicted_array = term_matrix @ coefficient_array
+    # weight the term columns in place for the output table
+    term_matrix *= coefficient_array
+
+    header_list.append('predicted')
+    value_matrix = numpy.column_stack((term_matrix, predicted_array))
+    target_df = pandas.DataFrame(value_matrix, columns=header_list)
+
+    print('generate point cloud')
+    lng_array, lat_array = positional_index_to_lng_lat(
+        base_table_df['positional_index'].to_numpy(), esa_lulc_geotransform,
+        esa_n_cols)
+    base_id = os.path.basename(os.path.splitext(base_table_path)[0])
+    write_point_vector(
+        f'{base_id}.gpkg', base_id, lng_array, lat_array, header_list,
+        value_matrix)
+
+    print('writing')
+    target_df.to_csv('result.csv', index=False)
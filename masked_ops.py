@@ -0,0 +1,112 @@
+"""Masked elementwise raster ops and a threaded block runner for them.
+
+The ops allocate at most their result, do their arithmetic in place
+through ``out=``, ``where=`` or ``numpy.copyto`` and compare integer
+arrays to nodata exactly, only floating point arrays use
+``numpy.isclose``. ``block_op`` reads every input of a block in one shared
+pass and runs an op over the blocks of a raster stack in a thread pool.
+"""
+import concurrent.futures
+import multiprocessing
+
+from osgeo import gdal
+import numpy
+import pygeoprocessing
+
+import tiled_convolution
+
+
+def nodata_mask(array, nodata):
+    """Return a bool array that is True where ``array`` is nodata.
+
+    Integer arrays are compared exactly, floating point arrays with
+    ``numpy.isclose``. If ``nodata`` is None nothing is nodata.
+
+    """
+    if nodata is None:
+        return numpy.zeros(array.shape, dtype=bool)
+    if numpy.issubdtype(array.dtype, numpy.integer):
+        return array == nodata
+    return numpy.isclose(array, nodata)
+
+
+def mask_by_value_op(array, value, nodata):
+    """Return 1 where array==value, 0 otherwise and 2 on nodata."""
+    result = numpy.empty_like(array)
+    numpy.equal(array, value, out=result, casting='unsafe')
+    numpy.copyto(result, 2, where=nodata_mask(array, nodata))
+    return result
+
+
+def mask_by_inv_value_op(array, value, nodata):
+    """Return 0 where array==value, 1 otherwise and 2 on nodata."""
+    result = numpy.empty_like(array)
+    numpy.not_equal(array, value, out=result, casting='unsafe')
+    numpy.copyto(result, 2, where=nodata_mask(array, nodata))
+    return result
+
+
+def burn_op(dem_array, stream_array, dem_nodata, burn_depth):
+    """Lower ``dem_array`` in place by ``burn_depth`` where streams are 1."""
+    burn_mask = stream_array == 1
+    burn_mask &= ~nodata_mask(dem_array, dem_nodata)
+    numpy.subtract(
+        dem_array, burn_depth, out=dem_array, where=burn_mask,
+        casting='unsafe')
+    return dem_array
+
+
+def _block_op_tile(base_raster_path_band_list, op, op_args, offset_dict):
+    """Read one block of every base band and return ``op`` of them."""
+    array_list = []
+    for path, band_index in base_raster_path_band_list:
+        raster = gdal.OpenEx(path, gdal.OF_RASTER)
+        array_list.append(
+            raster.GetRasterBand(band_index).ReadAsArray(**offset_dict))
+        raster = None
+    return op(*array_list, *op_args)
+
+
+def block_op(
+        base_raster_path_band_list, op, op_args, target_raster_path,
+        target_datatype, target_nodata, n_threads=None):
+    """Run a masked elementwise op over a raster stack block by block.
+
+    Args:
+        base_raster_path_band_list (list): (path, band) tuples of rasters on
+            the same grid, the target is created from the first.
+        op (callable): called as ``op(*block_list, *op_args)`` with a fresh
+            array per base band, so it may work in place. Returns the target
+            block.
+        op_args (tuple): extra arguments passed to ``op`` after the blocks.
+        target_raster_path (str): path to the target raster.
+        target_datatype (int): GDAL datatype of the target.
+        target_nodata (float): nodata value of the target, may be None.
+        n_threads (int): number of blocks to process at once, defaults to
+            the number of CPUs.
+
+    Returns:
+        None
+
+    """
+    if n_threads is None:
+        n_threads = multiprocessing.cpu_count()
+    pygeoprocessing.new_raster_from_base(
+        base_raster_path_band_list[0][0], target_raster_path,
+        target_datatype, [target_nodata])
+    offset_list = list(pygeoprocessing.iterblocks(
+        base_raster_path_band_list[0], offset_only=True))
+
+    target_raster = gdal.OpenEx(
+        target_raster_path, gdal.OF_RASTER | gdal.OF_UPDATE)
+    target_band = target_raster.GetRasterBand(1)
+    with concurrent.futures.ThreadPoolExecutor(n_threads) as executor:
+        for offset_dict, target_block in tiled_convolution.iter_tile_results(
+                executor, _block_op_tile,
+                (base_raster_path_band_list, op, op_args), offset_list,
+                2*n_threads):
+            target_band.WriteArray(
+                target_block, xoff=offset_dict['xoff'],
+                yoff=offset_dict['yoff'])
+    target_band = None
+    target_raster = None
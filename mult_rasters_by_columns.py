@@ -1,5 +1,6 @@
 """Demo of how to use pandas to multiply one table by another."""
 import argparse
+import collections
 import logging
 import multiprocessing
 import os
@@ -11,6 +12,8 @@ import pygeoprocessing
 import numpy
 import taskgraph
 
+import masked_ops
+
 gdal.SetCacheMax(2**30)
 
 # treat this one column name as special for the y intercept
@@ -20,6 +23,9 @@ OPERATOR_FN = {
     '*': numpy.multiply,
     '^': numpy.power,
 }
+# opcodes of ``compile_rpn`` instructions that aren't operators
+_PUSH_RASTER = 0
+_PUSH_CONST = 1
 N_CPUS = multiprocessing.cpu_count()
 
 logging.basicConfig(
@@ -33,71 +39,313 @@ LOGGER = logging.getLogger(__name__)
 logging.getLogger('taskgraph').setLevel(logging.INFO)
 
 
+def parse_lasso_table(lasso_df):
+    """Parse the rows of a lasso table into a polynomial.
+
+    Args:
+        lasso_df (pandas.DataFrame): headerless table whose first column is
+            INTERCEPT_COLUMN_ID or a term like ``a*b^2`` and whose second
+            column is its coefficient.
+
+    Returns:
+        dict mapping each monomial, a sorted tuple of (raster_id, exponent)
+        pairs, to its coefficient. The intercept is under ``()``.
+
+    """
+    polynomial = collections.defaultdict(float)
+    for row_index, row in lasso_df.iterrows():
+        header = row[0]
+        if header == INTERCEPT_COLUMN_ID:
+            polynomial[()] += float(row[1])
+            continue
+        LOGGER.debug(f'{row_index}: {row}')
+        exponent_map = collections.Counter()
+        for product in header.split('*'):
+            # for each multiplcation term split out an exponent if exists
+            if '^' in product:
+                raster_id, exponent = product.split('^')
+                exponent_map[raster_id] += int(exponent)
+            else:
+                exponent_map[product] += 1
+        monomial = tuple(sorted(
+            (raster_id, exponent) for raster_id, exponent in
+            exponent_map.items() if exponent > 0))
+        polynomial[monomial] += float(row[1])
+    return dict(polynomial)
+
+
+def _horner_rpn(polynomial):
+    """RPN stack for a polynomial factored greedily Horner style.
+
+    The raster in the most monomials is factored out as
+    ``x*quotient + remainder`` and both parts are factored recursively, so
+    powers and products shared by terms are only multiplied once.
+
+    """
+    raster_count = collections.Counter(
+        raster_id for monomial in polynomial
+        for raster_id, _ in monomial)
+    if not raster_count:
+        return [polynomial.get((), 0.0)]
+    factor_id = max(
+        sorted(raster_count), key=lambda raster_id: raster_count[raster_id])
+
+    quotient = collections.defaultdict(float)
+    remainder = {}
+    for monomial, coefficient in polynomial.items():
+        exponent_map = dict(monomial)
+        if factor_id in exponent_map:
+            exponent_map[factor_id] -= 1
+            if exponent_map[factor_id] == 0:
+                del exponent_map[factor_id]
+            quotient[tuple(sorted(exponent_map.items()))] += coefficient
+        else:
+            remainder[monomial] = coefficient
+
+    if dict(quotient) == {(): 1.0}:
+        rpn_stack = [factor_id]
+    else:
+        rpn_stack = _horner_rpn(quotient) + [factor_id, '*']
+    if remainder:
+        rpn_stack += _horner_rpn(remainder) + ['+']
+    return rpn_stack
+
+
+def plan_polynomial(polynomial):
+    """Plan a minimal multiply-add RPN stack for a lasso polynomial.
+
+    Args:
+        polynomial (dict): result of ``parse_lasso_table``.
+
+    Returns:
+        (rpn_stack, term_flops, planned_flops) tuple. ``rpn_stack`` only
+        uses '+' and '*', ``term_flops`` is the multiplies and adds per
+        pixel to evaluate every term on its own and ``planned_flops`` those
+        of ``rpn_stack``.
+
+    """
+    # a coefficient times x^e*y^f... is sum(exponents) multiplies, plus an
+    # add to accumulate each term
+    term_flops = len(polynomial) - 1 + sum(
+        exponent for monomial in polynomial for _, exponent in monomial)
+    rpn_stack = _horner_rpn(polynomial)
+    planned_flops = sum(1 for val in rpn_stack if val in ('+', '*'))
+    return rpn_stack, term_flops, planned_flops
+
+
+def compile_rpn(rpn_stack, raster_id_list):
+    """Compile an RPN stack into a flat instruction tuple.
+
+    Symbols are resolved to their index in ``raster_id_list`` and operators
+    whose operands are both constants are folded, so the per block
+    evaluation does no lookups or constant arithmetic.
+
+    Args:
+        rpn_stack (list): symbols, numeric values or keys of OPERATOR_FN.
+        raster_id_list (list): symbols in the order their arrays are passed
+            to ``raster_rpn_calculator_op``.
+
+    Returns:
+        tuple of (opcode, operand) instructions where opcode is
+        ``_PUSH_RASTER`` with a raster index, ``_PUSH_CONST`` with a value
+        or an OPERATOR_FN key with None.
+
+    """
+    raster_index_map = {
+        raster_id: index for index, raster_id in enumerate(raster_id_list)}
+    program = []
+    # True for each stack entry that is a constant
+    const_stack = []
+    for val in rpn_stack:
+        if val in OPERATOR_FN:
+            b_const = const_stack.pop()
+            a_const = const_stack.pop()
+            if a_const and b_const:
+                # both operands are the last two pushes, fold them
+                operand_b = program.pop()[1]
+                operand_a = program.pop()[1]
+                program.append((
+                    _PUSH_CONST,
+                    OPERATOR_FN[val](operand_a, operand_b).item()))
+            else:
+                program.append((val, None))
+            const_stack.append(a_const and b_const)
+        elif isinstance(val, str):
+            program.append((_PUSH_RASTER, raster_index_map[val]))
+            const_stack.append(False)
+        else:
+            program.append((_PUSH_CONST, val))
+            const_stack.append(True)
+    if len(const_stack) != 1:
+        raise ValueError(
+            f'rpn stack leaves {len(const_stack)} values: {rpn_stack}')
+    return tuple(program)
+
+
+def evaluate_program(program, operand_list):
+    """Evaluate a ``compile_rpn`` program.
+
+    Intermediate arrays owned by the evaluation are reused as the output
+    of the next operator so at most a couple of temporaries are live.
+
+    Args:
+        program (tuple): result of ``compile_rpn``.
+        operand_list (list): array for each raster index, not modified.
+
+    Returns:
+        result of the program, an array or a scalar.
+
+    """
+    # (value, owned) where owned values can be overwritten
+    stack = []
+    for opcode, operand in program:
+        if opcode == _PUSH_RASTER:
+            stack.append((operand_list[operand], False))
+        elif opcode == _PUSH_CONST:
+            stack.append((operand, False))
+        else:
+            operand_b, b_owned = stack.pop()
+            operand_a, a_owned = stack.pop()
+            if a_owned:
+                out = operand_a
+            elif b_owned and opcode != '^':
+                out = operand_b
+            else:
+                out = None
+            stack.append((
+                OPERATOR_FN[opcode](operand_a, operand_b, out=out), True))
+    return stack.pop()[0]
+
+
 def raster_rpn_calculator_op(*args_list):
-    """Calculate RPN expression.
+    """Calculate a compiled RPN expression.
 
     Args:
-        args_list (list): a length list of N+4 long where:
+        args_list (list): a length list of N+3 long where:
             - the first N elements are array followed by nodata
             - the N+1th element is the target nodata
-            - the N+2nd  element is an RPN stack containing either
-              symbols, numeric values, or an operator in OPERATOR_SET.
-            - N+3rd value is a dict mapping the symbol to a dict with
-              "index" in it showing where index*2 location it is in the
-              args_list.
-            - N+4th value is "zero nodata" if true then missing nodata are
+            - the N+2nd element is a program from ``compile_rpn`` whose
+              raster indexes are the array order in ``args_list``.
+            - N+3rd value is "zero nodata" if true then missing nodata are
               treated as zeros unless the entire stack is nodata
 
     Returns:
         evaluation of the RPN calculation
     """
-    n = len(args_list)-4
+    n = len(args_list)-3
     result = numpy.empty(args_list[0].shape, dtype=numpy.float32)
     result[:] = args_list[n]  # target nodata
-    rpn_stack = list(args_list[n+1])
-    info_dict = args_list[n+2]
-    zero_nodata = args_list[n+3]
-    if zero_nodata:
-        valid_mask = numpy.zeros(args_list[0].shape, dtype=numpy.bool)
-    else:
-        valid_mask = numpy.ones(args_list[0].shape, dtype=numpy.bool)
+    program = args_list[n+1]
+    zero_nodata = args_list[n+2]
+
     # build up valid mask where all pixel stacks are defined
+    local_valid_mask_list = []
     for index in range(0, n, 2):
-        nodata_value = args_list[index+1]
-        if nodata_value is not None:
-            if zero_nodata:
-                local_valid_mask = ~numpy.isclose(
-                    args_list[index], args_list[index+1])
-                # set nodata to zero in antipation of having to use it
-                args_list[index][~local_valid_mask] = 0.0
-                valid_mask |= local_valid_mask
-                pass
-            else:
-                valid_mask &= \
-                    ~numpy.isclose(args_list[index], args_list[index+1])
+        local_valid_mask = ~masked_ops.nodata_mask(
+            args_list[index], args_list[index+1])
+        local_valid_mask_list.append(local_valid_mask)
+    if zero_nodata:
+        valid_mask = numpy.logical_or.reduce(local_valid_mask_list)
+    else:
+        valid_mask = numpy.logical_and.reduce(local_valid_mask_list)
+
+    # mask each raster once, nodata is zeroed in the copy
+    operand_list = []
+    for index, local_valid_mask in zip(
+            range(0, n, 2), local_valid_mask_list):
+        operand = args_list[index][valid_mask].astype(
+            numpy.float64, copy=False)
+        if zero_nodata:
+            operand[~local_valid_mask[valid_mask]] = 0.0
+        operand_list.append(operand)
+
+    result[valid_mask] = evaluate_program(program, operand_list)
+    return result
 
-    # process the rpn stack
-    accumulator_stack = []
-    while rpn_stack:
-        val = rpn_stack.pop(0)
-        if val in OPERATOR_FN:
-            operator = val
-            operand_b = accumulator_stack.pop()
-            operand_a = accumulator_stack.pop()
-            val = OPERATOR_FN[operator](operand_a, operand_b)
-            accumulator_stack.append(val)
-        else:
-            if isinstance(val, str):
-                accumulator_stack.append(
-                    args_list[2*info_dict[val]['index']][valid_mask])
-            else:
-                accumulator_stack.append(val)
 
-    result[valid_mask] = accumulator_stack.pop(0)
-    if accumulator_stack:
-        raise RuntimeError(
-            f'accumulator_stack not empty: {accumulator_stack}')
-    return result
+def matches_grid(raster_info, target_pixel_size, target_bounding_box):
+    """Return True if a raster is already on the target pixel grid.
+
+    The geotransform must match the grid's to within a thousandth of a
+    pixel and the raster must have the grid's number of rows and columns,
+    so a raster shifted by any whole pixel is still warped.
+
+    Args:
+        raster_info (dict): has the raster's 'geotransform' and
+            'raster_size' as from ``pygeoprocessing.get_raster_info``.
+        target_pixel_size (tuple): target (x, y) pixel size.
+        target_bounding_box (list): target [minx, miny, maxx, maxy].
+
+    Returns:
+        True if the raster can be read in place of a warp to the grid.
+
+    """
+    target_geotransform = (
+        target_bounding_box[0], target_pixel_size[0], 0.0,
+        target_bounding_box[3], 0.0, target_pixel_size[1])
+    target_raster_size = (
+        int(round(abs(
+            (target_bounding_box[2] - target_bounding_box[0]) /
+            target_pixel_size[0]))),
+        int(round(abs(
+            (target_bounding_box[3] - target_bounding_box[1]) /
+            target_pixel_size[1]))))
+    pixel_tolerance = 1e-3 * min(
+        abs(target_pixel_size[0]), abs(target_pixel_size[1]))
+    return (
+        tuple(raster_info['raster_size']) == target_raster_size and
+        numpy.allclose(
+            raster_info['geotransform'], target_geotransform, rtol=0,
+            atol=pixel_tolerance))
+
+
+def add_align_tasks(
+        task_graph, raster_id_to_info_map, target_pixel_size,
+        target_bounding_box, align_dir, working_dir):
+    """Add a cached warp task for each raster not on the target grid.
+
+    Sets 'aligned_path' in each raster's info dict, that's the raster
+    itself if it already matches the grid and is read in place.
+
+    Args:
+        task_graph (taskgraph.TaskGraph): graph to add warps to, its worker
+            count bounds the number of concurrent warps.
+        raster_id_to_info_map (dict): maps raster id to a dict with 'path',
+            'geotransform' and 'raster_size'.
+        target_pixel_size (tuple): target (x, y) pixel size.
+        target_bounding_box (list): target [minx, miny, maxx, maxy].
+        align_dir (str): directory for the aligned rasters.
+        working_dir (str): scratch directory for the warps.
+
+    Returns:
+        list of the added tasks.
+
+    """
+    align_task_list = []
+    for raster_id, raster_info in raster_id_to_info_map.items():
+        raster_path = raster_info['path']
+        if matches_grid(raster_info, target_pixel_size, target_bounding_box):
+            LOGGER.info(f'{raster_id} is on the target grid, not warping')
+            raster_info['aligned_path'] = raster_path
+            continue
+        raster_basename = os.path.splitext(os.path.basename(raster_path))[0]
+        aligned_raster_path = os.path.join(
+            align_dir,
+            f'{raster_basename}_{target_bounding_box}_{target_pixel_size}.tif')
+        raster_info['aligned_path'] = aligned_raster_path
+        align_task_list.append(task_graph.add_task(
+            func=pygeoprocessing.warp_raster,
+            args=(
+                raster_path, target_pixel_size, aligned_raster_path,
+                'near'),
+            kwargs={
+                'target_bb': target_bounding_box,
+                'working_dir': working_dir
+            },
+            target_path_list=[aligned_raster_path],
+            task_name=f'warp {raster_id}'))
+    return align_task_list
+
 
 if __name__ == '__main__':
 
@@ -130,6 +378,9 @@ if __name__ == '__main__':
     parser.add_argument(
         '--target_nodata', type=float, default=numpy.finfo('float32').min,
         help='desired target nodata value')
+    parser.add_argument(
+        '--n_io_workers', type=int, default=min(N_CPUS, 4),
+        help='maximum number of rasters to warp at once')
 
     args = parser.parse_args()
 
@@ -137,45 +388,15 @@ if __name__ == '__main__':
     lasso_table_path = args.lasso_table_path
     lasso_df = pandas.read_csv(lasso_table_path, header=None)
 
-    # built a reverse polish notation stack for the operations and their order
-    # that they need to be executed in
-    rpn_stack = []
-    first_term = True
-    for row_index, row in lasso_df.iterrows():
-        header = row[0]
-        if header == INTERCEPT_COLUMN_ID:
-            # special case of the intercept, just push it
-            rpn_stack.append(float(row[1]))
-        else:
-            # it's an expression/coefficient row
-            LOGGER.debug(f'{row_index}: {row}')
-            coefficient = float(row[1])
-            # put on the coefficient first since it's there, we'll multiply
-            # it later
-            rpn_stack.append(coefficient)
-
-            # split out all the multiplcation terms
-            product_list = header.split('*')
-            for product in product_list:
-                # for each multiplcation term split out an exponent if exists
-                if '^' in product:
-                    rpn_stack.extend(product.split('^'))
-                    # cast the exponent to an integer so can operate directly
-                    rpn_stack[-1] = int(rpn_stack[-1])
-                    # push the ^ to exponentiate the last two operations
-                    rpn_stack.append('^')
-                else:
-                    # otherwise it's a single value
-                    rpn_stack.append(product)
-                # multiply this term and the last
-                rpn_stack.append('*')
-
-        # if it's not the first term we want to add the rest
-        if first_term:
-            first_term = False
-        else:
-            rpn_stack.append('+')
+    polynomial = parse_lasso_table(lasso_df)
 
+    # factor the terms into a reverse polish notation stack that shares
+    # powers and partial products between terms
+    rpn_stack, term_flops, planned_flops = plan_polynomial(polynomial)
+    LOGGER.info(
+        f'{len(polynomial)} terms take {planned_flops} flops per pixel '
+        f'factored vs {term_flops} term by term '
+        f'({100*(1-planned_flops/max(term_flops, 1)):.1f}% fewer)')
     LOGGER.debug(rpn_stack)
 
     # find the unique symbols in the expression
@@ -201,6 +422,8 @@ if __name__ == '__main__':
                 'path': raster_path,
                 'nodata': raster_info['nodata'][0],
                 'index': index,
+                'geotransform': raster_info['geotransform'],
+                'raster_size': raster_info['raster_size'],
             }
             min_size = min(
                 min_size, abs(raster_info['pixel_size'][0]))
@@ -232,32 +455,18 @@ if __name__ == '__main__':
     LOGGER.info(f'target bounding box: {target_bounding_box}')
 
     LOGGER.debug('align rasters, this might take a while')
-    task_graph = taskgraph.TaskGraph(args.workspace_dir, N_CPUS, 5.0)
+    # warps are mostly I/O so their concurrency is bounded separately
+    task_graph = taskgraph.TaskGraph(
+        args.workspace_dir, args.n_io_workers, 5.0)
     align_dir = os.path.join(args.workspace_dir, 'aligned_rasters')
     try:
         os.makedirs(align_dir)
     except OSError:
         pass
 
-    # align rasters and cast to list because we'll rewrite
-    # raster_id_to_path_map object
-    for raster_id in raster_id_to_info_map:
-        raster_path = raster_id_to_info_map[raster_id]['path']
-        raster_basename = os.path.splitext(os.path.basename(raster_path))[0]
-        aligned_raster_path = os.path.join(
-            align_dir,
-            f'{raster_basename}_{target_bounding_box}_{target_pixel_size}.tif')
-        raster_id_to_info_map[raster_id]['aligned_path'] = \
-            aligned_raster_path
-        task_graph.add_task(
-            func=pygeoprocessing.warp_raster,
-            args=(
-                raster_path, target_pixel_size, aligned_raster_path,
-                'near'),
-            kwargs={
-                'target_bb': target_bounding_box,
-                'working_dir': args.workspace_dir
-            })
+    add_align_tasks(
+        task_graph, raster_id_to_info_map, target_pixel_size,
+        target_bounding_box, align_dir, args.workspace_dir)
 
     LOGGER.info('construct raster calculator raster path band list')
     raster_path_band_list = []
@@ -271,11 +480,11 @@ if __name__ == '__main__':
         if index != raster_id_to_info_map[raster_id]['index']:
             raise RuntimeError(f"indexes dont match: {index} {raster_id} {raster_id_to_info_map}")
 
+    program = compile_rpn(rpn_stack, raster_id_list)
     raster_path_band_list.append((args.target_nodata, 'raw'))
-    raster_path_band_list.append((rpn_stack, 'raw'))
-    raster_path_band_list.append((raster_id_to_info_map, 'raw'))
+    raster_path_band_list.append((program, 'raw'))
     raster_path_band_list.append((args.zero_nodata, 'raw'))
-    LOGGER.debug(rpn_stack)
+    LOGGER.debug(program)
 
     # wait for rasters to align
     task_graph.close()
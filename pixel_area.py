@@ -0,0 +1,132 @@
+"""Per row pixel area and length columns for WGS84 rasters.
+
+Every pixel in a row of a lat/lng raster has the same area, so these
+return a (n_rows, 1) column that broadcasts against any block of the
+raster. Columns are memoized on (geotransform, n_rows) and returned
+read-only so callers can share them freely.
+"""
+import functools
+
+import numpy
+
+# WGS84 ellipsoid
+_SEMI_MAJOR_AXIS = 6378137  # meters
+_SEMI_MINOR_AXIS = 6356752.3142  # meters
+_ECCENTRICITY = numpy.sqrt(1 - (_SEMI_MINOR_AXIS/_SEMI_MAJOR_AXIS)**2)
+
+
+def _area_to_equator(lat):
+    """Area in m^2 of the ellipsoid between the equator and ``lat``, per 360
+    degrees of longitude.
+
+    Adapted from: https://gis.stackexchange.com/a/127327/2397
+
+    """
+    sin_lat = numpy.sin(numpy.radians(lat))
+    zm = 1 - _ECCENTRICITY*sin_lat
+    zp = 1 + _ECCENTRICITY*sin_lat
+    return numpy.pi * _SEMI_MINOR_AXIS**2 * (
+        numpy.log(zp/zm) / (2*_ECCENTRICITY) + sin_lat / (zp*zm))
+
+
+def area_of_pixel(pixel_size, center_lat):
+    """Calculate m^2 area of a wgs84 square pixel.
+
+    Args:
+        pixel_size (float): length of side of pixel in degrees.
+        center_lat (float or numpy.ndarray): latitude of the center of the
+            pixel. Note this value +/- half the `pixel-size` must not
+            exceed 90/-90 degrees latitude or an invalid area will be
+            calculated.
+
+    Returns:
+        Area of square pixel of side length `pixel_size` centered at
+        `center_lat` in m^2, an array if `center_lat` is an array.
+
+    """
+    return numpy.abs(pixel_size / 360. * (
+        _area_to_equator(numpy.asarray(center_lat) + pixel_size/2) -
+        _area_to_equator(numpy.asarray(center_lat) - pixel_size/2)))
+
+
+def area_column(geotransform, n_rows):
+    """Return the m^2 area of a pixel in each row of a WGS84 raster.
+
+    Args:
+        geotransform (list): GDAL geotransform of the raster, its rows must
+            not be rotated.
+        n_rows (int): number of rows in the raster.
+
+    Returns:
+        read-only (n_rows, 1) float64 numpy array.
+
+    """
+    return _area_column(tuple(geotransform), int(n_rows))
+
+
+@functools.lru_cache(maxsize=32)
+def _area_column(geotransform, n_rows):
+    """Memoized body of ``area_column``, ``geotransform`` is a tuple."""
+    # evaluate at the n_rows+1 row edges once then difference neighbors
+    edge_lat = geotransform[3] + geotransform[5] * numpy.arange(n_rows+1)
+    edge_area = _area_to_equator(edge_lat)
+    column = numpy.abs(
+        geotransform[1] / 360. * (edge_area[:-1] - edge_area[1:]))[:, None]
+    column.setflags(write=False)
+    return column
+
+
+def degrees_per_meter_column(geotransform, n_rows):
+    """Return the average degrees per meter at each row of a WGS84 raster.
+
+    This is the reciprocal of the geometric mean of the lengths of a degree
+    of latitude and a degree of longitude at each row's center latitude.
+
+    Args:
+        geotransform (list): GDAL geotransform of the raster.
+        n_rows (int): number of rows in the raster.
+
+    Returns:
+        read-only (n_rows, 1) float64 numpy array.
+
+    """
+    return _degrees_per_meter_column(tuple(geotransform), int(n_rows))
+
+
+@functools.lru_cache(maxsize=32)
+def _degrees_per_meter_column(geotransform, n_rows):
+    """Memoized body of ``degrees_per_meter_column``."""
+    center_lat = geotransform[3] + geotransform[5] * (
+        numpy.arange(n_rows) + 0.5)
+    lat_len, lng_len = length_of_degree(center_lat)
+    column = (1. / numpy.sqrt(lat_len*numpy.abs(lng_len)))[:, None]
+    column.setflags(write=False)
+    return column
+
+
+def length_of_degree(lat):
+    """Calculate the lengths in meters of a degree of lat and lng at ``lat``.
+
+    Args:
+        lat (float or numpy.ndarray): latitude in degrees.
+
+    Returns:
+        (lat_len, lng_len) tuple of meters per degree, arrays if ``lat`` is
+        an array.
+
+    """
+    m1 = 111132.92
+    m2 = -559.82
+    m3 = 1.175
+    m4 = -0.0023
+    p1 = 111412.84
+    p2 = -93.5
+    p3 = 0.118
+    lat_rad = numpy.radians(lat)
+    lat_len = (
+        m1 + m2*numpy.cos(2*lat_rad) + m3*numpy.cos(4*lat_rad) +
+        m4*numpy.cos(6*lat_rad))
+    lng_len = (
+        p1*numpy.cos(lat_rad) + p2*numpy.cos(3*lat_rad) +
+        p3*numpy.cos(5*lat_rad))
+    return lat_len, lng_len
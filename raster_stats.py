@@ -7,7 +7,7 @@ Show real and degree area.
 import argparse
 import collections
 import logging
-import math
+import multiprocessing
 import os
 
 from osgeo import gdal
@@ -15,6 +15,9 @@ from osgeo import osr
 from ecoshard.geoprocessing import get_raster_info
 from ecoshard.geoprocessing import iterblocks
 import numpy
+
+import pixel_area
+
 gdal.SetCacheMax(2**27)
 
 logging.basicConfig(
@@ -26,47 +29,96 @@ LOGGER = logging.getLogger(__name__)
 logging.getLogger('taskgraph').setLevel(logging.WARN)
 
 
-def _area_of_pixel(pixel_size, center_lat):
-    """Calculate m^2 area of a wgs84 square pixel.
+# widest integer value range indexed directly rather than through unique
+_MAX_DIRECT_INDEX_RANGE = 2**16
+
 
-    Adapted from: https://gis.stackexchange.com/a/127327/2397
+def _block_value_index(block_data):
+    """Map each pixel in ``block_data`` to an index into its value list.
 
     Args:
-        pixel_size (float): length of side of pixel in degrees.
-        center_lat (float): latitude of the center of the pixel. Note this
-            value +/- half the `pixel-size` must not exceed 90/-90 degrees
-            latitude or an invalid area will be calculated.
+        block_data (numpy.ndarray): raster block.
 
     Returns:
-        Area of square pixel of side length `pixel_size` centered at
-        `center_lat` in m^2.
+        (value_array, index_array) where ``value_array[index_array]`` is
+        ``block_data`` flattened. Integer blocks with a narrow range are
+        offset directly instead of sorted so ``value_array`` may hold
+        values that do not occur in the block.
 
     """
-    a = 6378137  # meters
-    b = 6356752.3142  # meters
-    e = math.sqrt(1 - (b/a)**2)
-    area_list = []
-    for f in [center_lat+pixel_size/2, center_lat-pixel_size/2]:
-        zm = 1 - e*math.sin(math.radians(f))
-        zp = 1 + e*math.sin(math.radians(f))
-        area_list.append(
-            math.pi * b**2 * (
-                math.log(zp/zm) / (2*e) +
-                math.sin(math.radians(f)) / (zp*zm)))
-    return abs(pixel_size / 360. * (area_list[0] - area_list[1]))
+    flat_data = block_data.ravel()
+    if numpy.issubdtype(flat_data.dtype, numpy.integer) and flat_data.size:
+        min_val = int(flat_data.min())
+        max_val = int(flat_data.max())
+        if max_val - min_val < _MAX_DIRECT_INDEX_RANGE:
+            return (
+                numpy.arange(min_val, max_val+1, dtype=flat_data.dtype),
+                (flat_data.astype(numpy.int64) - min_val))
+    value_array, index_array = numpy.unique(flat_data, return_inverse=True)
+    return value_array, index_array.ravel()
+
+
+def _value_stats(raster_path, offset_list, geotransform, n_rows):
+    """Count pixels and sum real area per pixel value over some blocks.
+
+    Args:
+        raster_path (str): path to a single band raster.
+        offset_list (list): ``iterblocks`` offset dicts to process.
+        geotransform (list): raster geotransform if real area should be
+            summed with ``pixel_area.area_column``, otherwise None.
+        n_rows (int): number of rows in the raster.
+
+    Returns:
+        (pixel_stat_dict, area_stat_dict) mapping value to pixel count and
+        value to m^2 area, the latter empty if ``geotransform`` is None.
+
+    """
+    if geotransform is not None:
+        area_column = pixel_area.area_column(geotransform, n_rows)
+    pixel_stat_dict = collections.defaultdict(int)
+    area_stat_dict = collections.defaultdict(float)
+    raster = gdal.OpenEx(raster_path, gdal.OF_RASTER)
+    band = raster.GetRasterBand(1)
+    for offset_info in offset_list:
+        block_data = band.ReadAsArray(**offset_info)
+        value_array, index_array = _block_value_index(block_data)
+        count_array = numpy.bincount(index_array, minlength=len(value_array))
+        present = count_array > 0
+        for val, count in zip(
+                value_array[present], count_array[present]):
+            pixel_stat_dict[val] += int(count)
+
+        if geotransform is not None:
+            # area weights are constant along each row of the block
+            weight_array = numpy.broadcast_to(
+                area_column[
+                    offset_info['yoff']:
+                    offset_info['yoff']+offset_info['win_ysize']],
+                block_data.shape).ravel()
+            area_array = numpy.bincount(
+                index_array, weights=weight_array,
+                minlength=len(value_array))
+            for val, area in zip(value_array[present], area_array[present]):
+                area_stat_dict[val] += area
+    band = None
+    raster = None
+    return pixel_stat_dict, area_stat_dict
 
 
 def main():
     """Entry point."""
     parser = argparse.ArgumentParser(description='Calculate raster stats.')
     parser.add_argument('raster_path', help='path to raster')
+    parser.add_argument(
+        '--n_workers', type=int, default=multiprocessing.cpu_count(),
+        help='number of processes to split the raster blocks over')
     args = parser.parse_args()
 
     raster_info = get_raster_info(args.raster_path)
     raster_srs = osr.SpatialReference()
     raster_srs.ImportFromWkt(raster_info['projection_wkt'])
     LOGGER.debug(f'projected: {raster_srs.IsProjected()}')
-    pixel_area = abs(numpy.prod(raster_info['pixel_size']))
+    raster_pixel_area = abs(numpy.prod(raster_info['pixel_size']))
     target_csv_path = \
         f'{os.path.basename(os.path.splitext(args.raster_path)[0])}.csv'
 
@@ -76,40 +128,36 @@ def main():
             csv_file.write(',area m^2')
         csv_file.write('\n')
 
+    geotransform = None
+    if not raster_srs.IsProjected():
+        geotransform = raster_info['geotransform']
+    n_rows = raster_info['raster_size'][1]
+
+    # interleave blocks across workers so each gets a similar share
+    offset_list = list(iterblocks((args.raster_path, 1), offset_only=True))
+    n_chunks = max(1, min(args.n_workers, len(offset_list)))
+    job_list = [
+        (args.raster_path, offset_list[index::n_chunks], geotransform,
+         n_rows) for index in range(n_chunks)]
+    if n_chunks == 1:
+        partial_list = [_value_stats(*job_list[0])]
+    else:
+        with multiprocessing.Pool(n_chunks) as worker_pool:
+            partial_list = worker_pool.starmap(_value_stats, job_list)
+
     pixel_stat_dict = collections.defaultdict(int)
     area_stat_dict = collections.defaultdict(float)
-
-    for offset_info, block_data in iterblocks((args.raster_path, 1)):
-        unique_vals, frequency = numpy.unique(block_data, return_counts=True)
-        for val, count in zip(unique_vals, frequency):
+    for partial_pixel_dict, partial_area_dict in partial_list:
+        for val, count in partial_pixel_dict.items():
             pixel_stat_dict[val] += count
-
-        if not raster_srs.IsProjected():
-            n_rows = offset_info['win_ysize']
-            pixel_height = abs(raster_info['geotransform'][5])
-            # the / 2 is to get in the center of the pixel
-            _, y_origin = gdal.ApplyGeoTransform(
-                raster_info['geotransform'], 0, offset_info['yoff'])
-            _, y_bot = gdal.ApplyGeoTransform(
-                raster_info['geotransform'], 0,
-                offset_info['yoff']+offset_info['win_ysize'])
-
-            miny = y_origin + pixel_height/2
-            maxy = y_bot + pixel_height/2
-            lat_vals = numpy.linspace(maxy, miny, n_rows)
-            deg_area_vals = numpy.expand_dims(numpy.array(
-                [_area_of_pixel(pixel_height, val) for val in lat_vals]),
-                axis=1)
-
-            for val in unique_vals:
-                area_stat_dict[val] += numpy.sum(
-                    (block_data == val) * deg_area_vals)
+        for val, area in partial_area_dict.items():
+            area_stat_dict[val] += area
 
     with open(target_csv_path, 'a') as csv_file:
         for val in sorted(pixel_stat_dict):
             csv_file.write(
                 f'{val},{pixel_stat_dict[val]},'
-                f'{pixel_area*pixel_stat_dict[val]}')
+                f'{raster_pixel_area*pixel_stat_dict[val]}')
             if not raster_srs.IsProjected():
                 csv_file.write(f',{area_stat_dict[val]}')
             csv_file.write('\n')
@@ -0,0 +1,549 @@
+"""Exact out-of-core percentiles of raster pixel values.
+
+Valid pixels are sorted a block at a time and written to disk as raw
+"runs" with ``numpy.ndarray.tofile``. Runs are read back through
+``numpy.memmap`` and ranks are found by counting how many values in each
+run fall below a pivot, so the runs never need to be fully merged. An
+optional histogram pre-pass restricts the runs to the value buckets that
+actually contain the requested ranks.
+
+Integer rasters whose value range is small enough skip sorting entirely
+and are summarized from an exact per-value ``numpy.bincount`` histogram.
+"""
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy
+import pygeoprocessing
+
+LOGGER = logging.getLogger(__name__)
+
+_BLOCK_SIZE = 2**20
+# once the candidate windows across all runs hold this many values they
+# are pulled into memory and resolved with ``numpy.partition``
+_SELECT_CHUNK_SIZE = 2**22
+# most runs that are merged at once, this bounds the number of open memmaps
+_MAX_MERGE_FAN_IN = 256
+# widest value range an integer raster can span and still be summarized
+# from an exact histogram, 2**24 int64 bins is 128MB
+_MAX_HISTOGRAM_BINS = 2**24
+
+
+def valid_mask(array, nodata):
+    """Return a boolean mask of the non-nodata, finite elements of ``array``.
+
+    Parameters:
+        array (numpy.ndarray): block of raster values.
+        nodata (numeric): raster nodata value, may be None.
+
+    Returns:
+        boolean array the same shape as ``array``.
+
+    """
+    if numpy.issubdtype(array.dtype, numpy.floating):
+        mask = numpy.isfinite(array)
+        if nodata is not None:
+            mask &= ~numpy.isclose(array, nodata)
+    elif nodata is not None:
+        mask = array != nodata
+    else:
+        mask = numpy.ones(array.shape, dtype=bool)
+    return mask
+
+
+def iter_valid_values(raster_path_band, largest_block=_BLOCK_SIZE):
+    """Yield 1D arrays of the valid pixels of each block in the raster.
+
+    Parameters:
+        raster_path_band (tuple): (path, band index) of the raster.
+        largest_block (int): largest number of pixels to read at once.
+
+    Yields:
+        1D numpy.ndarray of the block's valid values, in the raster's type.
+
+    """
+    nodata = pygeoprocessing.get_raster_info(
+        raster_path_band[0])['nodata'][raster_path_band[1]-1]
+    for _, block in pygeoprocessing.iterblocks(
+            raster_path_band, largest_block=largest_block):
+        yield block[valid_mask(block, nodata)]
+
+
+def percentile_to_rank(percentile, total_valid):
+    """Convert a percentile to a 0 based rank among ``total_valid`` values."""
+    return min(int(percentile / 100.0 * total_valid), total_valid - 1)
+
+
+def bucket_index(values, bucket_edges):
+    """Return the histogram bucket index of each element of ``values``.
+
+    Values below the first edge go in the first bucket and values at or
+    above the last edge go in the last one, so every value is assigned.
+
+    """
+    return numpy.clip(
+        numpy.searchsorted(bucket_edges, values, side='right') - 1,
+        0, len(bucket_edges) - 2)
+
+
+def locate_rank_buckets(raster_path_band, rank_list, bucket_edges):
+    """Find the histogram bucket each rank falls in.
+
+    Parameters:
+        raster_path_band (tuple): (path, band index) of the raster.
+        rank_list (list): 0 based ranks among the valid pixels.
+        bucket_edges (numpy.ndarray): increasing bucket boundaries.
+
+    Returns:
+        list of (bucket index, rank within that bucket) tuples in the same
+        order as ``rank_list``.
+
+    """
+    n_buckets = len(bucket_edges) - 1
+    bucket_counts = numpy.zeros(n_buckets, dtype=numpy.int64)
+    for valid_values in iter_valid_values(raster_path_band):
+        bucket_counts += numpy.bincount(
+            bucket_index(valid_values, bucket_edges), minlength=n_buckets)
+    cumulative_counts = numpy.cumsum(bucket_counts)
+    rank_bucket_list = []
+    for rank in rank_list:
+        bucket = int(numpy.searchsorted(cumulative_counts, rank, side='right'))
+        rank_bucket_list.append((
+            bucket,
+            int(rank - (cumulative_counts[bucket] - bucket_counts[bucket]))))
+    return rank_bucket_list
+
+
+def sort_to_disk(
+        raster_path_band, work_dir, bucket_edges=None, bucket_list=None):
+    """Write the valid pixels of each block to disk as sorted runs.
+
+    Parameters:
+        raster_path_band (tuple): (path, band index) of the raster.
+        work_dir (str): directory to write run files to.
+        bucket_edges (numpy.ndarray): if not None, histogram boundaries
+            used to split values into buckets, see ``bucket_index``.
+        bucket_list (list): if ``bucket_edges`` is given, only values in
+            these buckets are written.
+
+    Returns:
+        dict mapping bucket index to a list of run file paths. If no
+        buckets are given every value is stored under bucket 0. Run files
+        hold raw values in the raster's numpy type.
+
+    """
+    if bucket_edges is None:
+        bucket_list = [0]
+    run_path_map = {bucket: [] for bucket in bucket_list}
+    for block_index, valid_values in enumerate(
+            iter_valid_values(raster_path_band)):
+        _write_runs(
+            valid_values, block_index, work_dir, run_path_map, bucket_edges)
+    return run_path_map
+
+
+def _write_runs(
+        valid_values, block_index, work_dir, run_path_map, bucket_edges):
+    """Sort ``valid_values`` into a run file per bucket in ``run_path_map``.
+
+    New run paths are appended to the lists in ``run_path_map``, whose keys
+    are the buckets to keep. If ``bucket_edges`` is None every value goes
+    to bucket 0.
+
+    """
+    if bucket_edges is None:
+        bucket_values_list = [(0, valid_values)]
+    else:
+        value_buckets = bucket_index(valid_values, bucket_edges)
+        bucket_values_list = [
+            (bucket, valid_values[value_buckets == bucket])
+            for bucket in run_path_map]
+    for bucket, values in bucket_values_list:
+        if values.size == 0:
+            continue
+        values.sort()
+        run_path = os.path.join(work_dir, f'run_{bucket}_{block_index}.bin')
+        values.tofile(run_path)
+        run_path_map[bucket].append(run_path)
+
+
+def merge_sorted_runs(run_path_list, dtype, target_path, chunk_size=None):
+    """K-way merge sorted runs into a single sorted run file.
+
+    Each step reads a window from every run and emits every value at or
+    below the smallest window tail of the runs that still have data left,
+    since nothing still on disk can sort before it.
+
+    Parameters:
+        run_path_list (list): paths to sorted raw run files.
+        dtype (numpy.dtype): type of the values in the run files.
+        target_path (str): path to the merged run file to create.
+        chunk_size (int): total number of values to hold in memory across
+            all run windows. Defaults to ``_SELECT_CHUNK_SIZE``.
+
+    Returns:
+        None
+
+    """
+    if chunk_size is None:
+        chunk_size = _SELECT_CHUNK_SIZE
+    run_list = [
+        numpy.memmap(run_path, dtype=dtype, mode='r')
+        for run_path in run_path_list]
+    window_size = max(1, chunk_size // max(1, len(run_list)))
+    offset_list = [0] * len(run_list)
+    with open(target_path, 'wb') as target_file:
+        while True:
+            active_list = [
+                index for index, run in enumerate(run_list)
+                if offset_list[index] < run.size]
+            if not active_list:
+                break
+            window_list = [
+                run_list[index][
+                    offset_list[index]:offset_list[index]+window_size]
+                for index in active_list]
+            tail_list = [
+                window[-1] for index, window in zip(active_list, window_list)
+                if offset_list[index] + window.size < run_list[index].size]
+            if tail_list:
+                bound = min(tail_list)
+                take_list = [
+                    int(numpy.searchsorted(window, bound, side='right'))
+                    for window in window_list]
+            else:
+                take_list = [window.size for window in window_list]
+            merged = numpy.concatenate([
+                window[:take] for window, take in zip(
+                    window_list, take_list)])
+            # stable sort detects the already sorted sub runs
+            merged.sort(kind='stable')
+            merged.tofile(target_file)
+            for index, take in zip(active_list, take_list):
+                offset_list[index] += take
+    del run_list
+
+
+def reduce_run_fan_in(run_path_list, dtype, work_dir):
+    """Merge runs in groups until at most ``_MAX_MERGE_FAN_IN`` remain.
+
+    Parameters:
+        run_path_list (list): paths to sorted raw run files, these files
+            are removed once they are merged.
+        dtype (numpy.dtype): type of the values in the run files.
+        work_dir (str): directory to write merged runs to.
+
+    Returns:
+        list of run file paths covering the same values.
+
+    """
+    merge_pass = 0
+    while len(run_path_list) > _MAX_MERGE_FAN_IN:
+        LOGGER.debug(
+            f'merging {len(run_path_list)} runs, pass {merge_pass}')
+        merged_path_list = []
+        for group_index, group_start in enumerate(range(
+                0, len(run_path_list), _MAX_MERGE_FAN_IN)):
+            group_path_list = run_path_list[
+                group_start:group_start+_MAX_MERGE_FAN_IN]
+            merged_path = os.path.join(
+                work_dir, f'merged_{merge_pass}_{group_index}.bin')
+            merge_sorted_runs(group_path_list, dtype, merged_path)
+            for run_path in group_path_list:
+                os.remove(run_path)
+            merged_path_list.append(merged_path)
+        run_path_list = merged_path_list
+        merge_pass += 1
+    return run_path_list
+
+
+def select_ranks(run_path_list, dtype, rank_list):
+    """Find exact values at the given ranks across a set of sorted runs.
+
+    Parameters:
+        run_path_list (list): paths to sorted raw run files.
+        dtype (numpy.dtype): type of the values in the run files.
+        rank_list (list): 0 based ranks among all values in the runs.
+
+    Returns:
+        list of values in the same order as ``rank_list``.
+
+    """
+    run_list = [
+        numpy.memmap(run_path, dtype=dtype, mode='r')
+        for run_path in run_path_list]
+    value_list = [_select_rank(run_list, rank) for rank in rank_list]
+    del run_list
+    return value_list
+
+
+def _select_rank(run_list, rank):
+    """Return the value of 0 based ``rank`` across the sorted ``run_list``.
+
+    Keeps a [lo, hi) window per run that must contain the answer. Each
+    step pivots on the middle of the largest window and counts values
+    less than and equal to it in every window with ``searchsorted``, which
+    at least halves the largest window.
+
+    """
+    lo_array = numpy.zeros(len(run_list), dtype=numpy.int64)
+    hi_array = numpy.array([run.size for run in run_list], dtype=numpy.int64)
+    while True:
+        remaining_array = hi_array - lo_array
+        if remaining_array.sum() <= _SELECT_CHUNK_SIZE:
+            window = numpy.concatenate([
+                run[lo:hi] for run, lo, hi in zip(
+                    run_list, lo_array, hi_array) if hi > lo])
+            return numpy.partition(window, rank)[rank].item()
+        pivot_index = int(numpy.argmax(remaining_array))
+        pivot = run_list[pivot_index][
+            (lo_array[pivot_index] + hi_array[pivot_index]) // 2]
+        less_array = numpy.array([
+            lo + numpy.searchsorted(run[lo:hi], pivot, side='left')
+            for run, lo, hi in zip(run_list, lo_array, hi_array)])
+        less_equal_array = numpy.array([
+            lo + numpy.searchsorted(run[lo:hi], pivot, side='right')
+            for run, lo, hi in zip(run_list, lo_array, hi_array)])
+        n_less = int((less_array - lo_array).sum())
+        n_less_equal = int((less_equal_array - lo_array).sum())
+        if rank < n_less:
+            hi_array = less_array
+        elif rank < n_less_equal:
+            return pivot.item()
+        else:
+            rank -= n_less_equal
+            lo_array = less_equal_array
+
+
+def summarize_values(values):
+    """Return the (count, min, max, mean, M2) summary of a 1D array.
+
+    M2 is the sum of squared differences from the mean so summaries of
+    separate blocks can be combined with ``merge_summaries``.
+
+    """
+    if values.size == 0:
+        return (0, None, None, 0.0, 0.0)
+    values_64 = values.astype(numpy.float64)
+    mean = values_64.mean()
+    return (
+        values.size, values.min().item(), values.max().item(), mean,
+        ((values_64 - mean)**2).sum())
+
+
+def merge_summaries(summary_a, summary_b):
+    """Combine two ``summarize_values`` results (Chan et al.)."""
+    count_a, min_a, max_a, mean_a, m2_a = summary_a
+    count_b, min_b, max_b, mean_b, m2_b = summary_b
+    if count_a == 0:
+        return summary_b
+    if count_b == 0:
+        return summary_a
+    count = count_a + count_b
+    delta = mean_b - mean_a
+    return (
+        count, min(min_a, min_b), max(max_a, max_b),
+        mean_a + delta * count_b / count,
+        m2_a + m2_b + delta**2 * count_a * count_b / count)
+
+
+def histogram_integer_raster(
+        raster_path_band, max_bins=_MAX_HISTOGRAM_BINS):
+    """Count the occurrences of every valid value in an integer raster.
+
+    The histogram grows to cover the value range seen so far, so only the
+    span between the smallest and largest valid value is allocated.
+
+    Parameters:
+        raster_path_band (tuple): (path, band index) of an integer raster.
+        max_bins (int): give up if the valid values span more than this
+            many distinct integers.
+
+    Returns:
+        (offset, counts) tuple where ``counts[i]`` is the number of pixels
+        with value ``offset + i``, ``offset`` is None if there are no valid
+        pixels. Returns None if the value range exceeds ``max_bins``.
+
+    """
+    offset = None
+    counts = numpy.zeros(0, dtype=numpy.int64)
+    for valid_values in iter_valid_values(raster_path_band):
+        if valid_values.size == 0:
+            continue
+        block_min = int(valid_values.min())
+        block_max = int(valid_values.max())
+        if offset is None:
+            new_min, new_max = block_min, block_max
+        else:
+            new_min = min(offset, block_min)
+            new_max = max(offset + counts.size - 1, block_max)
+        if new_max - new_min + 1 > max_bins:
+            return None
+        if offset is None or new_min < offset or (
+                new_max >= offset + counts.size):
+            grown_counts = numpy.zeros(
+                new_max - new_min + 1, dtype=numpy.int64)
+            if offset is not None:
+                grown_counts[offset-new_min:offset-new_min+counts.size] = (
+                    counts)
+            counts = grown_counts
+            offset = new_min
+        block_counts = numpy.bincount(
+            valid_values.astype(numpy.int64) - block_min)
+        counts[block_min-offset:block_min-offset+block_counts.size] += (
+            block_counts)
+    return offset, counts
+
+
+def _summarize_histogram(offset, counts, percentile_list):
+    """Build a ``summarize_raster`` result from an integer histogram."""
+    value_array = numpy.flatnonzero(counts).astype(numpy.int64)
+    count_array = counts[value_array]
+    if offset is not None:
+        value_array += offset
+    total_valid = int(count_array.sum())
+    result = {
+        'valid_count': total_valid,
+        'min': None,
+        'max': None,
+        'mean': None,
+        'stdev': None,
+        'mode': None,
+        'percentiles': {percentile: None for percentile in percentile_list},
+        'value_counts': (value_array, count_array),
+    }
+    if total_valid == 0:
+        return result
+    mean = (value_array * count_array.astype(numpy.float64)).sum() / (
+        total_valid)
+    m2 = (count_array * (value_array - mean)**2).sum()
+    cumulative_counts = numpy.cumsum(count_array)
+    result.update({
+        'min': int(value_array[0]),
+        'max': int(value_array[-1]),
+        'mean': float(mean),
+        'stdev': float(m2 / total_valid)**0.5,
+        'mode': int(value_array[numpy.argmax(count_array)]),
+    })
+    for percentile in percentile_list:
+        rank = percentile_to_rank(percentile, total_valid)
+        result['percentiles'][percentile] = int(value_array[
+            numpy.searchsorted(cumulative_counts, rank, side='right')])
+    return result
+
+
+def summarize_raster(
+        raster_path_band, percentile_list, work_dir=None, n_buckets=None,
+        integer_histogram=True):
+    """Calculate summary statistics and exact percentiles of a raster.
+
+    Integer rasters are summarized from ``histogram_integer_raster`` when
+    their value range allows it. Otherwise, and without ``n_buckets``, the
+    moments are accumulated in the same block pass that writes the sorted
+    runs, so the raster is read exactly once.
+
+    Parameters:
+        raster_path_band (tuple): (path, band index) of the raster.
+        percentile_list (list): percentiles in [0, 100] to calculate.
+        work_dir (str): directory in which to create a temporary directory
+            for run files, if None the system default is used.
+        n_buckets (int): if not None, histogram the raster into this many
+            equal width buckets and only sort the buckets that contain a
+            requested percentile. This costs two extra reads of the raster
+            but can avoid writing most of it to disk.
+        integer_histogram (bool): if True, try the exact histogram mode for
+            integer rasters before falling back to sorting.
+
+    Returns:
+        dict with 'valid_count', 'min', 'max', 'mean', 'stdev' (population),
+        'mode', 'percentiles' which maps each percentile to its value, and
+        'value_counts' which is a (values, counts) tuple of arrays. 'mode'
+        and 'value_counts' are None unless the histogram mode was used.
+        Every value other than 'valid_count' is None if the raster has no
+        valid pixels.
+
+    """
+    dtype = pygeoprocessing.get_raster_info(
+        raster_path_band[0])['numpy_type']
+    if integer_histogram and numpy.issubdtype(dtype, numpy.integer):
+        histogram = histogram_integer_raster(raster_path_band)
+        if histogram is not None:
+            return _summarize_histogram(
+                histogram[0], histogram[1], percentile_list)
+        LOGGER.info(
+            f'value range of {raster_path_band} is too wide for a '
+            f'histogram, sorting instead')
+    run_dir = tempfile.mkdtemp(dir=work_dir, prefix='percentile_runs_')
+    try:
+        summary = summarize_values(numpy.empty(0))
+        run_path_map = {0: []}
+        for block_index, valid_values in enumerate(
+                iter_valid_values(raster_path_band)):
+            summary = merge_summaries(summary, summarize_values(valid_values))
+            if n_buckets is None and percentile_list:
+                _write_runs(
+                    valid_values, block_index, run_dir, run_path_map, None)
+        total_valid, min_val, max_val, mean, m2 = summary
+        result = {
+            'valid_count': total_valid,
+            'min': min_val,
+            'max': max_val,
+            'mean': float(mean) if total_valid else None,
+            'stdev': float(m2 / total_valid)**0.5 if total_valid else None,
+            'mode': None,
+            'percentiles': {
+                percentile: None for percentile in percentile_list},
+            'value_counts': None,
+        }
+        if total_valid == 0 or not percentile_list:
+            return result
+
+        rank_list = [
+            percentile_to_rank(percentile, total_valid)
+            for percentile in percentile_list]
+        if n_buckets is None:
+            rank_bucket_list = [(0, rank) for rank in rank_list]
+        else:
+            bucket_edges = numpy.linspace(
+                float(min_val), float(max_val), n_buckets+1)
+            LOGGER.debug(f'histogramming into {n_buckets} buckets')
+            rank_bucket_list = locate_rank_buckets(
+                raster_path_band, rank_list, bucket_edges)
+            run_path_map = sort_to_disk(
+                raster_path_band, run_dir, bucket_edges=bucket_edges,
+                bucket_list=sorted(set(
+                    bucket for bucket, _ in rank_bucket_list)))
+        for percentile, (bucket, rank) in zip(
+                percentile_list, rank_bucket_list):
+            run_path_map[bucket] = reduce_run_fan_in(
+                run_path_map[bucket], dtype, run_dir)
+            result['percentiles'][percentile] = select_ranks(
+                run_path_map[bucket], dtype, [rank])[0]
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+    return result
+
+
+def calculate_percentiles(
+        raster_path_band, percentile_list, work_dir=None, n_buckets=None):
+    """Calculate exact percentiles of the valid pixels in a raster.
+
+    Parameters:
+        raster_path_band (tuple): (path, band index) of the raster.
+        percentile_list (list): percentiles in [0, 100] to calculate.
+        work_dir (str): directory in which to create a temporary directory
+            for run files, if None the system default is used.
+        n_buckets (int): if not None, first histogram the raster into this
+            many equal width buckets and only sort the buckets that contain
+            a requested percentile.
+
+    Returns:
+        dict mapping each percentile to its value, or to None if the raster
+        has no valid pixels.
+
+    """
+    return summarize_raster(
+        raster_path_band, percentile_list, work_dir=work_dir,
+        n_buckets=n_buckets)['percentiles']
@@ -1,19 +1,22 @@
 """Remap landcover codes based on distance from stream."""
 import datetime
+import hashlib
 import os
 import sys
 import logging
 import zipfile
 
 from osgeo import gdal
-from osgeo import osr
 import pygeoprocessing
 import pygeoprocessing.routing
-import pygeoprocessing.symbolic
 import numpy
 import taskgraph
 import ecoshard
 
+import convolution_kernels
+import masked_ops
+import tiled_convolution
+
 LOGGER = logging.getLogger(__name__)
 
 logging.basicConfig(
@@ -30,6 +33,38 @@ STREAM_LAYER_ECOSHARD_URL = 'https://storage.googleapis.com/critical-natural-cap
 STREAM_10M_BUFFER_PATH = '10mbuffer.gpkg'
 STREAM_50M_BUFFER_PATH = '50mbuffer.gpkg'
 WORKSPACE_DIR = 'raster_stream_buffer_workspace'
+SLOPE_THRESHOLD = 40.0  # percent
+BURN_DEPTH = 10
+TARGET_LULC_NODATA = -1
+
+LULC_TO_CONVERTED_MAP = {
+    0: 100,
+    1: 1,
+    2: 102,
+    3: 103,
+    4: 4,
+    5: 5,
+    6: 106,
+    7: 7,
+    8: 108,
+    9: 109,
+    10: 110,
+    11: 111,
+    12: 12,
+    13: 113,
+    14: 14,
+    15: 15,
+    16: 16,
+    21: 21,
+    22: 122,
+    23: 123,
+    24: 24,
+}
+
+# bands of the raster written by ``rasterize_stream_layers``
+STREAM_BAND = 1
+BUFFER_10M_BAND = 2
+BUFFER_50M_BAND = 3
 
 
 def conditional_convert_op(
@@ -58,13 +93,34 @@ def conditional_convert_op(
     return result
 
 
-def mask_by_value_op(array, value, nodata):
-    """Return 1 where array==value 0 otherwise."""
-    result = numpy.empty_like(array)
-    result[:] = 0
-    result[array == value] = 1
-    result[numpy.isclose(array, nodata)] = 2
-    return result
+def reclassify_and_convert_op(
+        base_lulc, stream_array, buffer_10m_array, buffer_50m_array,
+        flow_accum_50m_slope_mask_array, lulc_nodata, lulc_code_array,
+        converted_code_array, target_nodata):
+    """Reclassify LULC to its converted codes inline and convert.
+
+    Args:
+        lulc_code_array (numpy.ndarray): sorted LULC codes.
+        converted_code_array (numpy.ndarray): converted code for each entry
+            in ``lulc_code_array``.
+
+    See ``conditional_convert_op`` for the rest.
+
+    """
+    code_index = numpy.clip(
+        numpy.searchsorted(lulc_code_array, base_lulc), 0,
+        len(lulc_code_array)-1)
+    unmapped_mask = (
+        (lulc_code_array[code_index] != base_lulc) &
+        (base_lulc != lulc_nodata))
+    if unmapped_mask.any():
+        raise ValueError(
+            'LULC values %s have no converted value' %
+            numpy.unique(base_lulc[unmapped_mask]))
+    return conditional_convert_op(
+        base_lulc, lulc_nodata, converted_code_array[code_index],
+        buffer_10m_array, flow_accum_50m_slope_mask_array, buffer_50m_array,
+        stream_array, target_nodata)
 
 
 def mask_slope_and_distance(
@@ -72,24 +128,14 @@ def mask_slope_and_distance(
         dist_array, dist_threshold, dist_nodata, target_nodata):
     result = numpy.empty(slope_array.shape, dtype=numpy.int8)
     result[:] = target_nodata
-    valid_mask = (
-        ~numpy.isclose(slope_array, slope_nodata) &
-        ~numpy.isclose(dist_array, dist_nodata))
+    valid_mask = ~masked_ops.nodata_mask(slope_array, slope_nodata)
+    valid_mask &= ~masked_ops.nodata_mask(dist_array, dist_nodata)
     result[valid_mask] = (
         (slope_array[valid_mask] < slope_threshold) &
         (dist_array[valid_mask] < dist_threshold))
     return result
 
 
-def mask_by_inv_value_op(array, value, nodata):
-    """Return 0 where array==value 1 otherwise."""
-    result = numpy.empty_like(array)
-    result[:] = 0
-    result[array != value] = 1
-    result[numpy.isclose(array, nodata)] = 2
-    return result
-
-
 def download_and_unzip(base_url, target_dir, done_token_path):
     """Download and unzip base_url to target_dir and write done token path."""
     path_to_zip_file = os.path.join(target_dir, os.path.basename(base_url))
@@ -103,33 +149,15 @@ def download_and_unzip(base_url, target_dir, done_token_path):
 
 
 def burn_dem(
-        dem_raster_path, streams_raster_path, target_burned_dem_path,
-        burn_depth=10):
-    """Burn streams into dem."""
+        dem_raster_path, streams_raster_path_band, target_burned_dem_path,
+        burn_depth=10, n_threads=N_CPUS):
+    """Burn streams into dem where the (path, band) stream raster is 1."""
     dem_raster_info = pygeoprocessing.get_raster_info(dem_raster_path)
     dem_nodata = dem_raster_info['nodata'][0]
-    pygeoprocessing.new_raster_from_base(
-        dem_raster_path, target_burned_dem_path, dem_raster_info['datatype'],
-        [dem_nodata])
-
-    burned_dem_raster = gdal.OpenEx(
-        target_burned_dem_path, gdal.OF_RASTER | gdal.OF_UPDATE)
-    burned_dem_band = burned_dem_raster.GetRasterBand(1)
-    stream_raster = gdal.OpenEx(streams_raster_path, gdal.OF_RASTER)
-    stream_band = stream_raster.GetRasterBand(1)
-    for offset_dict, dem_block in pygeoprocessing.iterblocks(
-            (dem_raster_path, 1)):
-        stream_block = stream_band.ReadAsArray(**offset_dict)
-        stream_mask = (
-            (stream_block == 1) & ~numpy.isclose(dem_block, dem_nodata))
-        filled_block = numpy.copy(dem_block)
-        filled_block[stream_mask] = filled_block[stream_mask]-burn_depth
-        burned_dem_band.WriteArray(
-            filled_block, xoff=offset_dict['xoff'], yoff=offset_dict['yoff'])
-    stream_band = None
-    stream_raster = None
-    burned_dem_band = None
-    burned_dem_raster = None
+    masked_ops.block_op(
+        [(dem_raster_path, 1), streams_raster_path_band], masked_ops.burn_op,
+        (dem_nodata, burn_depth), target_burned_dem_path,
+        dem_raster_info['datatype'], dem_nodata, n_threads=n_threads)
 
 
 def length_of_degree(lat):
@@ -151,16 +179,116 @@ def length_of_degree(lat):
     return max(latlen, longlen)
 
 
-def rasterize_streams(
-        base_raster_path, stream_vector_path, target_streams_raster_path):
-    """Rasterize streams."""
+def rasterize_stream_layers(
+        base_raster_path, vector_path_list, target_raster_path):
+    """Rasterize each vector into its own band of one uint8 raster.
+
+    Band ``i`` is 1 where the ``i``th vector in ``vector_path_list`` covers
+    the pixel and 2 (nodata) everywhere else, so the streams and their
+    buffers share a single raster and a single pass of later readers.
+
+    Args:
+        base_raster_path (str): raster to take the grid from.
+        vector_path_list (list): paths to the vectors to rasterize.
+        target_raster_path (str): path to the target multi-band raster.
+
+    Returns:
+        None
+
+    """
+    n_bands = len(vector_path_list)
+    pygeoprocessing.new_raster_from_base(
+        base_raster_path, target_raster_path, gdal.GDT_Byte, [2]*n_bands,
+        fill_value_list=[2]*n_bands)
+    target_raster = gdal.OpenEx(
+        target_raster_path, gdal.OF_RASTER | gdal.OF_UPDATE)
+    for band_index, vector_path in enumerate(vector_path_list, start=1):
+        LOGGER.debug(vector_path)
+        vector = gdal.OpenEx(vector_path, gdal.OF_VECTOR)
+        layer = vector.GetLayer()
+        gdal.RasterizeLayer(
+            target_raster, [band_index], layer, burn_values=[1])
+        layer = None
+        vector = None
+    target_raster.FlushCache()
+    target_raster = None
+
+
+def _percent_slope(padded_dem, padded_valid, x_size, y_size):
+    """Horn's percent slope of the interior of a 1 pixel padded DEM tile.
+
+    Invalid neighbors take the value of the center pixel, matching
+    ``pygeoprocessing.calculate_slope``.
+
+    """
+    center = padded_dem[1:-1, 1:-1]
+    n_rows, n_cols = padded_dem.shape
+
+    def neighbor(dy, dx):
+        window = (
+            slice(1+dy, n_rows-1+dy), slice(1+dx, n_cols-1+dx))
+        return numpy.where(padded_valid[window], padded_dem[window], center)
+
+    a, b, c = neighbor(-1, -1), neighbor(-1, 0), neighbor(-1, 1)
+    d, f = neighbor(0, -1), neighbor(0, 1)
+    g, h, i = neighbor(1, -1), neighbor(1, 0), neighbor(1, 1)
+    dzdx = ((c + 2*f + i) - (a + 2*d + g)) / (8 * x_size)
+    dzdy = ((g + 2*h + i) - (a + 2*b + c)) / (8 * y_size)
+    return 100 * numpy.hypot(dzdx, dzdy)
+
+
+def steep_slope_mask(
+        dem_raster_path, buffer_raster_path_band, slope_threshold,
+        target_mask_path):
+    """Mask pixels steeper than a threshold inside a rasterized buffer.
+
+    Slope is evaluated per block from the DEM rather than materialized as
+    its own raster.
+
+    Args:
+        dem_raster_path (str): path to a projected DEM.
+        buffer_raster_path_band (tuple): (path, band) of a buffer raster that
+            is 1 inside the buffer, on the same grid as the DEM.
+        slope_threshold (float): percent slope pixels must exceed.
+        target_mask_path (str): path to a uint8 raster that is 1 where the
+            percent slope is greater than ``slope_threshold`` and the buffer
+            is 1, and 0 otherwise.
+
+    Returns:
+        None
+
+    """
+    dem_raster_info = pygeoprocessing.get_raster_info(dem_raster_path)
+    dem_nodata = dem_raster_info['nodata'][0]
+    x_size, y_size = [abs(size) for size in dem_raster_info['pixel_size']]
     pygeoprocessing.new_raster_from_base(
-        base_raster_path, target_streams_raster_path, gdal.GDT_Byte, [2],
-        fill_value_list=[2])
-    LOGGER.debug(stream_vector_path)
-    pygeoprocessing.rasterize(
-        stream_vector_path, target_streams_raster_path,
-        burn_values=[1])
+        dem_raster_path, target_mask_path, gdal.GDT_Byte, [None])
+
+    dem_raster = gdal.OpenEx(dem_raster_path, gdal.OF_RASTER)
+    dem_band = dem_raster.GetRasterBand(1)
+    buffer_raster = gdal.OpenEx(buffer_raster_path_band[0], gdal.OF_RASTER)
+    buffer_band = buffer_raster.GetRasterBand(buffer_raster_path_band[1])
+    mask_raster = gdal.OpenEx(
+        target_mask_path, gdal.OF_RASTER | gdal.OF_UPDATE)
+    mask_band = mask_raster.GetRasterBand(1)
+    for offset_dict in pygeoprocessing.iterblocks(
+            (dem_raster_path, 1), offset_only=True):
+        padded_dem, padded_valid = tiled_convolution.read_padded_tile(
+            dem_band, offset_dict, 1, 1, dem_nodata)
+        steep_mask = (
+            _percent_slope(padded_dem, padded_valid, x_size, y_size) >
+            slope_threshold)
+        steep_mask &= padded_valid[1:-1, 1:-1]
+        steep_mask &= buffer_band.ReadAsArray(**offset_dict) == 1
+        mask_band.WriteArray(
+            steep_mask.astype(numpy.uint8), xoff=offset_dict['xoff'],
+            yoff=offset_dict['yoff'])
+    mask_band = None
+    mask_raster = None
+    buffer_band = None
+    buffer_raster = None
+    dem_band = None
+    dem_raster = None
 
 
 def hat_distance_kernel(pixel_radius, kernel_filepath):
@@ -176,33 +304,8 @@ def hat_distance_kernel(pixel_radius, kernel_filepath):
         None
 
     """
-    kernel_size = int((pixel_radius)*2+1)
-    driver = gdal.GetDriverByName('GTiff')
-    kernel_dataset = driver.Create(
-        kernel_filepath.encode('utf-8'), kernel_size, kernel_size, 1,
-        gdal.GDT_Float32, options=[
-            'BIGTIFF=IF_SAFER', 'TILED=YES', 'BLOCKXSIZE=256',
-            'BLOCKYSIZE=256'])
-    # Make some kind of geotransform, it doesn't matter what but
-    # will make GIS libraries behave better if it's all defined
-    kernel_dataset.SetGeoTransform([0, 1, 0, 0, 0, -1])
-    srs = osr.SpatialReference()
-    srs.SetWellKnownGeogCS('WGS84')
-    kernel_dataset.SetProjection(srs.ExportToWkt())
-    kernel_band = kernel_dataset.GetRasterBand(1)
-    kernel_band.SetNoDataValue(-9999)
-    cols_per_block, rows_per_block = kernel_band.GetBlockSize()
-    row_indices, col_indices = numpy.indices(
-        (kernel_size, kernel_size), dtype=numpy.float) - pixel_radius
-
-    kernel_index_distances = numpy.hypot(row_indices, col_indices)
-    kernel = kernel_index_distances <= pixel_radius
-    kernel_band.WriteArray(kernel)
-
-    kernel_band.FlushCache()
-    kernel_dataset.FlushCache()
-    kernel_band = None
-    kernel_dataset = None
+    convolution_kernels.write_kernel_raster(
+        convolution_kernels.hat_kernel(pixel_radius), kernel_filepath, -9999)
 
 
 def linear_decay_kernel(pixel_radius, kernel_filepath):
@@ -218,251 +321,274 @@ def linear_decay_kernel(pixel_radius, kernel_filepath):
         None
 
     """
-    kernel_size = int((pixel_radius)*2+1)
-    driver = gdal.GetDriverByName('GTiff')
-    kernel_dataset = driver.Create(
-        kernel_filepath.encode('utf-8'), kernel_size, kernel_size, 1,
-        gdal.GDT_Float32, options=[
-            'BIGTIFF=IF_SAFER', 'TILED=YES', 'BLOCKXSIZE=256',
-            'BLOCKYSIZE=256'])
-    # Make some kind of geotransform, it doesn't matter what but
-    # will make GIS libraries behave better if it's all defined
-    kernel_dataset.SetGeoTransform([0, 1, 0, 0, 0, -1])
-    srs = osr.SpatialReference()
-    srs.SetWellKnownGeogCS('WGS84')
-    kernel_dataset.SetProjection(srs.ExportToWkt())
-    kernel_band = kernel_dataset.GetRasterBand(1)
-    kernel_band.SetNoDataValue(-9999)
-    cols_per_block, rows_per_block = kernel_band.GetBlockSize()
-    row_indices, col_indices = numpy.indices(
-        (kernel_size, kernel_size), dtype=numpy.float) - pixel_radius
-
-    kernel_index_distances = numpy.hypot(row_indices, col_indices)
-    inverse_distances = (pixel_radius - kernel_index_distances) / pixel_radius
-    inverse_distances[inverse_distances < 0] = 0
-    kernel_band.WriteArray(inverse_distances)
-
-    kernel_band.FlushCache()
-    kernel_dataset.FlushCache()
-    kernel_band = None
-    kernel_dataset = None
+    convolution_kernels.write_kernel_raster(
+        convolution_kernels.linear_decay_kernel(pixel_radius),
+        kernel_filepath, -9999)
 
 
-if __name__ == '__main__':
-    try:
-        os.makedirs(WORKSPACE_DIR)
-    except OSError:
-        pass
-    task_graph = taskgraph.TaskGraph(WORKSPACE_DIR, N_CPUS, 5)
-    dem_download_token_path = os.path.join(
-        WORKSPACE_DIR, 'dem_downloaded.TOKEN')
-    dem_raster_path = os.path.join(WORKSPACE_DIR, 'Dem10cr1', 'Dem10cr1')
-    _ = task_graph.add_task(
-        func=download_and_unzip,
-        args=(DEM_ECOSHARD_URL, WORKSPACE_DIR, dem_download_token_path),
-        target_path_list=[dem_download_token_path],
-        task_name='download dem')
+def fingerprint(value_list):
+    """Hash a list of stage inputs into a short hex key.
 
-    stream_vector_path = os.path.join(WORKSPACE_DIR, 'Rivers_lascruces_KEL')
-    stream_download_token_path = os.path.join(
-        WORKSPACE_DIR, 'stream_downloaded.TOKEN')
-    _ = task_graph.add_task(
-        func=download_and_unzip,
-        args=(STREAM_LAYER_ECOSHARD_URL, WORKSPACE_DIR,
-              stream_download_token_path),
-        target_path_list=[stream_download_token_path],
-        task_name='download stream')
+    Strings naming existing files are keyed on their path, size and
+    modification time, everything else on its ``repr``.
 
-    lulc_raster_path = os.path.join(
-        WORKSPACE_DIR, os.path.basename(LULC_ECOSHARD_URL))
-    _ = task_graph.add_task(
-        func=ecoshard.download_url,
-        args=(LULC_ECOSHARD_URL, lulc_raster_path),
-        target_path_list=[lulc_raster_path],
-        task_name='download lulc')
+    """
+    hasher = hashlib.sha1()
+    for value in value_list:
+        if isinstance(value, str) and os.path.isfile(value):
+            file_stat = os.stat(value)
+            value = (value, file_stat.st_size, file_stat.st_mtime)
+        hasher.update(repr(value).encode('utf-8'))
+    return hasher.hexdigest()[:12]
+
+
+def warp_to_projection(
+        base_raster_path, target_projection_wkt, target_raster_path):
+    """Warp a raster to a projection keeping its pixel size."""
+    base_raster_info = pygeoprocessing.get_raster_info(base_raster_path)
+    pygeoprocessing.warp_raster(
+        base_raster_path, base_raster_info['pixel_size'], target_raster_path,
+        'near', target_sr_wkt=target_projection_wkt)
+
+
+def warp_to_grid(base_raster_path, grid_raster_path, target_raster_path):
+    """Warp a raster onto the pixel grid of ``grid_raster_path``."""
+    grid_raster_info = pygeoprocessing.get_raster_info(grid_raster_path)
+    pygeoprocessing.warp_raster(
+        base_raster_path, grid_raster_info['pixel_size'], target_raster_path,
+        'near', target_bb=grid_raster_info['bounding_box'],
+        target_sr_wkt=grid_raster_info['projection'])
+
+
+def add_hydrology_stage(
+        task_graph, dem_raster_path, stream_vector_path_list,
+        target_projection_wkt, hydrology_key, dependent_task_list):
+    """Add the landcover independent DEM and stream tasks to the graph.
+
+    Every product lives in a directory named by ``hydrology_key`` so it is
+    only rebuilt when the DEM, streams or target projection change.
+
+    Args:
+        task_graph (taskgraph.TaskGraph): graph to add tasks to.
+        dem_raster_path (str): path to the DEM.
+        stream_vector_path_list (list): streams, 10m and 50m buffer vectors
+            in band order of ``rasterize_stream_layers``.
+        target_projection_wkt (str): projection to warp the DEM to.
+        hydrology_key (str): fingerprint of the inputs above.
+        dependent_task_list (list): tasks that produce the inputs.
 
-    task_graph.join()
+    Returns:
+        (path_dict, task) tuple where ``path_dict`` has the 'dem',
+        'stream_layers' and 'flow_accum_slope_mask' raster paths and
+        ``task`` is the last task of the stage.
 
-    base_raster_path_list = [dem_raster_path, lulc_raster_path]
-    dem_raster_info = pygeoprocessing.get_raster_info(dem_raster_path)
-    lulc_raster_info = pygeoprocessing.get_raster_info(lulc_raster_path)
-    LOGGER.debug(dem_raster_info)
-    LOGGER.debug(lulc_raster_info)
-    aligned_raster_path_list = [
-        '%s/aligned_%s' % (os.path.dirname(path), os.path.basename(path))
-        for path in base_raster_path_list]
+    """
+    hydrology_dir = os.path.join(WORKSPACE_DIR, 'hydrology_%s' % hydrology_key)
+    try:
+        os.makedirs(hydrology_dir)
+    except OSError:
+        pass
+    path_dict = {
+        'dem': os.path.join(hydrology_dir, 'aligned_dem.tif'),
+        'stream_layers': os.path.join(
+            hydrology_dir, 'rasterized_stream_layers.tif'),
+        'flow_accum_slope_mask': os.path.join(
+            hydrology_dir, 'flow_accum_masked_high_slope.tif'),
+    }
     align_task = task_graph.add_task(
-        func=pygeoprocessing.align_and_resize_raster_stack,
-        args=(
-            base_raster_path_list, aligned_raster_path_list,
-            ['near', 'near'], dem_raster_info['pixel_size'],
-            'intersection'),
-        kwargs={'target_sr_wkt': lulc_raster_info['projection']},
-        target_path_list=aligned_raster_path_list,
-        task_name='align rasters')
-
-    rasterized_streams_raster_path = os.path.join(
-        WORKSPACE_DIR, 'rasterized_streams.tif')
-    rasterize_streams_task = task_graph.add_task(
-            func=rasterize_streams,
-            args=(aligned_raster_path_list[0], stream_vector_path,
-                  rasterized_streams_raster_path),
-            target_path_list=[rasterized_streams_raster_path],
-            dependent_task_list=[align_task],
-            task_name='rasterize streams')
-
-    rasterized_10m_buffer_raster_path = os.path.join(
-        WORKSPACE_DIR, 'rasterized_10m_buffer_streams.tif')
-    rasterize_10m_buffer_task = task_graph.add_task(
-            func=rasterize_streams,
-            args=(aligned_raster_path_list[0], STREAM_10M_BUFFER_PATH,
-                  rasterized_10m_buffer_raster_path),
-            target_path_list=[rasterized_10m_buffer_raster_path],
-            dependent_task_list=[align_task],
-            task_name='rasterize 10m buffer')
-
-    rasterized_50m_buffer_raster_path = os.path.join(
-        WORKSPACE_DIR, 'rasterized_50m_buffer_streams.tif')
-    rasterize_50m_buffer_task = task_graph.add_task(
-            func=rasterize_streams,
-            args=(aligned_raster_path_list[0], STREAM_50M_BUFFER_PATH,
-                  rasterized_50m_buffer_raster_path),
-            target_path_list=[rasterized_50m_buffer_raster_path],
-            dependent_task_list=[align_task],
-            task_name='rasterize 50m buffer')
-
-    burned_dem_path = os.path.join(WORKSPACE_DIR, 'burned_dem.tif')
+        func=warp_to_projection,
+        args=(dem_raster_path, target_projection_wkt, path_dict['dem']),
+        target_path_list=[path_dict['dem']],
+        dependent_task_list=dependent_task_list,
+        task_name='align dem')
+
+    # streams and both buffers burnt into the bands of one raster
+    rasterize_task = task_graph.add_task(
+        func=rasterize_stream_layers,
+        args=(path_dict['dem'], stream_vector_path_list,
+              path_dict['stream_layers']),
+        target_path_list=[path_dict['stream_layers']],
+        dependent_task_list=[align_task],
+        task_name='rasterize streams and buffers')
+
+    burned_dem_path = os.path.join(hydrology_dir, 'burned_dem.tif')
     burn_dem_task = task_graph.add_task(
         func=burn_dem,
-        args=(aligned_raster_path_list[0], rasterized_streams_raster_path,
+        args=(path_dict['dem'], (path_dict['stream_layers'], STREAM_BAND),
               burned_dem_path),
+        kwargs={'burn_depth': BURN_DEPTH},
         target_path_list=[burned_dem_path],
-        dependent_task_list=[rasterize_streams_task],
+        dependent_task_list=[rasterize_task],
         task_name='burn streams')
 
-    filled_dem_raster_path = os.path.join(
-        WORKSPACE_DIR, 'filled_dem.tif')
+    filled_dem_raster_path = os.path.join(hydrology_dir, 'filled_dem.tif')
     fill_pits_task = task_graph.add_task(
         func=pygeoprocessing.routing.fill_pits,
         args=(
             (burned_dem_path, 1), filled_dem_raster_path),
-        kwargs={'working_dir': WORKSPACE_DIR},
+        kwargs={'working_dir': hydrology_dir},
         dependent_task_list=[burn_dem_task],
         target_path_list=[filled_dem_raster_path],
         task_name='fill pits')
 
-    slope_raster_path = os.path.join(WORKSPACE_DIR, 'slope.tif')
-    slope_task = task_graph.add_task(
-        func=pygeoprocessing.calculate_slope,
-        args=((aligned_raster_path_list[0], 1), slope_raster_path),
-        target_path_list=[slope_raster_path],
-        dependent_task_list=[align_task],
-        task_name='calculate slope')
-
-    flow_direction_path = os.path.join(WORKSPACE_DIR, 'mfd_flow_dir.tif')
+    flow_direction_path = os.path.join(hydrology_dir, 'mfd_flow_dir.tif')
     flow_dir_task = task_graph.add_task(
         func=pygeoprocessing.routing.flow_dir_mfd,
         args=((filled_dem_raster_path, 1), flow_direction_path),
-        kwargs={'working_dir': WORKSPACE_DIR},
+        kwargs={'working_dir': hydrology_dir},
         target_path_list=[flow_direction_path],
         dependent_task_list=[fill_pits_task],
         task_name='flow dir')
 
-    flow_accum_path = os.path.join(WORKSPACE_DIR, 'flow_accum.tif')
-    flow_accum_task = task_graph.add_task(
-        func=pygeoprocessing.routing.flow_accumulation_mfd,
-        args=((flow_direction_path, 1), flow_accum_path),
-        target_path_list=[flow_accum_path],
-        dependent_task_list=[flow_dir_task],
-        task_name='flow accum')
-
-    # 3) make slope threshold mask
-    slope_threshold = 40.0
-    slope_mask_nodata = -9999
+    # mask slope over threshold within the 50m buffer, slope is computed
+    # per block rather than written out
     steep_slope_50m_mask_path = os.path.join(
-        WORKSPACE_DIR,
-        'steep_slope_%.2f_in_50m_mask.tif' % slope_threshold)
+        hydrology_dir,
+        'steep_slope_%.2f_in_50m_mask.tif' % SLOPE_THRESHOLD)
     steep_slope_50m_task = task_graph.add_task(
-        func=pygeoprocessing.symbolic.evaluate_raster_calculator_expression,
+        func=steep_slope_mask,
         args=(
-            'And(slope > %f, buffer_50m_mask)' % slope_threshold,
-            {'slope': (slope_raster_path, 1),
-             'buffer_50m_mask': (rasterized_50m_buffer_raster_path, 1)},
-            slope_mask_nodata,
-            steep_slope_50m_mask_path),
+            path_dict['dem'], (path_dict['stream_layers'], BUFFER_50M_BAND),
+            SLOPE_THRESHOLD, steep_slope_50m_mask_path),
         target_path_list=[steep_slope_50m_mask_path],
-        dependent_task_list=[slope_task, rasterize_50m_buffer_task],
-        task_name='mask slope to %.2f%%' % slope_threshold)
+        dependent_task_list=[rasterize_task],
+        task_name='mask slope to %.2f%%' % SLOPE_THRESHOLD)
 
-    # 4) weighted flow accum of slope threshold mask
-    flow_accum_slope_mask_path = os.path.join(
-        WORKSPACE_DIR, 'flow_accum_masked_high_slope.tif')
+    # weighted flow accum of slope threshold mask
     slope_flow_accum_task = task_graph.add_task(
         func=pygeoprocessing.routing.flow_accumulation_mfd,
         args=(
-            (flow_direction_path, 1), flow_accum_slope_mask_path),
+            (flow_direction_path, 1), path_dict['flow_accum_slope_mask']),
         kwargs={'weight_raster_path_band': (steep_slope_50m_mask_path, 1)},
-        target_path_list=[flow_accum_slope_mask_path],
+        target_path_list=[path_dict['flow_accum_slope_mask']],
         dependent_task_list=[steep_slope_50m_task, flow_dir_task],
         task_name='masked slope weighted flow accum')
+    return path_dict, slope_flow_accum_task
 
-    lulc_to_converted_map = {
-        0: 100,
-        1: 1,
-        2: 102,
-        3: 103,
-        4: 4,
-        5: 5,
-        6: 106,
-        7: 7,
-        8: 108,
-        9: 109,
-        10: 110,
-        11: 111,
-        12: 12,
-        13: 113,
-        14: 14,
-        15: 15,
-        16: 16,
-        21: 21,
-        22: 122,
-        23: 123,
-        24: 24,
-    }
 
-    target_lulc_nodata = -1
-    potential_converted_landover_raster_path = os.path.join(
-        WORKSPACE_DIR, 'potential_converted_lulc.tif')
-    converted_lulc_task = task_graph.add_task(
-        func=pygeoprocessing.reclassify_raster,
-        args=(
-            (aligned_raster_path_list[1], 1), lulc_to_converted_map,
-            potential_converted_landover_raster_path, gdal.GDT_Int16,
-            target_lulc_nodata),
-        kwargs={'values_required': True},
-        target_path_list=[potential_converted_landover_raster_path],
-        dependent_task_list=[align_task],
-        task_name='calculate converted')
+def add_landcover_stage(
+        task_graph, lulc_raster_path, lulc_to_converted_map,
+        hydrology_path_dict, hydrology_key, dependent_task_list):
+    """Add the tasks converting one landcover scenario to the graph.
 
-    task_graph.join()
+    The LULC is aligned to the hydrology grid once per LULC and hydrology
+    key, so a new ``lulc_to_converted_map`` only runs the final conversion.
 
+    Args:
+        task_graph (taskgraph.TaskGraph): graph to add tasks to.
+        lulc_raster_path (str): path to the base landcover raster.
+        lulc_to_converted_map (dict): maps every LULC code to the code it
+            converts to near streams.
+        hydrology_path_dict (dict): paths returned by
+            ``add_hydrology_stage``.
+        hydrology_key (str): fingerprint of the hydrology stage.
+        dependent_task_list (list): tasks that produce the LULC and the
+            hydrology products.
+
+    Returns:
+        (converted_lulc_raster_path, task) tuple.
+
+    """
+    landcover_dir = os.path.join(
+        WORKSPACE_DIR, 'landcover_%s' % fingerprint(
+            [lulc_raster_path, hydrology_key]))
+    try:
+        os.makedirs(landcover_dir)
+    except OSError:
+        pass
+    aligned_lulc_raster_path = os.path.join(landcover_dir, 'aligned_lulc.tif')
+    align_task = task_graph.add_task(
+        func=warp_to_grid,
+        args=(lulc_raster_path, hydrology_path_dict['dem'],
+              aligned_lulc_raster_path),
+        target_path_list=[aligned_lulc_raster_path],
+        dependent_task_list=dependent_task_list,
+        task_name='align lulc')
+
+    lulc_code_array = numpy.array(sorted(lulc_to_converted_map))
+    converted_code_array = numpy.array(
+        [lulc_to_converted_map[code] for code in lulc_code_array],
+        dtype=numpy.int16)
     converted_landover_raster_path = os.path.join(
-        WORKSPACE_DIR, 'converted_lulc.tif')
-    base_lulc_nodata = lulc_raster_info['nodata'][0]
-    task_graph.add_task(
+        landcover_dir, 'converted_lulc_%s.tif' % fingerprint(
+            [sorted(lulc_to_converted_map.items())]))
+    base_lulc_nodata = pygeoprocessing.get_raster_info(
+        lulc_raster_path)['nodata'][0]
+    stream_layers_raster_path = hydrology_path_dict['stream_layers']
+    convert_task = task_graph.add_task(
         func=pygeoprocessing.raster_calculator,
         args=(
-            ((aligned_raster_path_list[1], 1), (base_lulc_nodata, 'raw'),
-             (potential_converted_landover_raster_path, 1),
-             (rasterized_10m_buffer_raster_path, 1),
-             (flow_accum_slope_mask_path, 1),
-             (rasterized_50m_buffer_raster_path, 1),
-             (rasterized_streams_raster_path, 1),
-             (target_lulc_nodata, 'raw')),
-            conditional_convert_op, converted_landover_raster_path,
-            gdal.GDT_Int16, target_lulc_nodata),
+            ((aligned_lulc_raster_path, 1),
+             (stream_layers_raster_path, STREAM_BAND),
+             (stream_layers_raster_path, BUFFER_10M_BAND),
+             (stream_layers_raster_path, BUFFER_50M_BAND),
+             (hydrology_path_dict['flow_accum_slope_mask'], 1),
+             (base_lulc_nodata, 'raw'), (lulc_code_array, 'raw'),
+             (converted_code_array, 'raw'), (TARGET_LULC_NODATA, 'raw')),
+            reclassify_and_convert_op, converted_landover_raster_path,
+            gdal.GDT_Int16, TARGET_LULC_NODATA),
         target_path_list=[converted_landover_raster_path],
+        dependent_task_list=[align_task] + dependent_task_list,
         task_name='convert landcover')
+    return converted_landover_raster_path, convert_task
+
+
+if __name__ == '__main__':
+    try:
+        os.makedirs(WORKSPACE_DIR)
+    except OSError:
+        pass
+    task_graph = taskgraph.TaskGraph(WORKSPACE_DIR, N_CPUS, 5)
+    dem_download_token_path = os.path.join(
+        WORKSPACE_DIR, 'dem_downloaded.TOKEN')
+    dem_raster_path = os.path.join(WORKSPACE_DIR, 'Dem10cr1', 'Dem10cr1')
+    dem_download_task = task_graph.add_task(
+        func=download_and_unzip,
+        args=(DEM_ECOSHARD_URL, WORKSPACE_DIR, dem_download_token_path),
+        target_path_list=[dem_download_token_path],
+        task_name='download dem')
+
+    stream_vector_path = os.path.join(WORKSPACE_DIR, 'Rivers_lascruces_KEL')
+    stream_download_token_path = os.path.join(
+        WORKSPACE_DIR, 'stream_downloaded.TOKEN')
+    stream_download_task = task_graph.add_task(
+        func=download_and_unzip,
+        args=(STREAM_LAYER_ECOSHARD_URL, WORKSPACE_DIR,
+              stream_download_token_path),
+        target_path_list=[stream_download_token_path],
+        task_name='download stream')
+
+    lulc_raster_path = os.path.join(
+        WORKSPACE_DIR, os.path.basename(LULC_ECOSHARD_URL))
+    lulc_download_task = task_graph.add_task(
+        func=ecoshard.download_url,
+        args=(LULC_ECOSHARD_URL, lulc_raster_path),
+        target_path_list=[lulc_raster_path],
+        task_name='download lulc')
+
+    # only the landcover projection is needed to lay out the graph, the
+    # other downloads keep going in the background
+    lulc_download_task.join()
+    lulc_projection_wkt = pygeoprocessing.get_raster_info(
+        lulc_raster_path)['projection']
+
+    # ecoshard urls carry the md5 of their contents
+    stream_vector_path_list = [
+        stream_vector_path, STREAM_10M_BUFFER_PATH, STREAM_50M_BUFFER_PATH]
+    hydrology_key = fingerprint([
+        DEM_ECOSHARD_URL, STREAM_LAYER_ECOSHARD_URL, STREAM_10M_BUFFER_PATH,
+        STREAM_50M_BUFFER_PATH, lulc_projection_wkt, SLOPE_THRESHOLD,
+        BURN_DEPTH])
+    hydrology_path_dict, hydrology_task = add_hydrology_stage(
+        task_graph, dem_raster_path, stream_vector_path_list,
+        lulc_projection_wkt, hydrology_key,
+        [dem_download_task, stream_download_task])
+
+    converted_landover_raster_path, _ = add_landcover_stage(
+        task_graph, lulc_raster_path, LULC_TO_CONVERTED_MAP,
+        hydrology_path_dict, hydrology_key,
+        [lulc_download_task, hydrology_task])
 
     task_graph.join()
     task_graph.close()
+    LOGGER.info('converted landcover: %s', converted_landover_raster_path)
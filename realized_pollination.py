@@ -3,13 +3,11 @@ import os
 import logging
 import sys
 
-import scipy
 import numpy
-from osgeo import osr
-from osgeo import gdal
 import pygeoprocessing
 import taskgraph
 import raster_calculations_core
+import tiled_convolution
 import compress_and_overview
 
 BASE_RASTER_URL_MAP = {
@@ -43,6 +41,16 @@ def _nodata_to_zero_op(base_array, base_nodata):
     return result
 
 
+def _mask_by_hab_op(
+        ppl_fed_reach_array, hab_mask_array, hab_mask_nodata, target_nodata):
+    """Mask ppl fed reach to where there is habitat."""
+    result = ppl_fed_reach_array * (hab_mask_array > 0.0)
+    if hab_mask_nodata is not None:
+        result[numpy.isclose(hab_mask_array, hab_mask_nodata)] = (
+            target_nodata)
+    return result
+
+
 def main():
     """Entry point."""
     for dir_path in [WORKSPACE_DIR, CHURN_DIR, ECOSHARD_DIR]:
@@ -51,12 +59,6 @@ def main():
         except OSError:
             pass
     task_graph = taskgraph.TaskGraph(CHURN_DIR, -1, 5.0)
-    kernel_raster_path = os.path.join(CHURN_DIR, 'radial_kernel.tif')
-    kernel_task = task_graph.add_task(
-        func=create_flat_radial_convolution_mask,
-        args=(0.00277778, 2000., kernel_raster_path),
-        target_path_list=[kernel_raster_path],
-        task_name='make convolution kernel')
     hab_fetch_path_map = {}
     # download hab mask and ppl fed equivalent raster
     for raster_id, raster_url in BASE_RASTER_URL_MAP.items():
@@ -75,54 +77,45 @@ def main():
     ppl_fed_raster_info = pygeoprocessing.get_raster_info(
         hab_fetch_path_map['ppl_fed'])
 
-    ppl_fed_nodata_to_zero_path = os.path.join(
-        CHURN_DIR, 'ppl_fed__nodata_to_zero.tif')
-
-    task_graph.add_task(
-        func=pygeoprocessing.raster_calculator,
+    # the post op reads the hab mask tile by tile with the ppl fed tiles so
+    # it must be on the ppl fed grid
+    aligned_hab_mask_raster_path = os.path.join(
+        CHURN_DIR, 'hab_mask_aligned_to_ppl_fed.tif')
+    align_hab_mask_task = task_graph.add_task(
+        func=pygeoprocessing.warp_raster,
         args=(
-            [(hab_fetch_path_map['ppl_fed'], 1),
-             (ppl_fed_raster_info['nodata'][0], 'raw')],
-            _nodata_to_zero_op, ppl_fed_nodata_to_zero_path,
-            gdal.GDT_Float32, None),
-        target_path_list=[ppl_fed_nodata_to_zero_path],
-        task_name='hab mask nodata to zero')
-    task_graph.join()
-
-    # calculate extent of ppl fed by 2km.
-    ppl_fed_reach_raster_path = os.path.join(CHURN_DIR, 'ppl_fed_reach.tif')
-    ppl_fed_reach_task = task_graph.add_task(
-        func=pygeoprocessing.convolve_2d,
-        args=[
-            (ppl_fed_nodata_to_zero_path, 1), (kernel_raster_path, 1),
-            ppl_fed_reach_raster_path],
+            hab_fetch_path_map['hab_mask'],
+            ppl_fed_raster_info['pixel_size'], aligned_hab_mask_raster_path,
+            'near'),
+        kwargs={
+            'target_bb': ppl_fed_raster_info['bounding_box'],
+            'target_projection_wkt': ppl_fed_raster_info['projection_wkt']},
+        target_path_list=[aligned_hab_mask_raster_path],
+        task_name='align hab mask to ppl fed')
+
+    # calculate extent of ppl fed by 2km, each latitude band gets a 2km
+    # kernel sized for its latitude. ppl fed nodata is zeroed as each tile
+    # is read and the reach is masked by the hab mask before it is written
+    task_graph.add_task(
+        func=tiled_convolution.convolve_by_latitude_band,
+        args=[(hab_fetch_path_map['ppl_fed'], 1), 2000.,
+              REALIZED_POLLINATION_RASTER_PATH],
         kwargs={
-            'working_dir': CHURN_DIR,
+            'kernel_normalization': 'max',
+            'ignore_nodata': False,
             'mask_nodata': False,
-            'raster_driver_creation_tuple': (
-                'GTiff', (
-                    'TILED=YES', 'BIGTIFF=YES', 'COMPRESS=ZSTD',
-                    'PREDICTOR=1', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256',
-                    'NUM_THREADS=2')),
-                'n_threads': 4},
-        dependent_task_list=[kernel_task],
-        target_path_list=[ppl_fed_reach_raster_path],
-        task_name=(
-            'calculate natural hab proportion'
-            f' {os.path.basename(ppl_fed_reach_raster_path)}'))
-
-    # mask ppl fed reach by the hab mask.
-    raster_calculations_core.evaluate_calculation(
-        {
-            'expression': 'ppl_fed_reach*(hab_mask>0.0)',
-            'symbol_to_path_map': {
-                'ppl_fed_reach': ppl_fed_reach_raster_path,
-                'hab_mask': hab_fetch_path_map['hab_mask'],
-            },
-            'target_pixel_size': hab_mask_raster_info['pixel_size'],
             'target_nodata': TARGET_NODATA,
-            'target_raster_path': REALIZED_POLLINATION_RASTER_PATH,
-        }, task_graph, CHURN_DIR)
+            'n_threads': 4,
+            'pre_op': _nodata_to_zero_op,
+            'pre_op_args': (ppl_fed_raster_info['nodata'][0],),
+            'post_op': _mask_by_hab_op,
+            'post_op_args': (
+                hab_mask_raster_info['nodata'][0], TARGET_NODATA),
+            'post_op_raster_path_band_list': [
+                (aligned_hab_mask_raster_path, 1)]},
+        dependent_task_list=[align_hab_mask_task],
+        target_path_list=[REALIZED_POLLINATION_RASTER_PATH],
+        task_name='calculate realized pollination')
     task_graph.join()
 
     compress_and_overview.compress_to(
@@ -132,59 +125,5 @@ def main():
     task_graph.close()
 
 
-def create_flat_radial_convolution_mask(
-        pixel_size_degree, radius_meters, kernel_filepath):
-    """Create a radial mask to sample pixels in convolution filter.
-
-    Parameters:
-        pixel_size_degree (float): size of pixel in degrees.
-        radius_meters (float): desired size of radial mask in meters.
-
-    Returns:
-        A 2D numpy array that can be used in a convolution to aggregate a
-        raster while accounting for partial coverage of the circle on the
-        edges of the pixel.
-
-    """
-    degree_len_0 = 110574  # length at 0 degrees
-    degree_len_60 = 111412  # length at 60 degrees
-    pixel_size_m = pixel_size_degree * (degree_len_0 + degree_len_60) / 2.0
-    pixel_radius = numpy.ceil(radius_meters / pixel_size_m)
-    n_pixels = (int(pixel_radius) * 2 + 1)
-    sample_pixels = 200
-    mask = numpy.ones((sample_pixels * n_pixels, sample_pixels * n_pixels))
-    mask[mask.shape[0]//2, mask.shape[0]//2] = 0
-    distance_transform = scipy.ndimage.morphology.distance_transform_edt(mask)
-    mask = None
-    stratified_distance = distance_transform * pixel_size_m / sample_pixels
-    distance_transform = None
-    in_circle = numpy.where(stratified_distance <= 2000.0, 1.0, 0.0)
-    stratified_distance = None
-    reshaped = in_circle.reshape(
-        in_circle.shape[0] // sample_pixels, sample_pixels,
-        in_circle.shape[1] // sample_pixels, sample_pixels)
-    kernel_array = numpy.sum(reshaped, axis=(1, 3)) / sample_pixels**2
-    normalized_kernel_array = kernel_array / numpy.max(kernel_array)
-    LOGGER.debug(normalized_kernel_array)
-    reshaped = None
-
-    driver = gdal.GetDriverByName('GTiff')
-    kernel_raster = driver.Create(
-        kernel_filepath.encode('utf-8'), n_pixels, n_pixels, 1,
-        gdal.GDT_Float32, options=[
-            'BIGTIFF=IF_SAFER', 'TILED=YES', 'BLOCKXSIZE=256',
-            'BLOCKYSIZE=256'])
-
-    # Make some kind of geotransform, it doesn't matter what but
-    # will make GIS libraries behave better if it's all defined
-    kernel_raster.SetGeoTransform([-180, 1, 0, 90, 0, -1])
-    srs = osr.SpatialReference()
-    srs.ImportFromEPSG(4326)
-    kernel_raster.SetProjection(srs.ExportToWkt())
-    kernel_band = kernel_raster.GetRasterBand(1)
-    kernel_band.SetNoDataValue(TARGET_NODATA)
-    kernel_band.WriteArray(normalized_kernel_array)
-
-
 if __name__ == '__main__':
     main()
@@ -0,0 +1,54 @@
+"""Tests for the masked elementwise ops."""
+import os
+import sys
+import unittest
+
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import masked_ops  # noqa: E402
+
+
+class MaskedOpsTests(unittest.TestCase):
+    """Tests for the masked elementwise ops."""
+
+    def test_nodata_mask_integer_is_exact(self):
+        """Integer arrays only match nodata exactly."""
+        array = numpy.array([[0, 1, 2, 255]], dtype=numpy.int32)
+        numpy.testing.assert_array_equal(
+            masked_ops.nodata_mask(array, 1),
+            [[False, True, False, False]])
+        numpy.testing.assert_array_equal(
+            masked_ops.nodata_mask(array, None), numpy.zeros((1, 4), bool))
+
+    def test_mask_by_value_op(self):
+        """1 on the value, 0 elsewhere and 2 on nodata."""
+        array = numpy.array([[1, 2, 3, 255]], dtype=numpy.uint8)
+        result = masked_ops.mask_by_value_op(array, 2, 255)
+        self.assertEqual(result.dtype, array.dtype)
+        numpy.testing.assert_array_equal(result, [[0, 1, 0, 2]])
+        numpy.testing.assert_array_equal(array, [[1, 2, 3, 255]])
+
+    def test_mask_by_inv_value_op(self):
+        """0 on the value, 1 elsewhere and 2 on nodata."""
+        array = numpy.array([[1, 2, 3, 255]], dtype=numpy.uint8)
+        numpy.testing.assert_array_equal(
+            masked_ops.mask_by_inv_value_op(array, 2, 255), [[1, 0, 1, 2]])
+
+    def test_mask_ops_float_nodata(self):
+        """Float arrays match nodata with isclose and allow no nodata."""
+        array = numpy.array([[1.0, 2.0, -9999.0]], dtype=numpy.float32)
+        numpy.testing.assert_array_equal(
+            masked_ops.mask_by_value_op(array, 2.0, -9999), [[0, 1, 2]])
+        numpy.testing.assert_array_equal(
+            masked_ops.mask_by_inv_value_op(array, 2.0, None), [[1, 0, 1]])
+
+    def test_burn_op(self):
+        """Streams lower the DEM in place except on nodata."""
+        dem_array = numpy.array([[20, 20, -1, 20]], dtype=numpy.int16)
+        stream_array = numpy.array([[1, 0, 1, 2]], dtype=numpy.uint8)
+        result = masked_ops.burn_op(dem_array, stream_array, -1, 10)
+        self.assertIs(result, dem_array)
+        numpy.testing.assert_array_equal(result, [[10, 20, -1, 20]])
@@ -0,0 +1,81 @@
+"""Tests for the alignment stage of mult_rasters_by_columns."""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import mult_rasters_by_columns  # noqa: E402
+
+# a 1 arc-second grid over one degree
+_PIXEL_SIZE = (1/3600, -1/3600)
+_BOUNDING_BOX = [-10.0, 40.0, -9.0, 41.0]
+
+
+class _RecordingTaskGraph(object):
+    """Records the tasks added to it without running them."""
+
+    def __init__(self):
+        self.task_kwargs_list = []
+
+    def add_task(self, **kwargs):
+        self.task_kwargs_list.append(kwargs)
+        return kwargs
+
+
+def _raster_info(x_offset_pixels=0, y_offset_pixels=0, raster_size=None):
+    """Info of a raster on the test grid shifted by whole pixels."""
+    return {
+        'path': 'raster.tif',
+        'geotransform': (
+            _BOUNDING_BOX[0] + x_offset_pixels*_PIXEL_SIZE[0],
+            _PIXEL_SIZE[0], 0.0,
+            _BOUNDING_BOX[3] + y_offset_pixels*_PIXEL_SIZE[1], 0.0,
+            _PIXEL_SIZE[1]),
+        'raster_size': raster_size or (3600, 3600),
+    }
+
+
+class AlignTests(unittest.TestCase):
+    """Tests for matches_grid and add_align_tasks."""
+
+    def test_matching_raster_read_in_place(self):
+        """A raster already on the target grid is not warped."""
+        task_graph = _RecordingTaskGraph()
+        info_map = {'a': _raster_info()}
+        mult_rasters_by_columns.add_align_tasks(
+            task_graph, info_map, _PIXEL_SIZE, _BOUNDING_BOX, 'align',
+            'work')
+        self.assertEqual(task_graph.task_kwargs_list, [])
+        self.assertEqual(info_map['a']['aligned_path'], 'raster.tif')
+
+    def test_one_pixel_offset_is_warped(self):
+        """A raster shifted by a single pixel gets a warp task."""
+        for x_offset, y_offset in [(1, 0), (0, 1), (-1, -1)]:
+            task_graph = _RecordingTaskGraph()
+            info_map = {'a': _raster_info(x_offset, y_offset)}
+            self.assertFalse(mult_rasters_by_columns.matches_grid(
+                info_map['a'], _PIXEL_SIZE, _BOUNDING_BOX))
+            mult_rasters_by_columns.add_align_tasks(
+                task_graph, info_map, _PIXEL_SIZE, _BOUNDING_BOX, 'align',
+                'work')
+            self.assertEqual(len(task_graph.task_kwargs_list), 1)
+            self.assertEqual(
+                task_graph.task_kwargs_list[0]['target_path_list'],
+                [info_map['a']['aligned_path']])
+            self.assertNotEqual(info_map['a']['aligned_path'], 'raster.tif')
+
+    def test_different_size_is_warped(self):
+        """A raster at the grid origin with a different size is warped."""
+        self.assertFalse(mult_rasters_by_columns.matches_grid(
+            _raster_info(raster_size=(3601, 3600)), _PIXEL_SIZE,
+            _BOUNDING_BOX))
+
+    def test_sub_pixel_noise_matches(self):
+        """Float noise far below a pixel still counts as on the grid."""
+        info = _raster_info()
+        info['geotransform'] = (
+            info['geotransform'][0] + 1e-9,) + info['geotransform'][1:]
+        self.assertTrue(mult_rasters_by_columns.matches_grid(
+            info, _PIXEL_SIZE, _BOUNDING_BOX))
@@ -0,0 +1,87 @@
+"""Tests for the grid checks of tiled_convolution."""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from osgeo import osr
+import numpy
+import pygeoprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import tiled_convolution  # noqa: E402
+
+_PIXEL_SIZE = (0.01, -0.01)
+_ORIGIN = (-10.0, 60.0)
+
+
+def _projection_wkt(epsg_code):
+    """WKT of an EPSG projection."""
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(epsg_code)
+    return srs.ExportToWkt()
+
+
+class ConvolveStackGridTests(unittest.TestCase):
+    """Rasters that aren't on the signal grid are rejected."""
+
+    def setUp(self):
+        self.workspace_dir = tempfile.mkdtemp()
+        self.base_path = self._make_raster('base.tif')
+
+    def tearDown(self):
+        shutil.rmtree(self.workspace_dir)
+
+    def _make_raster(
+            self, basename, origin=_ORIGIN, pixel_size=_PIXEL_SIZE,
+            epsg_code=4326):
+        """Write a 20x30 raster of ones and return its path."""
+        raster_path = os.path.join(self.workspace_dir, basename)
+        pygeoprocessing.numpy_array_to_raster(
+            numpy.ones((20, 30), dtype=numpy.float32), -1, pixel_size,
+            origin, _projection_wkt(epsg_code), raster_path)
+        return raster_path
+
+    def _convolve(self, base_path_list, post_op_path_list=()):
+        """Convolve a stack, optionally passing rasters to a post op."""
+        target_path_list = [
+            os.path.join(self.workspace_dir, f'target_{index}.tif')
+            for index in range(len(base_path_list))]
+        tiled_convolution.convolve_stack_by_latitude_band(
+            [(path, 1) for path in base_path_list], 2000.0,
+            target_path_list, n_threads=1,
+            post_op=(lambda array, *post_array_list: array),
+            post_op_raster_path_band_list=[
+                (path, 1) for path in post_op_path_list])
+
+    def test_same_grid(self):
+        """Rasters on one grid convolve without error."""
+        other_path = self._make_raster('other.tif')
+        self._convolve([self.base_path, other_path], [other_path])
+
+    def test_shifted_origin(self):
+        """A same sized raster shifted by a pixel raises."""
+        shifted_path = self._make_raster(
+            'shifted.tif', origin=(_ORIGIN[0] + _PIXEL_SIZE[0], _ORIGIN[1]))
+        with self.assertRaises(ValueError):
+            self._convolve([self.base_path, shifted_path])
+        with self.assertRaises(ValueError):
+            self._convolve([self.base_path], [shifted_path])
+
+    def test_different_pixel_size(self):
+        """A same sized raster with another pixel size raises."""
+        coarse_path = self._make_raster(
+            'coarse.tif', pixel_size=(0.02, -0.02))
+        with self.assertRaises(ValueError):
+            self._convolve([self.base_path, coarse_path])
+
+    def test_different_projection(self):
+        """A same sized raster in another projection raises."""
+        projected_path = self._make_raster('projected.tif', epsg_code=3857)
+        with self.assertRaises(ValueError):
+            self._convolve([self.base_path, projected_path])
+        with self.assertRaises(ValueError):
+            self._convolve([self.base_path], [projected_path])
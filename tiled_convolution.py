@@ -0,0 +1,399 @@
+"""Tiled, threaded convolution of rasters too large to hold in memory.
+
+Rasters are processed in tiles padded by a halo of half the kernel size
+and only the target raster is written. Lat/lng rasters can be convolved in
+latitude bands so each band uses a kernel sized for its own latitude.
+"""
+import concurrent.futures
+import functools
+import logging
+import multiprocessing
+
+from osgeo import gdal
+from osgeo import osr
+import numpy
+import pygeoprocessing
+import scipy.fft
+
+import convolution_kernels
+
+LOGGER = logging.getLogger(__name__)
+
+# rows per latitude band and columns per tile
+_BAND_HEIGHT = 256
+_TILE_WIDTH = 2048
+# kernels are sized no further poleward than this so their width is bounded
+_MAX_KERNEL_LATITUDE = 85.0
+# padded kernel transforms kept per convolution
+_MAX_CACHED_KERNEL_FFTS = 16
+
+
+def iter_tile_results(executor, tile_func, arg_tuple, tile_list, max_pending):
+    """Run a tile function over tiles and yield results as they finish.
+
+    Args:
+        executor (concurrent.futures.Executor): executor to submit to.
+        tile_func (callable): called as ``tile_func(*arg_tuple, tile)``.
+        arg_tuple (tuple): leading arguments of ``tile_func``.
+        tile_list (list): last argument of ``tile_func`` for each tile,
+            usually an offset dict.
+        max_pending (int): maximum number of tiles in flight so finished
+            tiles don't pile up in memory.
+
+    Yields:
+        (tile, result) tuples in completion order.
+
+    """
+    pending_set = set()
+    for tile in tile_list:
+        if len(pending_set) >= max_pending:
+            done_set, pending_set = concurrent.futures.wait(
+                pending_set, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done_set:
+                yield future.tile, future.result()
+        future = executor.submit(tile_func, *arg_tuple, tile)
+        future.tile = tile
+        pending_set.add(future)
+    for future in concurrent.futures.wait(pending_set)[0]:
+        yield future.tile, future.result()
+
+
+def read_padded_tile(
+        band, tile_offset, y_halo, x_halo, nodata, pre_op=None):
+    """Read a tile plus halo, zero and invalidate anything off the raster.
+
+    Args:
+        band (gdal.Band): band to read from.
+        tile_offset (dict): tile window with 'xoff', 'yoff', 'win_xsize' and
+            'win_ysize'.
+        y_halo, x_halo (int): rows and columns of padding on each side.
+        nodata (float): nodata value of ``band``, may be None.
+        pre_op (callable): if not None called on the array as read,
+            including the halo, and its result used as the signal.
+
+    Returns:
+        (padded_signal, padded_valid) float64 and bool arrays of shape
+        ``(win_ysize+2*y_halo, win_xsize+2*x_halo)``, nodata and non-finite
+        pixels are 0 in ``padded_signal``.
+
+    """
+    x_min = max(0, tile_offset['xoff']-x_halo)
+    y_min = max(0, tile_offset['yoff']-y_halo)
+    x_max = min(
+        band.XSize, tile_offset['xoff']+tile_offset['win_xsize']+x_halo)
+    y_max = min(
+        band.YSize, tile_offset['yoff']+tile_offset['win_ysize']+y_halo)
+    halo_array = band.ReadAsArray(
+        xoff=x_min, yoff=y_min, win_xsize=x_max-x_min,
+        win_ysize=y_max-y_min)
+    if pre_op is not None:
+        halo_array = pre_op(halo_array)
+
+    padded_shape = (
+        tile_offset['win_ysize']+2*y_halo, tile_offset['win_xsize']+2*x_halo)
+    padded_slice = (
+        slice(y_min-(tile_offset['yoff']-y_halo),
+              y_max-(tile_offset['yoff']-y_halo)),
+        slice(x_min-(tile_offset['xoff']-x_halo),
+              x_max-(tile_offset['xoff']-x_halo)))
+    valid_array = numpy.isfinite(halo_array)
+    if nodata is not None:
+        valid_array &= ~numpy.isclose(halo_array, nodata)
+    padded_valid = numpy.zeros(padded_shape, dtype=bool)
+    padded_valid[padded_slice] = valid_array
+    padded_signal = numpy.zeros(padded_shape)
+    padded_signal[padded_slice] = numpy.where(valid_array, halo_array, 0)
+    return padded_signal, padded_valid
+
+
+def _apply_op(op, op_args, array):
+    """Call ``op(array, *op_args)``."""
+    return op(array, *op_args)
+
+
+def _kernel_fft(kernel_list, band_index, fft_shape):
+    """Real FFT of a band's kernel zero padded to ``fft_shape``.
+
+    Args:
+        kernel_list (list): 2D kernel of each latitude band.
+        band_index (int): index of the band in ``kernel_list``.
+        fft_shape (tuple): padded transform shape.
+
+    Returns:
+        complex array from ``scipy.fft.rfft2``.
+
+    """
+    return scipy.fft.rfft2(kernel_list[band_index], s=fft_shape)
+
+
+def _convolve_stack_tile(
+        base_raster_path_band_list, nodata_list, ignore_nodata, mask_nodata,
+        target_nodata, pre_op, pre_op_args, post_op, post_op_args,
+        post_op_raster_path_band_list, kernel_list, kernel_fft_func,
+        band_tile):
+    """Convolve one tile of each signal raster and apply the stages.
+
+    Every signal is convolved with the same kernel transform and the
+    ``post_op`` rasters are read once for the whole stack.
+
+    Args:
+        base_raster_path_band_list (list): (path, band index) of the
+            signals.
+        nodata_list (list): nodata value of each signal, may be None.
+        ignore_nodata, mask_nodata, target_nodata, pre_op, pre_op_args,
+            post_op, post_op_args, post_op_raster_path_band_list: see
+            ``convolve_stack_by_latitude_band``.
+        kernel_list (list): odd sized 2D kernel of each latitude band.
+        kernel_fft_func (callable): cached ``_kernel_fft`` bound to
+            ``kernel_list``.
+        band_tile (tuple): (band_index, tile_offset) of the tile's
+            latitude band and its window.
+
+    Returns:
+        list of float32 tiles to write to the targets.
+
+    """
+    band_index, tile_offset = band_tile
+    kernel_array = kernel_list[band_index]
+    y_halo, x_halo = kernel_array.shape[0]//2, kernel_array.shape[1]//2
+    padded_shape = (
+        tile_offset['win_ysize']+2*y_halo, tile_offset['win_xsize']+2*x_halo)
+    fft_shape = tuple(
+        scipy.fft.next_fast_len(padded_size + kernel_size - 1, real=True)
+        for padded_size, kernel_size in zip(
+            padded_shape, kernel_array.shape))
+    kernel_fft = kernel_fft_func(band_index, fft_shape)
+    # the fully overlapped 'valid' part of the linear convolution
+    valid_slice = (
+        slice(kernel_array.shape[0]-1, padded_shape[0]),
+        slice(kernel_array.shape[1]-1, padded_shape[1]))
+
+    def _convolve(padded_array):
+        return scipy.fft.irfft2(
+            scipy.fft.rfft2(padded_array, s=fft_shape) * kernel_fft,
+            s=fft_shape)[valid_slice]
+
+    if pre_op is not None:
+        pre_op = functools.partial(_apply_op, pre_op, pre_op_args)
+    aligned_array_list = []
+    if post_op is not None:
+        for path, raster_band_index in post_op_raster_path_band_list:
+            raster = gdal.OpenEx(path, gdal.OF_RASTER)
+            aligned_array_list.append(
+                raster.GetRasterBand(raster_band_index).ReadAsArray(
+                    **tile_offset))
+            raster = None
+
+    result_list = []
+    for (path, raster_band_index), nodata in zip(
+            base_raster_path_band_list, nodata_list):
+        raster = gdal.OpenEx(path, gdal.OF_RASTER)
+        band = raster.GetRasterBand(raster_band_index)
+        padded_signal, padded_valid = read_padded_tile(
+            band, tile_offset, y_halo, x_halo, nodata, pre_op=pre_op)
+        band = None
+        raster = None
+
+        result = _convolve(padded_signal)
+        if ignore_nodata:
+            weight = _convolve(padded_valid.astype(numpy.float64))
+            # ignore FFT roundoff where no valid pixel is under the kernel
+            weighted_mask = weight > 1e-9 * kernel_array.sum()
+            result[weighted_mask] /= weight[weighted_mask]
+            result[~weighted_mask] = 0
+        if mask_nodata:
+            result[~padded_valid[
+                y_halo:y_halo+tile_offset['win_ysize'],
+                x_halo:x_halo+tile_offset['win_xsize']]] = target_nodata
+        if post_op is not None:
+            result = post_op(result, *aligned_array_list, *post_op_args)
+        result_list.append(result.astype(numpy.float32))
+    return result_list
+
+
+def _same_grid(raster_info, base_raster_info):
+    """True if two rasters share size, projection and pixel grid.
+
+    Geotransforms are compared to within a thousandth of a base pixel.
+
+    """
+    if (tuple(raster_info['raster_size']) !=
+            tuple(base_raster_info['raster_size'])):
+        return False
+    pixel_tolerance = 1e-3 * min(
+        abs(size) for size in base_raster_info['pixel_size'])
+    if not numpy.allclose(
+            raster_info['geotransform'], base_raster_info['geotransform'],
+            rtol=0, atol=pixel_tolerance):
+        return False
+    projection_wkt = raster_info['projection_wkt']
+    base_projection_wkt = base_raster_info['projection_wkt']
+    if projection_wkt == base_projection_wkt:
+        return True
+    if not projection_wkt or not base_projection_wkt:
+        return False
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(projection_wkt)
+    base_srs = osr.SpatialReference()
+    base_srs.ImportFromWkt(base_projection_wkt)
+    return bool(srs.IsSame(base_srs))
+
+
+def convolve_by_latitude_band(
+        base_raster_path_band, radius_meters, target_raster_path, **kwargs):
+    """Convolve a lat/lng raster with a disk sized per latitude band.
+
+    This is ``convolve_stack_by_latitude_band`` for a single raster.
+
+    Args:
+        base_raster_path_band (tuple): (path, band index) of a lat/lng
+            signal raster with square pixels.
+        radius_meters (float): radius of the disk kernel in meters.
+        target_raster_path (str): path to float32 target raster.
+        kwargs: optional arguments of ``convolve_stack_by_latitude_band``.
+
+    Returns:
+        None
+
+    """
+    convolve_stack_by_latitude_band(
+        [base_raster_path_band], radius_meters, [target_raster_path],
+        **kwargs)
+
+
+def convolve_stack_by_latitude_band(
+        base_raster_path_band_list, radius_meters, target_raster_path_list,
+        kernel_normalization='sum', ignore_nodata=False, mask_nodata=True,
+        target_nodata=-1, band_height=_BAND_HEIGHT, n_threads=None,
+        pre_op=None, pre_op_args=(), post_op=None, post_op_args=(),
+        post_op_raster_path_band_list=()):
+    """Convolve same grid lat/lng rasters with a disk sized per latitude band.
+
+    The rasters are split into bands of ``band_height`` rows. Each band is
+    convolved with ``convolution_kernels.wgs84_disk_coverage_kernel`` built
+    at the band's center latitude so distances are correct at any latitude
+    and kernels are no larger than their latitude needs. Bands are padded
+    by their kernel's halo and processed as tiles in a thread pool. Each
+    tile's kernel is transformed once and applied to every raster in the
+    stack.
+
+    Per pixel stages can be attached to the convolution so they run on each
+    tile in memory rather than as separate passes over whole rasters:
+    ``pre_op`` on the signal as read and ``post_op`` on the convolved tile
+    before it is written.
+
+    Nodata and non-finite signal pixels contribute 0 to the convolution.
+
+    Args:
+        base_raster_path_band_list (list): (path, band index) tuples of
+            lat/lng signal rasters with square pixels on the same grid.
+        radius_meters (float): radius of the disk kernel in meters.
+        target_raster_path_list (list): paths to float32 target rasters, one
+            per signal.
+        kernel_normalization (str): 'sum' to scale each kernel to sum to 1,
+            'max' to scale its largest value to 1 or None to leave it as
+            fractional pixel coverage.
+        ignore_nodata (bool): if True each pixel is divided by the kernel
+            weight of the valid pixels under it, so nodata and off-raster
+            pixels don't pull the result toward 0.
+        mask_nodata (bool): if True pixels that are nodata in the signal are
+            nodata in the target.
+        target_nodata (float): nodata value of the targets.
+        band_height (int): rows per latitude band.
+        n_threads (int): number of tiles to process at once, defaults to
+            the number of CPUs.
+        pre_op (callable): if not None, ``pre_op(signal_array,
+            *pre_op_args)`` is applied to each signal window as read and
+            must return an array of the same shape, nodata is tested on its
+            result.
+        pre_op_args (tuple): constant trailing arguments of ``pre_op``.
+        post_op (callable): if not None, ``post_op(convolved_array,
+            *aligned_arrays, *post_op_args)`` is applied to each convolved
+            tile and its result written to the target.
+        post_op_args (tuple): constant trailing arguments of ``post_op``.
+        post_op_raster_path_band_list (list): (path, band index) tuples of
+            rasters on the same grid as the signals whose tile windows are
+            passed to ``post_op`` after the convolved tile.
+
+    Returns:
+        None
+
+    """
+    if len(base_raster_path_band_list) != len(target_raster_path_list):
+        raise ValueError(
+            f'got {len(base_raster_path_band_list)} signal rasters but '
+            f'{len(target_raster_path_list)} target rasters')
+    base_raster_info = pygeoprocessing.get_raster_info(
+        base_raster_path_band_list[0][0])
+    geotransform = base_raster_info['geotransform']
+    pixel_size_degree = abs(base_raster_info['pixel_size'][0])
+    n_cols, n_rows = base_raster_info['raster_size']
+    if n_threads is None:
+        n_threads = multiprocessing.cpu_count()
+    nodata_list = []
+    for path, band_index in base_raster_path_band_list:
+        raster_info = pygeoprocessing.get_raster_info(path)
+        nodata_list.append(raster_info['nodata'][band_index-1])
+        if not _same_grid(raster_info, base_raster_info):
+            raise ValueError(
+                f'{path} is not on the same grid as '
+                f'{base_raster_path_band_list[0][0]}')
+    for path, _ in post_op_raster_path_band_list:
+        if not _same_grid(
+                pygeoprocessing.get_raster_info(path), base_raster_info):
+            raise ValueError(
+                f'{path} is not on the same grid as '
+                f'{base_raster_path_band_list[0][0]}')
+
+    for (path, _), target_raster_path in zip(
+            base_raster_path_band_list, target_raster_path_list):
+        pygeoprocessing.new_raster_from_base(
+            path, target_raster_path, gdal.GDT_Float32, [target_nodata])
+
+    kernel_list = []
+    band_tile_list = []
+    for yoff in range(0, n_rows, band_height):
+        win_ysize = min(band_height, n_rows-yoff)
+        center_lat = numpy.clip(
+            geotransform[3] + geotransform[5] * (yoff + win_ysize/2),
+            -_MAX_KERNEL_LATITUDE, _MAX_KERNEL_LATITUDE)
+        kernel_array = convolution_kernels.wgs84_disk_coverage_kernel(
+            radius_meters, pixel_size_degree, float(center_lat))
+        if kernel_normalization == 'sum':
+            kernel_array = kernel_array / kernel_array.sum()
+        elif kernel_normalization == 'max':
+            kernel_array = kernel_array / kernel_array.max()
+        kernel_list.append(kernel_array)
+        for xoff in range(0, n_cols, _TILE_WIDTH):
+            band_tile_list.append((len(kernel_list)-1, {
+                'xoff': xoff, 'yoff': yoff,
+                'win_xsize': min(_TILE_WIDTH, n_cols-xoff),
+                'win_ysize': win_ysize}))
+    LOGGER.info(
+        f'convolving {len(base_raster_path_band_list)} raster(s) in '
+        f'{(n_rows+band_height-1)//band_height} latitude bands')
+
+    # tiles run in band order so only the transforms of the bands in flight
+    # need to be kept
+    kernel_fft_func = functools.lru_cache(maxsize=_MAX_CACHED_KERNEL_FFTS)(
+        functools.partial(_kernel_fft, kernel_list))
+    target_raster_list = [
+        gdal.OpenEx(path, gdal.OF_RASTER | gdal.OF_UPDATE)
+        for path in target_raster_path_list]
+    target_band_list = [
+        raster.GetRasterBand(1) for raster in target_raster_list]
+    with concurrent.futures.ThreadPoolExecutor(n_threads) as executor:
+        for (_, tile_offset), tile_array_list in iter_tile_results(
+                executor, _convolve_stack_tile,
+                (base_raster_path_band_list, nodata_list, ignore_nodata,
+                 mask_nodata, target_nodata, pre_op, pre_op_args, post_op,
+                 post_op_args, post_op_raster_path_band_list, kernel_list,
+                 kernel_fft_func),
+                band_tile_list, 2*n_threads):
+            for target_band, tile_array in zip(
+                    target_band_list, tile_array_list):
+                target_band.WriteArray(
+                    tile_array, xoff=tile_offset['xoff'],
+                    yoff=tile_offset['yoff'])
+    target_band_list = None
+    target_raster_list = None
@@ -2,12 +2,18 @@
 import argparse
 import datetime
 import glob
+import hashlib
 import logging
+import multiprocessing
 import os
 import sys
 
 from osgeo import gdal
 import ecoshard.geoprocessing as pygeoprocessing
+from ecoshard import taskgraph
+import numpy
+
+import zone_utils
 
 logging.basicConfig(
     level=logging.DEBUG,
@@ -20,6 +26,250 @@ LOGGER = logging.getLogger(__name__)
 logging.getLogger('taskgraph').setLevel(logging.INFO)
 
 WORKSPACE_DIR = 'zonal_stats_workspace'
+STAT_LIST = ['count', 'max', 'min', 'nodata_count', 'sum']
+
+
+def calculate_zone_stats(
+        zone_raster_path, zone_vector_path, value_raster_path, n_fids):
+    """Sweep a value raster against a zone raster on the same grid.
+
+    Features too small to cover any pixel center get the stats of the
+    pixels under their bounding box, as ``pygeoprocessing.zonal_statistics``
+    does.
+
+    Args:
+        zone_raster_path (str): raster created by
+            ``zone_utils.rasterize_zones``.
+        zone_vector_path (str): vector created by
+            ``zone_utils.build_zone_vector``.
+        value_raster_path (str): raster to summarize, on the same grid as
+            ``zone_raster_path``.
+        n_fids (int): one more than the largest FID in the zones.
+
+    Returns:
+        dict mapping each of STAT_LIST to an array indexed by FID.
+
+    """
+    value_nodata = pygeoprocessing.get_raster_info(
+        value_raster_path)['nodata'][0]
+    stats = {
+        'count': numpy.zeros(n_fids, dtype=numpy.int64),
+        'nodata_count': numpy.zeros(n_fids, dtype=numpy.int64),
+        'sum': numpy.zeros(n_fids, dtype=numpy.float64),
+        'min': numpy.full(n_fids, numpy.inf),
+        'max': numpy.full(n_fids, -numpy.inf),
+    }
+
+    def _accumulate(fid_array, value_array):
+        """Add the pixels of ``value_array`` to the stats of their FID."""
+        if value_nodata is not None:
+            nodata_mask = numpy.isclose(value_array, value_nodata)
+        else:
+            nodata_mask = numpy.zeros(value_array.shape, dtype=bool)
+        stats['nodata_count'] += numpy.bincount(
+            fid_array[nodata_mask], minlength=n_fids)
+        fid_array = fid_array[~nodata_mask]
+        value_array = value_array[~nodata_mask].astype(numpy.float64)
+        stats['count'] += numpy.bincount(fid_array, minlength=n_fids)
+        stats['sum'] += numpy.bincount(
+            fid_array, weights=value_array, minlength=n_fids)
+        numpy.minimum.at(stats['min'], fid_array, value_array)
+        numpy.maximum.at(stats['max'], fid_array, value_array)
+
+    zone_raster = gdal.OpenEx(zone_raster_path, gdal.OF_RASTER)
+    zone_band_list = [
+        zone_raster.GetRasterBand(band_index+1)
+        for band_index in range(zone_raster.RasterCount)]
+    for offset_dict, value_block in pygeoprocessing.iterblocks(
+            (value_raster_path, 1)):
+        for zone_band in zone_band_list:
+            zone_block = zone_band.ReadAsArray(**offset_dict)
+            zone_mask = zone_block != zone_utils.ZONE_NODATA
+            _accumulate(zone_block[zone_mask], value_block[zone_mask])
+    zone_band_list = None
+    zone_raster = None
+
+    covered_mask = (stats['count'] + stats['nodata_count']) > 0
+    value_raster = gdal.OpenEx(value_raster_path, gdal.OF_RASTER)
+    value_band = value_raster.GetRasterBand(1)
+    inv_gt = gdal.InvGeoTransform(value_raster.GetGeoTransform())
+    zone_vector = gdal.OpenEx(zone_vector_path, gdal.OF_VECTOR)
+    zone_layer = zone_vector.GetLayer()
+    for zone_feature in zone_layer:
+        fid = zone_feature.GetField('zone_fid')
+        if covered_mask[fid]:
+            continue
+        min_x, max_x, min_y, max_y = (
+            zone_feature.GetGeometryRef().GetEnvelope())
+        x_a, y_a = gdal.ApplyGeoTransform(inv_gt, min_x, max_y)
+        x_b, y_b = gdal.ApplyGeoTransform(inv_gt, max_x, min_y)
+        xoff = max(0, int(numpy.floor(min(x_a, x_b))))
+        yoff = max(0, int(numpy.floor(min(y_a, y_b))))
+        win_xsize = min(
+            value_band.XSize, int(numpy.ceil(max(x_a, x_b)))) - xoff
+        win_ysize = min(
+            value_band.YSize, int(numpy.ceil(max(y_a, y_b)))) - yoff
+        if win_xsize <= 0 or win_ysize <= 0:
+            continue
+        value_window = value_band.ReadAsArray(
+            xoff=xoff, yoff=yoff, win_xsize=win_xsize,
+            win_ysize=win_ysize).ravel()
+        _accumulate(
+            numpy.full(value_window.shape, fid, dtype=numpy.int64),
+            value_window)
+    zone_layer = None
+    zone_vector = None
+    value_band = None
+    value_raster = None
+    return stats
+
+
+def _get_fid_to_field_value(vector_path, field_name, fid_list):
+    """Map each FID in ``fid_list`` to its ``field_name`` value."""
+    fid_array, value_list = zone_utils.read_field_values(
+        vector_path, field_name)
+    fid_to_field_val = dict(zip(fid_array.tolist(), value_list))
+    return {fid: fid_to_field_val[fid] for fid in fid_list}
+
+
+def _stat_columns(stats, prefix=''):
+    """Build STAT_LIST and mean columns from per feature stat arrays.
+
+    ``min``, ``max`` and ``mean`` are NaN for features with no valid
+    pixels.
+
+    """
+    count = numpy.asarray(stats['count'])
+    column_list = []
+    for stat in STAT_LIST:
+        values = numpy.asarray(stats[stat], dtype=numpy.float64 if stat in (
+            'min', 'max', 'sum') else numpy.int64)
+        if stat in ('min', 'max'):
+            values = numpy.where(count > 0, values, numpy.nan)
+        column_list.append((f'{prefix}{stat}', values))
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        mean = numpy.where(
+            count > 0, numpy.asarray(stats['sum']) / count, numpy.nan)
+    column_list.append((f'{prefix}mean', mean))
+    return column_list
+
+
+def _time_str():
+    """Return the current UTC time formatted for a filename."""
+    return str(datetime.datetime.utcnow()).replace(
+        '-', '_').replace(':', '_').replace('.', '_').replace(' ', '_')
+
+
+def wide_zonal_stats(
+        raster_path_list, vector_path, field_name, polygons_overlap,
+        n_workers, table_format='csv'):
+    """Summarize many rasters under a vector with one rasterization per grid.
+
+    The vector is burnt once into a cached zone FID raster for each
+    distinct grid among the rasters (a band per group of non-overlapping
+    features), then every raster is swept against its grid's zone raster
+    in parallel.
+
+    Args:
+        raster_path_list (list): paths to rasters to summarize.
+        vector_path (str): path to aggregate vector in the same projection
+            as the rasters.
+        field_name (str): if not None, also report this vector field.
+        polygons_overlap (bool): set if polygons may overlap.
+        n_workers (int): number of parallel workers.
+        table_format (str): either 'csv' or 'parquet'.
+
+    Returns:
+        path to a table with a row per feature and a column per raster stat.
+
+    """
+    working_dir = os.path.join(WORKSPACE_DIR, 'zonal_stats')
+    os.makedirs(working_dir, exist_ok=True)
+    task_graph = taskgraph.TaskGraph(working_dir, n_workers, 15.0)
+
+    vector_basename = os.path.basename(os.path.splitext(vector_path)[0])
+    zone_vector_path = os.path.join(
+        working_dir,
+        f'zones_{vector_basename}'
+        f'{"_overlap" if polygons_overlap else ""}.gpkg')
+    zone_vector_task = task_graph.add_task(
+        func=zone_utils.build_zone_vector,
+        args=(vector_path, polygons_overlap, zone_vector_path),
+        target_path_list=[zone_vector_path],
+        store_result=True,
+        task_name=f'build zones for {vector_path}')
+    n_groups = zone_vector_task.get()
+
+    zone_vector = gdal.OpenEx(zone_vector_path, gdal.OF_VECTOR)
+    zone_layer = zone_vector.GetLayer()
+    fid_list = sorted(
+        zone_feature.GetField('zone_fid') for zone_feature in zone_layer)
+    zone_layer = None
+    zone_vector = None
+    n_fids = fid_list[-1] + 1 if fid_list else 0
+
+    grid_to_zone_task_map = {}
+    stats_task_list = []
+    for raster_path in raster_path_list:
+        raster_info = pygeoprocessing.get_raster_info(raster_path)
+        grid_key = (
+            raster_info['projection_wkt'],
+            tuple(raster_info['geotransform']),
+            tuple(raster_info['raster_size']))
+        if grid_key not in grid_to_zone_task_map:
+            grid_hash = hashlib.sha1(
+                str(grid_key).encode('utf-8')).hexdigest()[:12]
+            zone_raster_path = os.path.join(
+                working_dir,
+                f'{os.path.splitext(os.path.basename(zone_vector_path))[0]}'
+                f'_{grid_hash}.tif')
+            grid_to_zone_task_map[grid_key] = (
+                zone_raster_path, task_graph.add_task(
+                    func=zone_utils.rasterize_zones,
+                    args=(
+                        zone_vector_path, n_groups, raster_path,
+                        zone_raster_path),
+                    target_path_list=[zone_raster_path],
+                    dependent_task_list=[zone_vector_task],
+                    task_name=f'rasterize zones {zone_raster_path}'))
+        zone_raster_path, zone_raster_task = grid_to_zone_task_map[grid_key]
+        stats_task_list.append((raster_path, task_graph.add_task(
+            func=calculate_zone_stats,
+            args=(
+                zone_raster_path, zone_vector_path, raster_path, n_fids),
+            store_result=True,
+            dependent_task_list=[zone_raster_task],
+            task_name=f'zonal stats {raster_path}')))
+
+    # read the field while the sweeps run
+    fid_to_field_val = {}
+    if field_name:
+        fid_to_field_val = _get_fid_to_field_value(
+            vector_path, field_name, fid_list)
+
+    table_path = os.path.join(
+        WORKSPACE_DIR,
+        f'{vector_basename}_wide_{_time_str()}.{table_format}')
+    raster_stats_list = [
+        (os.path.basename(os.path.splitext(raster_path)[0]),
+         stats_task.get())
+        for raster_path, stats_task in stats_task_list]
+    task_graph.join()
+    task_graph.close()
+
+    LOGGER.info(f'building table at {table_path}')
+    fid_array = numpy.array(fid_list, dtype=numpy.int64)
+    column_list = [('fid', fid_array)]
+    if field_name:
+        column_list.append((
+            field_name, [fid_to_field_val[fid] for fid in fid_list]))
+    for basename, stats in raster_stats_list:
+        column_list.extend(_stat_columns(
+            {stat: stats[stat][fid_array] for stat in STAT_LIST},
+            prefix=f'{basename}_'))
+    zone_utils.write_table(table_path, column_list)
+    return table_path
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='mult by columns script')
@@ -39,50 +289,55 @@ if __name__ == '__main__':
         '--polygons_overlap', action='store_true', help=(
             'set if polygons overlap and need zonal_statistics to be '
             'calculated individually for each'))
+    parser.add_argument(
+        '--wide_table', action='store_true', help=(
+            'rasterize the vector once per distinct raster grid and write '
+            'the stats of every matching raster to a single table'))
+    parser.add_argument(
+        '--n_workers', type=int, default=multiprocessing.cpu_count(),
+        help='number of rasters to summarize in parallel with --wide_table')
+    parser.add_argument(
+        '--table_format', choices=['csv', 'parquet'], default='csv',
+        help='format of the output table, parquet needs pyarrow')
     args = parser.parse_args()
 
     LOGGER.info(
         f'calculating zonal stats for {args.raster_pattern} '
         f'on {args.vector_path}')
-    working_dir = os.path.join(WORKSPACE_DIR, 'zonal_stats')
-    os.makedirs(working_dir, exist_ok=True)
-    for raster_path in glob.glob(args.raster_pattern):
-        basename = os.path.basename(os.path.splitext(raster_path)[0])
-        stat_dict = pygeoprocessing.zonal_statistics(
-            (raster_path, 1), args.vector_path,
-            working_dir=working_dir,
-            clean_working_dir=not args.keep_working_dir,
-            polygons_might_overlap=args.polygons_overlap)
-        fid_to_field_val = {}
-        if args.field_name:
-            vector = gdal.OpenEx(args.vector_path, gdal.OF_VECTOR)
-            layer = vector.GetLayer()
-            fid_to_field_val = {
-                fid: layer.GetFeature(fid).GetField(args.field_name)
-                for fid in stat_dict
-            }
-            layer = None
-            vector = None
-        time_str = str(datetime.datetime.utcnow()).replace(
-            '-', '_').replace(':', '_').replace('.', '_').replace(' ', '_')
-        stat_list = ['count', 'max', 'min', 'nodata_count', 'sum']
-        table_path = os.path.join(WORKSPACE_DIR, f'{basename}_{time_str}.csv')
-        LOGGER.info(f'building table at {table_path}')
-        with open(table_path, 'w') as table_file:
-            table_file.write(f'{raster_path}\n{args.vector_path}\n')
-            table_file.write('fid,')
-            if args.field_name:
-                table_file.write(f'{args.field_name},')
-            table_file.write(f'{",".join(stat_list)},mean\n')
-            for fid, stats in stat_dict.items():
-                table_file.write(f'{fid},')
-                if args.field_name:
-                    table_file.write(f'{fid_to_field_val[fid]},')
-                for stat in stat_list:
-                    table_file.write(f'{stats[stat]},')
-                if stats['count'] > 0:
-                    table_file.write(f'{stats["sum"]/stats["count"]}')
-                else:
-                    table_file.write(f'NaN')
-                table_file.write('\n')
+    if args.wide_table:
+        table_path = wide_zonal_stats(
+            sorted(glob.glob(args.raster_pattern)), args.vector_path,
+            args.field_name, args.polygons_overlap, args.n_workers,
+            table_format=args.table_format)
         LOGGER.info(f'all done, table at {table_path}')
+    else:
+        working_dir = os.path.join(WORKSPACE_DIR, 'zonal_stats')
+        os.makedirs(working_dir, exist_ok=True)
+        for raster_path in glob.glob(args.raster_pattern):
+            basename = os.path.basename(os.path.splitext(raster_path)[0])
+            stat_dict = pygeoprocessing.zonal_statistics(
+                (raster_path, 1), args.vector_path,
+                working_dir=working_dir,
+                clean_working_dir=not args.keep_working_dir,
+                polygons_might_overlap=args.polygons_overlap)
+            fid_list = list(stat_dict)
+            column_list = [('fid', numpy.array(fid_list, dtype=numpy.int64))]
+            if args.field_name:
+                fid_to_field_val = _get_fid_to_field_value(
+                    args.vector_path, args.field_name, fid_list)
+                column_list.append((
+                    args.field_name,
+                    [fid_to_field_val[fid] for fid in fid_list]))
+            column_list.extend(_stat_columns({
+                stat: [
+                    numpy.nan if stat_dict[fid][stat] is None
+                    else stat_dict[fid][stat] for fid in fid_list]
+                for stat in STAT_LIST}))
+            table_path = os.path.join(
+                WORKSPACE_DIR,
+                f'{basename}_{_time_str()}.{args.table_format}')
+            LOGGER.info(f'building table at {table_path}')
+            zone_utils.write_table(
+                table_path, column_list,
+                header_line_list=[raster_path, args.vector_path])
+            LOGGER.info(f'all done, table at {table_path}')
@@ -1,13 +1,14 @@
 """Calculate real area of raster mask under polygon."""
 import argparse
 import logging
-import math
 import os
 import sys
 
 from osgeo import gdal
 import pygeoprocessing
 import numpy
+import pixel_area
+import zone_utils
 
 gdal.SetCacheMax(2**28)
 
@@ -24,61 +25,65 @@ WORKSPACE_DIR = 'zonal_stats_workspace'
 os.makedirs(WORKSPACE_DIR, exist_ok=True)
 
 
-def _area_of_pixel_km2(pixel_size, center_lat):
-    """Calculate km^2 area of a wgs84 square pixel.
+def area_weighted_zonal_stats(
+        raster_path, zone_raster_path, n_fids, lat_area_km2):
+    """Sum pixel area and value*area per zone in one pass.
 
-    Adapted from: https://gis.stackexchange.com/a/127327/2397
-
-    Parameters:
-        pixel_size (float): length of side of pixel in degrees.
-        center_lat (float): latitude of the center of the pixel. Note this
-            value +/- half the `pixel-size` must not exceed 90/-90 degrees
-            latitude or an invalid area will be calculated.
+    Args:
+        raster_path (str): path to value raster.
+        zone_raster_path (str): zone FID raster on the same grid as
+            ``raster_path``, see ``zone_utils.rasterize_zones``.
+        n_fids (int): one more than the largest zone FID.
+        lat_area_km2 (numpy.ndarray): (n_rows, 1) km^2 area of a pixel in
+            each row of ``raster_path``, broadcast across each block.
 
     Returns:
-        Area of square pixel of side length `pixel_size` centered at
-        `center_lat` in km^2.
+        dict of 'pixel_count', 'nodata_count', 'area_km2' and 'weighted_sum'
+        arrays indexed by FID, where 'area_km2' is the real area of the
+        valid pixels and 'weighted_sum' is the sum of value*area over them.
 
     """
-    a = 6378137  # meters
-    b = 6356752.3142  # meters
-    e = math.sqrt(1 - (b/a)**2)
-    area_list = []
-    for f in [center_lat+pixel_size/2, center_lat-pixel_size/2]:
-        zm = 1 - e*math.sin(math.radians(f))
-        zp = 1 + e*math.sin(math.radians(f))
-        area_list.append(
-            math.pi * b**2 * (
-                math.log(zp/zm) / (2*e) +
-                math.sin(math.radians(f)) / (zp*zm)))
-    # mult by 1e-6 to convert m^2 to km^2
-    return pixel_size / 360. * (area_list[0] - area_list[1]) * 1e-6
-
-
-def _get_area_column(raster_info):
-    # create lat/lng area column
-    n_cols, n_rows = raster_info['raster_size']
-    gt = raster_info['geotransform']
-
-    lat_area_km2 = numpy.empty(shape=(n_rows, 1))
-    for row_index in range(n_rows):
-        _, lat_a = gdal.ApplyGeoTransform(gt, 0, row_index)
-        _, lat_b = gdal.ApplyGeoTransform(gt, 0, row_index+1)
-        lat_center = (lat_a+lat_b)/2.0
-        lat_area_km2[row_index][0] = _area_of_pixel_km2(
-            raster_info['pixel_size'][0], lat_center)
-    return lat_area_km2
-
-
-def _mult_by_mask_op(base_array, area_array, base_nodata):
-    # mult base by array but keep nodata
-    if base_nodata is not None:
-        valid_mask = base_array != base_nodata
-    else:
-        valid_mask = numpy.ones(base_array.shape, dtype=bool)
-    result = numpy.full(base_array.shape, -1, dtype=numpy.float32)
-    result[valid_mask] = base_array[valid_mask] * area_array[valid_mask]
-    return result
+    nodata = pygeoprocessing.get_raster_info(raster_path)['nodata'][0]
+    stats = {
+        'pixel_count': numpy.zeros(n_fids, dtype=numpy.int64),
+        'nodata_count': numpy.zeros(n_fids, dtype=numpy.int64),
+        'area_km2': numpy.zeros(n_fids, dtype=numpy.float64),
+        'weighted_sum': numpy.zeros(n_fids, dtype=numpy.float64),
+    }
+    zone_raster = gdal.OpenEx(zone_raster_path, gdal.OF_RASTER)
+    zone_band_list = [
+        zone_raster.GetRasterBand(band_index+1)
+        for band_index in range(zone_raster.RasterCount)]
+    for offset_dict, value_block in pygeoprocessing.iterblocks(
+            (raster_path, 1)):
+        if nodata is not None:
+            valid_mask = value_block != nodata
+        else:
+            valid_mask = numpy.ones(value_block.shape, dtype=bool)
+        area_block = numpy.broadcast_to(
+            lat_area_km2[
+                offset_dict['yoff']:
+                offset_dict['yoff']+offset_dict['win_ysize']],
+            value_block.shape)
+        for zone_band in zone_band_list:
+            zone_block = zone_band.ReadAsArray(**offset_dict)
+            zone_mask = zone_block != zone_utils.ZONE_NODATA
+            stats['nodata_count'] += numpy.bincount(
+                zone_block[zone_mask & ~valid_mask], minlength=n_fids)
+            zone_valid_mask = zone_mask & valid_mask
+            fid_array = zone_block[zone_valid_mask]
+            area_array = area_block[zone_valid_mask]
+            stats['pixel_count'] += numpy.bincount(
+                fid_array, minlength=n_fids)
+            stats['area_km2'] += numpy.bincount(
+                fid_array, weights=area_array, minlength=n_fids)
+            stats['weighted_sum'] += numpy.bincount(
+                fid_array, weights=(
+                    value_block[zone_valid_mask] * area_array),
+                minlength=n_fids)
+    zone_band_list = None
+    zone_raster = None
+    return stats
 
 
 def main():
@@ -87,38 +92,71 @@ def main():
         description='Calculate real area of raster mask under polygon.')
     parser.add_argument('raster_path', help='Raster path')
     parser.add_argument('vector_path', help='Vector path')
+    parser.add_argument(
+        '--polygons_overlap', action='store_true',
+        help='set if polygons overlap each other')
     args = parser.parse_args()
 
     raster_info = pygeoprocessing.get_raster_info(args.raster_path)
-    # create a masked area raster
-    lat_area_km2 = _get_area_column(raster_info)
-    masked_area_raster_path = os.path.join(
-        WORKSPACE_DIR, f'area_km_{os.path.basename(args.raster_path)}')
-    LOGGER.debug(lat_area_km2)
-    pygeoprocessing.raster_calculator(
-        [(args.raster_path, 1), lat_area_km2,
-         (raster_info['nodata'][0], 'raw')], _mult_by_mask_op,
-        masked_area_raster_path, gdal.GDT_Float32, -1)
+    # mult by 1e-6 to convert m^2 to km^2
+    lat_area_km2 = pixel_area.area_column(
+        raster_info['geotransform'], raster_info['raster_size'][1]) * 1e-6
+
+    # keep the input FIDs, the reprojected GPKG renumbers its features
+    vector_basename = os.path.splitext(os.path.basename(args.vector_path))[0]
+    source_fid_vector_path = os.path.join(
+        WORKSPACE_DIR, f'source_fid_{vector_basename}.gpkg')
+    zone_utils.copy_with_source_fid(args.vector_path, source_fid_vector_path)
 
     # mask lat/lng area column by raster_path
     projected_vector_path = os.path.join(
-        WORKSPACE_DIR, f'projected_{os.path.basename(args.vector_path)}')
+        WORKSPACE_DIR, f'projected_{vector_basename}.gpkg')
 
     pygeoprocessing.reproject_vector(
-        args.vector_path, raster_info['projection_wkt'],
+        source_fid_vector_path, raster_info['projection_wkt'],
         projected_vector_path, driver_name='GPKG', copy_fields=True)
 
+    basename = os.path.basename(os.path.splitext(args.raster_path)[0])
+    zone_vector_path = os.path.join(WORKSPACE_DIR, f'zones_{basename}.gpkg')
+    n_groups = zone_utils.build_zone_vector(
+        projected_vector_path, args.polygons_overlap, zone_vector_path)
+    zone_raster_path = os.path.join(WORKSPACE_DIR, f'zones_{basename}.tif')
+    zone_utils.rasterize_zones(
+        zone_vector_path, n_groups, args.raster_path, zone_raster_path)
+    fid_array = numpy.array(
+        zone_utils.read_field_values(zone_vector_path, 'zone_fid')[1],
+        dtype=numpy.int64)
+    n_fids = fid_array.max() + 1 if fid_array.size else 0
+
     # * proportional area in terms of real area of 1 vs non-1 under each polygon
     # * # of pixels
-
-    # base stats
-    stats = pygeoprocessing.zonal_statistics(
-        (args.raster_path, 1), projected_vector_path,
-        polygons_might_overlap=False, working_dir='.')
-
-    # area stats
-
-    LOGGER.debug(stats)
+    stats = area_weighted_zonal_stats(
+        args.raster_path, zone_raster_path, n_fids, lat_area_km2)
+
+    fid_array.sort()
+    projected_fid_array, source_fid_list = zone_utils.read_field_values(
+        projected_vector_path, zone_utils.SOURCE_FID_FIELD)
+    projected_to_source_fid = dict(zip(
+        projected_fid_array.tolist(), source_fid_list))
+    source_fid_array = numpy.array(
+        [projected_to_source_fid[fid] for fid in fid_array.tolist()],
+        dtype=numpy.int64)
+    area_km2 = stats['area_km2'][fid_array]
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        weighted_mean = numpy.where(
+            area_km2 > 0, stats['weighted_sum'][fid_array] / area_km2,
+            numpy.nan)
+    table_path = os.path.join(WORKSPACE_DIR, f'area_stats_{basename}.csv')
+    LOGGER.info(f'writing area stats to {table_path}')
+    zone_utils.write_table(
+        table_path, [
+            ('fid', source_fid_array),
+            ('pixel_count', stats['pixel_count'][fid_array]),
+            ('nodata_count', stats['nodata_count'][fid_array]),
+            ('area_km2', area_km2),
+            ('area_weighted_sum', stats['weighted_sum'][fid_array]),
+            ('area_weighted_mean', weighted_mean),
+        ], header_line_list=[args.raster_path, args.vector_path])
 
 
 if __name__ == '__main__':
@@ -25,65 +25,175 @@ LOGGER = logging.getLogger(__name__)
 logging.getLogger('ecoshard.taskgraph').setLevel(logging.INFO)
 
 
-def get_unique_values(raster_path):
-    """Return a list of non-nodata unique values from `raster_path`."""
-    nodata = geoprocessing.get_raster_info(raster_path)['nodata'][0]
-    unique_set = set()
+def get_unique_values(raster_path, max_unique_values=None):
+    """Find the non-nodata unique values of `raster_path`.
+
+    Small integer types are tracked in a presence bitmap over the whole type
+    range, anything else is accumulated as a sorted array with
+    ``numpy.union1d``. Either way the scan stops as soon as more than
+    ``max_unique_values`` distinct values have been seen.
+
+    Args:
+        raster_path (str): path to a single band raster.
+        max_unique_values (int): if not None, stop scanning once there are
+            more distinct values than this.
+
+    Returns:
+        (unique_array, overflow) tuple where ``unique_array`` is a sorted
+        numpy array of the values seen and ``overflow`` is True if the scan
+        stopped early because of ``max_unique_values``.
+
+    """
+    raster_info = geoprocessing.get_raster_info(raster_path)
+    nodata = raster_info['nodata'][0]
+    dtype = numpy.dtype(raster_info['numpy_type'])
+    use_bitmap = (
+        numpy.issubdtype(dtype, numpy.integer) and dtype.itemsize <= 2)
+    if use_bitmap:
+        type_min = int(numpy.iinfo(dtype).min)
+        seen_bitmap = numpy.zeros(
+            int(numpy.iinfo(dtype).max) - type_min + 1, dtype=bool)
+    else:
+        unique_array = numpy.empty(0, dtype=dtype)
     for offset_data, array in geoprocessing.iterblocks((raster_path, 1)):
         if nodata is not None:
-            valid_mask = array != nodata
-            unique_set |= set(numpy.unique(array[valid_mask]))
+            array = array[array != nodata]
+        if numpy.issubdtype(dtype, numpy.floating):
+            array = array[~numpy.isnan(array)]
+        if use_bitmap:
+            seen_bitmap[array.astype(numpy.int32) - type_min] = True
+            n_unique = numpy.count_nonzero(seen_bitmap)
         else:
-            unique_set |= set(numpy.unique(array))
-    return unique_set
-
-
-def mask_out_op(mask_data, base_data, mask_code, base_nodata):
-    """Return 1 where base data == mask_code, 0 or nodata othewise."""
-    result = numpy.empty_like(base_data)
-    result[:] = base_nodata
-    valid_mask = (mask_data == mask_code) & (~numpy.isnan(base_data))
-    result[valid_mask] = base_data[valid_mask]
-    return result
-
-
-def _calculate_stats(
-        aligned_raster_path_list, mask_code, other_raster_info,
-        masked_raster_path):
-    LOGGER.debug(f'_calculate_stats for {masked_raster_path}')
-    geoprocessing.raster_calculator(
-        [(aligned_raster_path_list[0], 1), (aligned_raster_path_list[1], 1),
-         (mask_code, 'raw'), (other_raster_info['nodata'][0], 'raw')],
-        mask_out_op, masked_raster_path, gdal.GDT_Float32,
-        other_raster_info['nodata'][0])
-    masked_raster = gdal.OpenEx(masked_raster_path, gdal.OF_RASTER)
-    masked_band = masked_raster.GetRasterBand(1)
-    (raster_min, raster_max, raster_mean, raster_stdev) = (
-        masked_band.GetStatistics(0, 1))
-    value_nodata = other_raster_info['nodata'][0]
-    masked_band = None
-    masked_raster = None
-
-    LOGGER.debug(f'getting stats for {masked_raster_path}')
-    nodata_count = 0
-    valid_count = 0
-    value_raster = gdal.OpenEx(aligned_raster_path_list[1], gdal.OF_RASTER)
-    value_band = value_raster.GetRasterBand(1)
-    for offset_dict, base_block in geoprocessing.iterblocks(
-            (aligned_raster_path_list[0], 1)):
-        valid_mask = base_block == mask_code
-        value_block = value_band.ReadAsArray(**offset_dict)
-        valid_value_block = value_block[valid_mask]
-        local_nodata_count = numpy.count_nonzero(
-            numpy.isclose(valid_value_block, value_nodata))
-        nodata_count += local_nodata_count
-        valid_count += valid_value_block.size - local_nodata_count
+            unique_array = numpy.union1d(unique_array, array)
+            n_unique = unique_array.size
+        if max_unique_values is not None and n_unique > max_unique_values:
+            LOGGER.warning(
+                f'{raster_path} has more than {max_unique_values} unique '
+                f'values, stopping scan')
+            break
+    if use_bitmap:
+        unique_array = (
+            numpy.flatnonzero(seen_bitmap) + type_min).astype(dtype)
+    overflow = (
+        max_unique_values is not None and
+        unique_array.size > max_unique_values)
+    return unique_array, overflow
 
-    value_raster = None
-    value_band = None
 
-    return (raster_min, raster_max, raster_mean,
-            raster_stdev, valid_count, nodata_count)
+def _empty_class_stats(n_classes):
+    """Return per class stats arrays for ``n_classes`` with no pixels."""
+    return {
+        'valid_count': numpy.zeros(n_classes, dtype=numpy.int64),
+        'nodata_count': numpy.zeros(n_classes, dtype=numpy.int64),
+        'mean': numpy.zeros(n_classes, dtype=numpy.float64),
+        'm2': numpy.zeros(n_classes, dtype=numpy.float64),
+        'min': numpy.full(n_classes, numpy.inf),
+        'max': numpy.full(n_classes, -numpy.inf),
+    }
+
+
+def _merge_class_stats(stats_a, stats_b):
+    """Combine two per class stats dicts (Chan et al. for mean/m2)."""
+    count_a = stats_a['valid_count']
+    count_b = stats_b['valid_count']
+    count = count_a + count_b
+    safe_count = numpy.where(count > 0, count, 1)
+    delta = stats_b['mean'] - stats_a['mean']
+    return {
+        'valid_count': count,
+        'nodata_count': stats_a['nodata_count'] + stats_b['nodata_count'],
+        'mean': stats_a['mean'] + delta * count_b / safe_count,
+        'm2': (
+            stats_a['m2'] + stats_b['m2'] +
+            delta**2 * count_a * count_b / safe_count),
+        'min': numpy.minimum(stats_a['min'], stats_b['min']),
+        'max': numpy.maximum(stats_a['max'], stats_b['max']),
+    }
+
+
+def _block_class_stats(
+        class_block, value_block, class_nodata, value_nodata, class_values):
+    """Reduce one block to per class stats keyed on ``class_values``.
+
+    Args:
+        class_block (numpy.ndarray): block of the landcover raster.
+        value_block (numpy.ndarray): same block of the value raster.
+        class_nodata (numeric): landcover nodata, may be None.
+        value_nodata (numeric): value raster nodata, may be None.
+        class_values (numpy.ndarray): sorted landcover codes to report,
+            pixels with any other code are ignored.
+
+    Returns:
+        per class stats dict as in ``_empty_class_stats``.
+
+    """
+    n_classes = class_values.size
+    class_index = numpy.searchsorted(class_values, class_block)
+    in_class_mask = class_index < n_classes
+    in_class_mask[in_class_mask] = (
+        class_values[class_index[in_class_mask]] ==
+        class_block[in_class_mask])
+    if class_nodata is not None:
+        in_class_mask &= class_block != class_nodata
+
+    value_valid_mask = numpy.isfinite(value_block)
+    if value_nodata is not None:
+        value_valid_mask &= ~numpy.isclose(value_block, value_nodata)
+
+    block_stats = _empty_class_stats(n_classes)
+    block_stats['nodata_count'] = numpy.bincount(
+        class_index[in_class_mask & ~value_valid_mask], minlength=n_classes)
+    valid_mask = in_class_mask & value_valid_mask
+    class_index = class_index[valid_mask]
+    values = value_block[valid_mask].astype(numpy.float64)
+    count = numpy.bincount(class_index, minlength=n_classes)
+    block_stats['valid_count'] = count
+    block_stats['mean'] = numpy.bincount(
+        class_index, weights=values, minlength=n_classes) / numpy.where(
+            count > 0, count, 1)
+    block_stats['m2'] = numpy.bincount(
+        class_index, weights=(values - block_stats['mean'][class_index])**2,
+        minlength=n_classes)
+    numpy.minimum.at(block_stats['min'], class_index, values)
+    numpy.maximum.at(block_stats['max'], class_index, values)
+    return block_stats
+
+
+def _calculate_class_stats(
+        class_raster_path, value_raster_path, offset_list, class_values):
+    """Reduce the blocks at ``offset_list`` to per class stats.
+
+    Args:
+        class_raster_path (str): path to landcover raster.
+        value_raster_path (str): path to value raster aligned with the
+            landcover raster.
+        offset_list (list): iterblocks offset dicts to process.
+        class_values (list): sorted landcover codes to report.
+
+    Returns:
+        per class stats dict as in ``_empty_class_stats``.
+
+    """
+    class_nodata = geoprocessing.get_raster_info(
+        class_raster_path)['nodata'][0]
+    value_nodata = geoprocessing.get_raster_info(
+        value_raster_path)['nodata'][0]
+    class_raster = gdal.OpenEx(class_raster_path, gdal.OF_RASTER)
+    class_band = class_raster.GetRasterBand(1)
+    value_raster = gdal.OpenEx(value_raster_path, gdal.OF_RASTER)
+    value_band = value_raster.GetRasterBand(1)
+    class_values = numpy.array(class_values)
+    class_stats = _empty_class_stats(class_values.size)
+    for offset_dict in offset_list:
+        class_stats = _merge_class_stats(class_stats, _block_class_stats(
+            class_band.ReadAsArray(**offset_dict),
+            value_band.ReadAsArray(**offset_dict),
+            class_nodata, value_nodata, class_values))
+    class_band = None
+    class_raster = None
+    value_band = None
+    value_raster = None
+    return class_stats
 
 
 if __name__ == '__main__':
@@ -107,6 +217,10 @@ if __name__ == '__main__':
         help=(
             'number of CPUs to use for processing, default is all CPUs on '
             'the machine'))
+    parser.add_argument(
+        '--max_unique_values', type=int, default=1000, help=(
+            'stop with an error if the landcover raster has more unique '
+            'values than this, default is 1000'))
     args = parser.parse_args()
     if args.basename:
         basename = args.basename
@@ -145,30 +259,52 @@ if __name__ == '__main__':
     lulc_nodata = geoprocessing.get_raster_info(
         args.landcover_raster)['nodata']
     LOGGER.info('calculate unique values')
-    unique_values = get_unique_values(args.landcover_raster)
+    unique_values, unique_overflow = get_unique_values(
+        args.landcover_raster, max_unique_values=args.max_unique_values)
     LOGGER.debug(unique_values)
+    if unique_overflow:
+        LOGGER.error(
+            f'{args.landcover_raster} has more than {args.max_unique_values} '
+            f'unique values, is it really a landcover raster? Use '
+            f'--max_unique_values to raise the limit.')
+        sys.exit(-1)
     stats_table = open(f'stats_table_{basename}.csv', 'w')
     stats_table.write(
         'lucode,min,max,mean,stdev,valid_count,nodata_count,total\n')
 
-    masked_stats_list = []
-    for mask_code in sorted(unique_values):
-        LOGGER.debug(f'scheduling {mask_code}')
-        masked_raster_path = os.path.join(working_dir, '%d.tif' % mask_code)
-        stats_task = task_graph.add_task(
-            func=_calculate_stats,
+    # each worker reduces an interleaved share of the blocks so the rasters
+    # are read exactly once no matter how many landcover codes there are
+    class_values = unique_values
+    offset_list = list(geoprocessing.iterblocks(
+        (aligned_raster_path_list[0], 1), offset_only=True))
+    n_chunks = max(1, min(args.n_workers, len(offset_list)))
+    partial_stats_task_list = []
+    for chunk_index in range(n_chunks):
+        LOGGER.debug(f'scheduling block chunk {chunk_index}')
+        partial_stats_task_list.append(task_graph.add_task(
+            func=_calculate_class_stats,
             args=(
-                aligned_raster_path_list, mask_code, other_raster_info,
-                masked_raster_path),
+                aligned_raster_path_list[0], aligned_raster_path_list[1],
+                offset_list[chunk_index::n_chunks], class_values.tolist()),
             store_result=True,
-            target_path_list=[masked_raster_path],
-            task_name=f'mask {masked_raster_path}')
-        masked_stats_list.append((stats_task, mask_code))
+            task_name=f'class stats chunk {chunk_index}'))
 
     LOGGER.debug('waiting for it to gadot')
-    for masked_task, mask_code in masked_stats_list:
-        (raster_min, raster_max, raster_mean,
-         raster_stdev, valid_count, nodata_count) = masked_task.get()
+    class_stats = _empty_class_stats(class_values.size)
+    for partial_stats_task in partial_stats_task_list:
+        class_stats = _merge_class_stats(
+            class_stats, partial_stats_task.get())
+    for index, mask_code in enumerate(class_values):
+        valid_count = class_stats['valid_count'][index]
+        nodata_count = class_stats['nodata_count'][index]
+        if valid_count > 0:
+            raster_min = class_stats['min'][index]
+            raster_max = class_stats['max'][index]
+            raster_mean = class_stats['mean'][index]
+            raster_stdev = numpy.sqrt(
+                class_stats['m2'][index] / valid_count)
+        else:
+            raster_min = raster_max = raster_mean = raster_stdev = numpy.nan
         stats_table.write(
             '%d,%f,%f,%f,%f,%d,%d,%d\n' % (
                 mask_code, raster_min, raster_max, raster_mean, raster_stdev,
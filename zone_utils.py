@@ -0,0 +1,266 @@
+"""Zone vector, zone raster and table helpers shared by the zonal scripts.
+
+Only GDAL/OGR and numpy are needed so scripts built on either
+pygeoprocessing or ecoshard.geoprocessing can use them.
+"""
+import os
+
+from osgeo import gdal
+from osgeo import ogr
+import numpy
+
+ZONE_NODATA = -1
+# field holding the FID a feature had in the vector it was copied from
+SOURCE_FID_FIELD = 'source_fid'
+# rows formatted per write call by ``write_table``
+_WRITE_CHUNK_ROWS = 2**14
+_ZONE_RASTER_OPTION_LIST = [
+    'TILED=YES', 'BIGTIFF=YES', 'COMPRESS=LZW', 'BLOCKXSIZE=256',
+    'BLOCKYSIZE=256']
+
+
+def build_zone_vector(base_vector_path, polygons_overlap, target_vector_path):
+    """Copy the geometry of a vector tagged with its FID and a zone group.
+
+    Features in the same zone group do not overlap so each group can be
+    burnt into a single band of a zone raster.
+
+    Args:
+        base_vector_path (str): path to the aggregate vector.
+        polygons_overlap (bool): if True, greedily assign overlapping
+            features to different groups, otherwise every feature is in
+            group 0.
+        target_vector_path (str): path to GPKG to create with a
+            'zone_fid' and 'zone_group' field.
+
+    Returns:
+        number of zone groups.
+
+    """
+    base_vector = gdal.OpenEx(base_vector_path, gdal.OF_VECTOR)
+    base_layer = base_vector.GetLayer()
+    if polygons_overlap:
+        # a second handle so the spatial filter doesn't reset the main loop
+        neighbor_vector = gdal.OpenEx(base_vector_path, gdal.OF_VECTOR)
+        neighbor_layer = neighbor_vector.GetLayer()
+
+    if os.path.exists(target_vector_path):
+        os.remove(target_vector_path)
+    gpkg_driver = ogr.GetDriverByName('GPKG')
+    target_vector = gpkg_driver.CreateDataSource(target_vector_path)
+    target_layer = target_vector.CreateLayer(
+        'zones', base_layer.GetSpatialRef(), base_layer.GetGeomType())
+    for field_name in ['zone_fid', 'zone_group']:
+        target_layer.CreateField(ogr.FieldDefn(field_name, ogr.OFTInteger))
+    layer_defn = target_layer.GetLayerDefn()
+
+    fid_to_group = {}
+    target_layer.StartTransaction()
+    for base_feature in base_layer:
+        geom = base_feature.GetGeometryRef()
+        if geom is None:
+            continue
+        fid = base_feature.GetFID()
+        group = 0
+        if polygons_overlap:
+            neighbor_layer.SetSpatialFilter(geom)
+            used_group_set = set()
+            for neighbor_feature in neighbor_layer:
+                neighbor_fid = neighbor_feature.GetFID()
+                if neighbor_fid not in fid_to_group:
+                    continue
+                neighbor_geom = neighbor_feature.GetGeometryRef()
+                if (geom.Intersects(neighbor_geom) and
+                        not geom.Touches(neighbor_geom)):
+                    used_group_set.add(fid_to_group[neighbor_fid])
+            while group in used_group_set:
+                group += 1
+        fid_to_group[fid] = group
+        target_feature = ogr.Feature(layer_defn)
+        target_feature.SetGeometry(geom.Clone())
+        target_feature.SetField('zone_fid', fid)
+        target_feature.SetField('zone_group', group)
+        target_layer.CreateFeature(target_feature)
+        target_feature = None
+    target_layer.CommitTransaction()
+
+    target_layer = None
+    target_vector = None
+    neighbor_layer = None
+    neighbor_vector = None
+    base_layer = None
+    base_vector = None
+    return max(fid_to_group.values(), default=0) + 1
+
+
+def copy_with_source_fid(base_vector_path, target_vector_path):
+    """Copy the geometry of a vector tagged with its original FID.
+
+    FIDs are not kept when a vector is reprojected or changes format, a
+    shapefile counts from 0 and a GeoPackage from 1, so the FID is stored
+    in ``SOURCE_FID_FIELD`` to report results against the base vector.
+
+    Args:
+        base_vector_path (str): path to the vector to copy.
+        target_vector_path (str): path to GPKG to create with an integer
+            ``SOURCE_FID_FIELD`` field.
+
+    Returns:
+        None
+
+    """
+    base_vector = gdal.OpenEx(base_vector_path, gdal.OF_VECTOR)
+    base_layer = base_vector.GetLayer()
+    if os.path.exists(target_vector_path):
+        os.remove(target_vector_path)
+    gpkg_driver = ogr.GetDriverByName('GPKG')
+    target_vector = gpkg_driver.CreateDataSource(target_vector_path)
+    target_layer = target_vector.CreateLayer(
+        base_layer.GetName(), base_layer.GetSpatialRef(),
+        base_layer.GetGeomType())
+    target_layer.CreateField(
+        ogr.FieldDefn(SOURCE_FID_FIELD, ogr.OFTInteger64))
+    layer_defn = target_layer.GetLayerDefn()
+
+    target_layer.StartTransaction()
+    for base_feature in base_layer:
+        target_feature = ogr.Feature(layer_defn)
+        geom = base_feature.GetGeometryRef()
+        if geom is not None:
+            target_feature.SetGeometry(geom.Clone())
+        target_feature.SetField(SOURCE_FID_FIELD, base_feature.GetFID())
+        target_layer.CreateFeature(target_feature)
+        target_feature = None
+    target_layer.CommitTransaction()
+
+    target_layer = None
+    target_vector = None
+    base_layer = None
+    base_vector = None
+
+
+def rasterize_zones(
+        zone_vector_path, n_groups, base_raster_path,
+        target_zone_raster_path):
+    """Burn zone FIDs onto the grid of ``base_raster_path``.
+
+    Args:
+        zone_vector_path (str): vector created by ``build_zone_vector``.
+        n_groups (int): number of zone groups in ``zone_vector_path``.
+        base_raster_path (str): raster whose grid to rasterize onto.
+        target_zone_raster_path (str): path to an Int32 raster to create
+            with one band per zone group holding the feature FID, or
+            ``ZONE_NODATA`` where no feature of that group covers a pixel.
+
+    Returns:
+        None
+
+    """
+    base_raster = gdal.OpenEx(base_raster_path, gdal.OF_RASTER)
+    zone_raster = gdal.GetDriverByName('GTiff').Create(
+        target_zone_raster_path, base_raster.RasterXSize,
+        base_raster.RasterYSize, n_groups, gdal.GDT_Int32,
+        options=_ZONE_RASTER_OPTION_LIST)
+    zone_raster.SetGeoTransform(base_raster.GetGeoTransform())
+    zone_raster.SetProjection(base_raster.GetProjection())
+    base_raster = None
+    for group in range(n_groups):
+        zone_band = zone_raster.GetRasterBand(group+1)
+        zone_band.SetNoDataValue(ZONE_NODATA)
+        zone_band.Fill(ZONE_NODATA)
+        zone_band = None
+    zone_vector = gdal.OpenEx(zone_vector_path, gdal.OF_VECTOR)
+    zone_layer = zone_vector.GetLayer()
+    for group in range(n_groups):
+        zone_layer.SetAttributeFilter(f'zone_group = {group}')
+        gdal.RasterizeLayer(
+            zone_raster, [group+1], zone_layer,
+            options=['ATTRIBUTE=zone_fid'])
+    zone_layer = None
+    zone_vector = None
+    zone_raster = None
+
+
+def read_field_values(vector_path, field_name):
+    """Read the FID and ``field_name`` of every feature in one layer scan.
+
+    Geometry and every other field are ignored while reading. If GDAL
+    supports it the layer is read in batches through its Arrow stream,
+    otherwise features are read sequentially.
+
+    Args:
+        vector_path (str): path to vector.
+        field_name (str): field to read.
+
+    Returns:
+        (fid_array, value_list) of the FIDs and their field values.
+
+    """
+    vector = gdal.OpenEx(vector_path, gdal.OF_VECTOR)
+    layer = vector.GetLayer()
+    layer_defn = layer.GetLayerDefn()
+    layer.SetIgnoredFields([
+        layer_defn.GetFieldDefn(index).GetName()
+        for index in range(layer_defn.GetFieldCount())
+        if layer_defn.GetFieldDefn(index).GetName() != field_name] +
+        ['OGR_GEOMETRY', 'OGR_STYLE'])
+    fid_batch_list = []
+    value_list = []
+    if hasattr(layer, 'GetArrowStreamAsNumPy'):
+        fid_column = layer.GetFIDColumn() or 'OGC_FID'
+        for batch in layer.GetArrowStreamAsNumPy(
+                options=['INCLUDE_FID=YES', 'USE_MASKED_ARRAYS=NO']):
+            fid_batch_list.append(numpy.asarray(
+                batch[fid_column], dtype=numpy.int64))
+            value_list.extend(
+                value.decode('utf-8') if isinstance(value, bytes) else value
+                for value in batch[field_name].tolist())
+        fid_array = (
+            numpy.concatenate(fid_batch_list) if fid_batch_list
+            else numpy.empty(0, dtype=numpy.int64))
+    else:
+        fid_list = []
+        for feature in layer:
+            fid_list.append(feature.GetFID())
+            value_list.append(feature.GetField(field_name))
+        fid_array = numpy.array(fid_list, dtype=numpy.int64)
+    layer = None
+    vector = None
+    return fid_array, value_list
+
+
+def write_table(table_path, column_list, header_line_list=()):
+    """Write equal length columns to a CSV or Parquet table.
+
+    CSV rows are formatted a chunk at a time and written in one call per
+    chunk. Paths ending in ``.parquet`` are written with pandas, which
+    needs pyarrow or fastparquet, and drop ``header_line_list``.
+
+    Args:
+        table_path (str): path to the table to create.
+        column_list (list): list of (column name, sequence) tuples.
+        header_line_list (list): lines written above the CSV column names.
+
+    Returns:
+        None
+
+    """
+    if table_path.endswith('.parquet'):
+        import pandas
+        pandas.DataFrame({
+            name: numpy.asarray(values) for name, values in column_list
+        }).to_parquet(table_path, index=False)
+        return
+    n_rows = len(column_list[0][1]) if column_list else 0
+    with open(table_path, 'w') as table_file:
+        for header_line in header_line_list:
+            table_file.write(f'{header_line}\n')
+        table_file.write(
+            ','.join([name for name, _ in column_list]) + '\n')
+        for row_start in range(0, n_rows, _WRITE_CHUNK_ROWS):
+            str_column_list = [
+                numpy.asarray(
+                    values[row_start:row_start+_WRITE_CHUNK_ROWS]).astype(str)
+                for _, values in column_list]
+            table_file.write(''.join([
+                ','.join(row) + '\n' for row in zip(*str_column_list)]))